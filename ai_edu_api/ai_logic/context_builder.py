@@ -0,0 +1,200 @@
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+
+from ai_edu_api.supabase_logic.knowledge_graph import extract_terms
+
+# --- 会話コンテキストの組み立て（重複排除・トークン予算・ローリング要約） ---
+# 履歴を毎回すべて送るのではなく、直近のターンはそのまま、古いターンは
+# chat_idごとに増分で更新する要約にまとめ、トークン予算内に収める。
+# 要約は上流を呼ばずにローカルで作る抽出型:
+#   - 話題: 古いターン全体から抽出した用語を出現回数の多い順に（行を捨てても話題は残る）
+#   - 流れ: 1ターン1行の要点（発言の最初の一文）。予算を超えたら古い行から話題だけに畳む
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_SUMMARY_TOKENS = int(os.environ.get("CONTEXT_SUMMARY_TOKENS", "400"))
+CONTEXT_MAX_CHATS = int(os.environ.get("CONTEXT_MAX_CHATS", "1024"))
+
+# 1メッセージあたりの役割・区切りのオーバーヘッド（OpenAIのチャット形式の概算）
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_LINE_CHARS = 60
+SUMMARY_TOPICS = 8  # 要約に載せる話題（用語）の数
+_SENTENCE_END = re.compile(r"(?<=[。！？!?\n])")
+
+# 英数字の連続は1語、それ以外（日本語など）は1文字ずつトークンとして数える
+_TOKEN_PATTERN = re.compile(r"[A-Za-z0-9_]+|\S")
+
+
+def count_tokens(text):
+    """ローカルでトークン数を概算する（英単語は4文字≒1トークン、日本語は1文字≒1トークン）"""
+    if not text:
+        return 0
+    total = 0
+    for token in _TOKEN_PATTERN.findall(text):
+        total += math.ceil(len(token) / 4) if token[0].isascii() and token[0].isalnum() else 1
+    return total
+
+
+def message_tokens(message):
+    return count_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+
+def message_identity(message):
+    """メッセージの同一性キー（idがあればid、なければ役割・本文・作成時刻）"""
+    if message.get("id"):
+        return ("id", str(message["id"]))
+    return (message.get("role"), message.get("content"), message.get("created_at"))
+
+
+def dedupe_messages(*message_lists):
+    """複数の履歴を結合し、前のリストと重なるメッセージ（同じオブジェクトか同じid）だけを除いて返す
+
+    1つの履歴の中の繰り返し（「はい」が続く等）はまとめない。最後のリストの最新メッセージは必ず末尾に残す。
+    """
+    seen_objects = set()
+    seen_ids = set()
+    merged = []
+    for messages in message_lists:
+        added = []
+        for message in messages or []:
+            message_id = message.get("id")
+            if id(message) in seen_objects or (message_id and str(message_id) in seen_ids):
+                continue
+            added.append(message)
+        # 同じリストの中では重複とみなさないよう、リストを見終えてから既出に加える
+        for message in added:
+            seen_objects.add(id(message))
+            if message.get("id"):
+                seen_ids.add(str(message["id"]))
+        merged.extend(added)
+    latest = next((messages[-1] for messages in reversed(message_lists) if messages), None)
+    if latest is not None and merged and merged[-1] is not latest:
+        # 最新の発言が前のリストとの重なりとして落ちた場合も、末尾に置き直す
+        latest_id = latest.get("id")
+        merged = [
+            m for m in merged
+            if m is not latest and not (latest_id and str(m.get("id")) == str(latest_id))
+        ] + [latest]
+    return merged
+
+
+class BuiltContext:
+    __slots__ = ("summary", "messages", "raw_tokens", "sent_tokens")
+
+    def __init__(self, summary, messages, raw_tokens, sent_tokens):
+        self.summary = summary
+        self.messages = messages
+        self.raw_tokens = raw_tokens
+        self.sent_tokens = sent_tokens
+
+    @property
+    def saved_tokens(self):
+        return max(0, self.raw_tokens - self.sent_tokens)
+
+
+class _RollingSummary:
+    __slots__ = ("folded", "last_identity", "topics", "lines", "line_tokens", "dropped")
+
+    def __init__(self):
+        self.folded = 0
+        self.last_identity = None
+        self.topics = Counter()  # 用語 -> 古いターンでの出現回数
+        self.lines = []
+        self.line_tokens = []
+        self.dropped = 0
+
+
+def key_sentence(content):
+    """発言の要点として最初の一文（長すぎれば切り詰める）を返す"""
+    text = " ".join((content or "").split())
+    sentence = next((part for part in _SENTENCE_END.split(text) if part.strip()), "")
+    if len(sentence) > SUMMARY_LINE_CHARS:
+        sentence = sentence[:SUMMARY_LINE_CHARS] + "…"
+    return sentence
+
+
+class ContextBuilder:
+    def __init__(
+        self,
+        token_budget=CONTEXT_TOKEN_BUDGET,
+        summary_tokens=CONTEXT_SUMMARY_TOKENS,
+        max_chats=CONTEXT_MAX_CHATS,
+    ):
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.max_chats = max_chats
+        self._summaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def build(self, chat_id, *message_lists):
+        """履歴リストを重複排除し、要約＋直近メッセージのコンテキストを組み立てる"""
+        raw_tokens = sum(message_tokens(m) for messages in message_lists for m in messages or [])
+        history = dedupe_messages(*message_lists)
+
+        # 新しい方から予算に収まるだけ原文のまま残す（最新の1件は必ず残す）
+        recent_budget = self.token_budget - self.summary_tokens
+        used = 0
+        split = len(history)
+        while split > 0:
+            cost = message_tokens(history[split - 1])
+            if split < len(history) and used + cost > recent_budget:
+                break
+            used += cost
+            split -= 1
+
+        summary = self._summarize(chat_id, history, split) if split else ""
+        sent_tokens = used + count_tokens(summary)
+        return BuiltContext(summary, history[split:], raw_tokens, sent_tokens)
+
+    def forget(self, chat_id):
+        with self._lock:
+            self._summaries.pop(chat_id, None)
+
+    def _summarize(self, chat_id, history, split):
+        with self._lock:
+            state = self._summaries.get(chat_id) if chat_id else None
+            # 前回までに畳み込んだ範囲が今回の履歴の先頭と一致する場合だけ差分を追加する
+            if (
+                state is None
+                or state.folded > split
+                or (state.folded and message_identity(history[state.folded - 1]) != state.last_identity)
+            ):
+                state = _RollingSummary()
+            for message in history[state.folded:split]:  # 前回より後に古くなった分だけを畳み込む
+                self._fold(state, message)
+            state.folded = split
+            state.last_identity = message_identity(history[split - 1])
+            if chat_id:
+                self._summaries[chat_id] = state
+                self._summaries.move_to_end(chat_id)
+                while len(self._summaries) > self.max_chats:
+                    self._summaries.popitem(last=False)
+            return self._render(state)
+
+    def _render(self, state):
+        parts = []
+        if state.topics:
+            parts.append("話題: " + "、".join(term for term, _ in state.topics.most_common(SUMMARY_TOPICS)))
+        if state.lines:
+            parts.append("流れ:" + (f"（それ以前の{state.dropped}件は話題のみ）" if state.dropped else ""))
+            parts.extend(state.lines)
+        return "\n".join(parts)
+
+    def _fold(self, state, message):
+        content = message.get("content") or ""
+        state.topics.update(extract_terms(content))
+        line = f"- {message.get('role', 'user')}: {key_sentence(content)}"
+        state.lines.append(line)
+        state.line_tokens.append(count_tokens(line))
+        # 要約自体も予算を超えないよう、古い行から捨てる（その行の話題は topics に残る）
+        budget = self.summary_tokens - SUMMARY_TOPICS * 2
+        while len(state.lines) > 1 and sum(state.line_tokens) > budget:
+            state.lines.pop(0)
+            state.line_tokens.pop(0)
+            state.dropped += 1
+
+
+# /chat・/chat/stream と chat_endpoint_logic で共有する（chat_idごとの要約をプロセスで1つに持つ）
+context_builder = ContextBuilder()
@@ -0,0 +1,184 @@
+import re
+import unicodedata
+from array import array
+from bisect import bisect_right
+
+from ai_edu_api.supabase_logic.profile_store import EMOTION_LABELS, EMOTION_INDEX
+
+# --- ローカルの感情ラベラー（CPUのみ・辞書と文字n-gram） ---
+# 返答の emotion を埋めるためだけに上流をJSONモードで呼ぶのをやめ、
+# 返答・ユーザーの発言の感情をプロセス内でマイクロ秒単位でラベル付けする。
+#   - 語彙はNFKC正規化・小文字化した「語幹」の文字n-gram（活用形や「大好き」等もまとめて拾う）
+#   - 全語彙を1つのトライ状の正規表現にまとめ、バッチはテキストを連結して1回の走査で処理する
+#   - 直後の否定（〜くない・〜じゃない・〜なかった）と直前の英語の否定（not 〜）で極性を反転する
+# ラベルはプロファイルストアと同じ EMOTION_LABELS。どの語彙にも当たらなければニュートラル。
+
+NEUTRAL = "ニュートラル"
+MIN_SCORE = 0.75  # これ未満の得点しか無ければニュートラル
+NEGATED_WEIGHT = 0.5  # 否定されたネガティブ語（難しくない等）をポジティブとして数える重み
+
+_POSITIVE = (EMOTION_INDEX["ポジティブ"], EMOTION_INDEX["喜び"])
+_NEGATIVE = (EMOTION_INDEX["ネガティブ"], EMOTION_INDEX["怒り"], EMOTION_INDEX["悲しみ"])
+# 同点のときは具体的な感情を優先する
+_PRIORITY = tuple(EMOTION_INDEX[label] for label in ("喜び", "怒り", "悲しみ", "驚き", "ネガティブ", "ポジティブ"))
+
+# 全角英数・記号と全角空白は表で半角にし、それで足りる文字列はNFKC正規化を省く（日本語の大半）
+_FULLWIDTH = {code: code - 0xFEE0 for code in range(0xFF01, 0xFF5F)}
+_FULLWIDTH[0x3000] = 0x20
+_SEPARATOR = "\x00"  # バッチ連結用（語彙にも否定の窓にも現れない文字）
+_NEGATION_AFTER = re.compile(r"[^\x00。、!?.\n]{0,2}?(?:ない|なかっ|なく|ません|ねー|ねえ)")
+_NEGATION_BEFORE = re.compile(r"(?:\bnot|\bnever|n't|\bno)\s+$")
+
+# ラベル -> (語幹, 重み) の並び。重み2は単独でほぼ確定できる強い手がかり
+LEXICON = {
+    "喜び": (
+        ("嬉し", 2), ("うれし", 2), ("楽し", 1.5), ("たのし", 1.5), ("幸せ", 2), ("しあわせ", 2),
+        ("やった", 2), ("やったー", 2), ("よっしゃ", 2), ("わーい", 2), ("最高", 2), ("大好き", 2),
+        ("好き", 1), ("わくわく", 2), ("ワクワク", 2), ("面白", 1.5), ("おもしろ", 1.5), ("笑", 1),
+        ("合格", 1.5), ("できた", 1), ("出来た", 1), ("解けた", 1.5), ("喜", 1.5),
+        ("ハッピー", 2), ("happy", 2), ("glad", 2), ("yay", 2), ("love", 1.5), ("fun", 1), ("funny", 1),
+        ("😊", 2), ("😄", 2), ("😁", 2), ("😆", 2), ("🥰", 2), ("😍", 2), ("🎉", 2), ("(^^)", 2), ("♪", 1),
+    ),
+    "ポジティブ": (
+        ("ありがと", 2), ("感謝", 2), ("助か", 1.5), ("良い", 1), ("よい", 0.5), ("いい", 0.5), ("落ち着", 1),
+        ("良かった", 1.5),
+        ("よかった", 1.5), ("素晴らし", 2), ("すばらし", 2), ("頑張", 1.5), ("がんば", 1.5), ("大丈夫", 1),
+        ("安心", 1.5), ("なるほど", 1.5), ("納得", 1.5), ("理解でき", 1.5), ("上手", 1.5), ("得意", 1.5),
+        ("自信", 1), ("前向き", 1.5), ("期待", 1), ("楽しみ", 1.5), ("正解", 1.5), ("よくでき", 2),
+        ("上達", 1.5), ("成長", 1), ("応援", 1.5), ("素敵", 2), ("すてき", 2), ("完璧", 1.5), ("うまくいっ", 1.5),
+        ("good", 1.5), ("great", 2), ("nice", 1.5), ("thank", 2), ("excellent", 2), ("👍", 2),
+    ),
+    "ネガティブ": (
+        ("嫌", 1.5), ("苦手", 1.5), ("難し", 0.5), ("むずかし", 0.5), ("わかりませ", 1), ("わかりにく", 1.5),
+        ("わからな", 1), ("分からな", 1),
+        ("わかんな", 1), ("無理", 1.5), ("むり", 1.5), ("不安", 1.5), ("心配", 1.5), ("疲れ", 1.5),
+        ("つかれ", 1.5), ("しんど", 1.5), ("面倒", 1.5), ("めんどう", 1.5), ("めんどくさ", 2), ("だる", 1.5),
+        ("最悪", 2), ("ダメ", 1), ("だめ", 1), ("困", 1.5), ("間違", 1), ("失敗", 1.5), ("不合格", 2),
+        ("落ち", 1), ("嫌い", 2), ("退屈", 1.5), ("つまらな", 2), ("やる気が出な", 2), ("やる気がな", 2),
+        ("自信がな", 2), ("焦", 1.5), ("憂鬱", 2), ("ゆううつ", 2), ("ストレス", 1.5), ("ミス", 1),
+        ("bad", 1.5), ("difficult", 1), ("tired", 1.5), ("boring", 1.5), ("confus", 1.5), ("worried", 1.5),
+        ("😞", 2), ("😩", 2), ("😓", 1.5),
+    ),
+    "怒り": (
+        ("怒", 2), ("むかつ", 2), ("ムカつ", 2), ("ムカムカ", 2), ("イライラ", 2), ("いらいら", 2),
+        ("腹が立", 2), ("腹立", 2), ("ふざけ", 2), ("うざ", 2), ("ウザ", 2), ("許せな", 2), ("頭にく", 2),
+        ("頭に来", 2), ("キレ", 1.5), ("ちくしょう", 2), ("くそ", 1.5), ("クソ", 1.5), ("いい加減にし", 2),
+        ("angry", 2), ("annoy", 2), ("hate", 2), ("furious", 2), ("💢", 2), ("😡", 2), ("😠", 2),
+    ),
+    "驚き": (
+        ("驚", 2), ("びっくり", 2), ("ビックリ", 2), ("まさか", 2), ("えっ", 1.5), ("ええっ", 2), ("えー", 1),
+        ("マジ", 1), ("まじ", 1), ("ほんとに?", 1.5), ("本当に?", 1.5), ("信じられな", 2), ("意外", 1.5),
+        ("知らなかった", 2), ("なんと", 1), ("すごい", 1), ("すご!", 1), ("すげ", 1), ("凄", 1), ("へぇ", 1.5),
+        ("へー", 1.5), ("!?", 1.5), ("?!", 1.5), ("wow", 2), ("surpris", 2), ("😲", 2), ("😮", 2), ("😱", 2),
+    ),
+    "悲しみ": (
+        ("悲し", 2), ("かなし", 2), ("寂し", 2), ("さみし", 2), ("さびし", 2), ("泣", 2), ("涙", 2),
+        ("つら", 1.5), ("辛い", 1.5), ("辛かった", 1.5), ("落ち込", 2), ("残念", 1.5), ("がっかり", 2),
+        ("切な", 2), ("孤独", 2), ("失恋", 2), ("凹", 1.5), ("へこ", 1.5), ("しょんぼり", 2), ("絶望", 2),
+        ("sad", 2), ("lonely", 2), ("cry", 1.5), ("crying", 1.5), ("cried", 1.5), ("😢", 2), ("😭", 2), ("😿", 2),
+    ),
+}
+
+
+def normalize_text(text):
+    """全角・半角や大文字小文字の違いで語彙を取りこぼさないように正規化する"""
+    text = str(text or "").translate(_FULLWIDTH)
+    if not unicodedata.is_normalized("NFKC", text):
+        text = unicodedata.normalize("NFKC", text)
+    return text.lower()
+
+
+def _trie_pattern(node):
+    # 共通の接頭辞をまとめた正規表現（選択肢を1つずつ試さず、1文字ずつ枝をたどる）
+    alternatives = [re.escape(char) + _trie_pattern(child) for char, child in sorted(node.items()) if char]
+    if not alternatives:
+        return ""
+    body = alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+    if "" in node:
+        # ここで終わる語もある。より長い語を優先して貪欲に伸ばす
+        body = "(?:" + body + ")?"
+    return body
+
+
+def compile_lexicon(lexicon):
+    """語彙を (正規表現, 語幹 -> ((ラベル番号, 重み), ...)) に変換する"""
+    weights = {}
+    trie = {}
+    for label, entries in lexicon.items():
+        for term, weight in entries:
+            term = normalize_text(term)
+            weights.setdefault(term, ())
+            weights[term] += ((EMOTION_INDEX[label], float(weight)),)
+            node = trie
+            for char in term:
+                node = node.setdefault(char, {})
+            node[""] = {}
+    return re.compile(_trie_pattern(trie)), weights
+
+
+class EmotionLabeler:
+    def __init__(self, lexicon=LEXICON, min_score=MIN_SCORE):
+        self.lexicon = lexicon
+        self.min_score = min_score
+        self.labels = EMOTION_LABELS
+        self._compiled = None  # 正規表現の組み立ては初回（ウォームアップ）まで遅らせ、起動時のimportを軽くする
+
+    def compile(self):
+        if self._compiled is None:
+            self._compiled = compile_lexicon(self.lexicon)
+        return self._compiled
+
+    def scores_batch(self, texts):
+        """テキストごとのラベル別得点（len(EMOTION_LABELS) 要素の array）を返す"""
+        texts = [normalize_text(text) for text in texts]
+        if not texts:
+            return []
+        pattern, weights = self.compile()
+        width = len(self.labels)
+        scores = array("d", [0.0]) * (width * len(texts))
+        # 連結した1本の文字列を1回だけ走査し、一致位置から元のテキストを引く
+        joined = _SEPARATOR.join(texts)
+        starts = []
+        offset = 0
+        for text in texts:
+            starts.append(offset)
+            offset += len(text) + 1
+        for match in pattern.finditer(joined):
+            begin, end = match.span()
+            term = match.group()
+            if term[0].isascii() and term[0].isalpha() and (
+                (begin and joined[begin - 1].isalnum())
+                or (len(term) <= 3 and end < len(joined) and joined[end].isalnum())
+            ):
+                continue  # 英単語の途中（"fun" in "function" 等）は数えない。4文字以上は語幹として前方一致
+            base = (bisect_right(starts, begin) - 1) * width
+            negated = _NEGATION_AFTER.match(joined, end) is not None or (
+                term[0].isascii() and _NEGATION_BEFORE.search(joined, max(0, begin - 8), begin) is not None
+            )
+            for label, weight in weights[term]:
+                if not negated:
+                    scores[base + label] += weight
+                elif label in _POSITIVE:
+                    scores[base + EMOTION_INDEX["ネガティブ"]] += weight  # 楽しくない・好きじゃない
+                elif label in _NEGATIVE:
+                    scores[base + EMOTION_INDEX["ポジティブ"]] += weight * NEGATED_WEIGHT  # 難しくない
+        return [scores[i * width:(i + 1) * width] for i in range(len(texts))]
+
+    def label_batch(self, texts):
+        """テキストの並びをまとめてラベル付けする（1回の正規表現走査）"""
+        return [self._decide(scores) for scores in self.scores_batch(texts)]
+
+    def label(self, text):
+        return self.label_batch((text,))[0]
+
+    def _decide(self, scores):
+        best = None
+        best_score = self.min_score
+        for index in _PRIORITY:
+            if scores[index] >= best_score and (best is None or scores[index] > scores[best]):
+                best = index
+                best_score = scores[index]
+        return self.labels[best] if best is not None else NEUTRAL
+
+
+emotion_labeler = EmotionLabeler()
@@ -0,0 +1,202 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+
+# --- ホットパス向けのログ基盤 ---
+# リクエスト処理中はレコードをキューに積むだけにし、整形・伏せ字・切り詰め・出力は
+# バックグラウンドのリスナースレッドで行う。ログの引数は logger.debug("...%s", x) の形で渡し、
+# 呼び出し側で文字列を組み立てない（レベルで捨てられる場合は整形自体が行われない）。
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")  # "text" または "json"
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_MAX_CHARS = int(os.environ.get("LOG_MAX_CHARS", "500"))  # 1メッセージの最大文字数
+# レベルごとのサンプリング率（例: "DEBUG=0.01,INFO=1"）。WARNING以上は既定で全件
+LOG_SAMPLE_RATES = os.environ.get("LOG_SAMPLE_RATES", "DEBUG=1,INFO=1")
+
+REQUEST_ID_HEADER = "x-request-id"
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+# APIキー・トークン類はログに残さない
+_SECRET_PATTERNS = (
+    re.compile(r"sk-[A-Za-z0-9_\-]{8,}"),
+    re.compile(r"(?i)(bearer\s+)[A-Za-z0-9._\-]+"),
+    re.compile(r"(?i)((?:api[_-]?key|anon[_-]?key|password|secret|token)[\"']?\s*[:=]\s*[\"']?)[^\s\"',}]+"),
+)
+
+
+def parse_sample_rates(text):
+    rates = {}
+    for part in (text or "").split(","):
+        if "=" not in part:
+            continue
+        level, rate = part.split("=", 1)
+        level_no = logging.getLevelName(level.strip().upper())
+        if isinstance(level_no, int):
+            rates[level_no] = max(0.0, min(1.0, float(rate)))
+    return rates
+
+
+def redact(text):
+    for pattern in _SECRET_PATTERNS:
+        if pattern.groups:
+            text = pattern.sub(lambda m: m.group(1) + "***", text)
+        else:
+            text = pattern.sub("***", text)
+    return text
+
+
+def truncate(text, max_chars=LOG_MAX_CHARS):
+    if max_chars and len(text) > max_chars:
+        return f"{text[:max_chars]}…(+{len(text) - max_chars}文字)"
+    return text
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+class SamplingFilter(logging.Filter):
+    """レベルごとに指定の割合だけレコードを通す（未指定のレベルは全件）"""
+
+    def __init__(self, rates=None, rand=random.random):
+        super().__init__()
+        self.rates = rates or {}
+        self.rand = rand
+        self.dropped = 0
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno)
+        if rate is None or rate >= 1.0 or self.rand() < rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """キューに積むだけのハンドラ。満杯なら待たずに捨てて件数を数える"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # 整形はリスナー側で行う。相関IDだけはリクエストのコンテキストにいるうちに取る
+        record.request_id = request_id_var.get()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SafeFormatter(logging.Formatter):
+    """メッセージを伏せ字・切り詰めしてから整形する（リスナースレッドで実行）"""
+
+    def __init__(self, fmt=None, json_output=False, max_chars=LOG_MAX_CHARS):
+        super().__init__(fmt or "%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s")
+        self.json_output = json_output
+        self.max_chars = max_chars
+
+    def format(self, record):
+        try:
+            message = record.getMessage()
+        except Exception as e:
+            message = f"{record.msg!r} (ログの整形に失敗: {e})"
+        message = truncate(redact(message), self.max_chars)
+        if record.exc_text:
+            message = f"{message}\n{redact(record.exc_text)}"
+        if not hasattr(record, "request_id"):
+            record.request_id = "-"
+        if self.json_output:
+            return json.dumps({
+                "ts": self.formatTime(record),
+                "level": record.levelname,
+                "logger": record.name,
+                "request_id": record.request_id,
+                "message": message,
+            }, ensure_ascii=False)
+        record.message = message
+        record.asctime = self.formatTime(record)
+        return self.formatMessage(record)
+
+
+_listener = None
+_handler = None
+
+
+def setup_logging(level=LOG_LEVEL, stream=None, json_output=None, sample_rates=None):
+    """ai_edu_api配下のロガーをキュー経由の非同期出力にする（何度呼んでも1回だけ設定）"""
+    global _listener, _handler
+    logger = logging.getLogger("ai_edu_api")
+    logger.setLevel(level)
+    if _handler is not None:
+        return _handler
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _handler = NonBlockingQueueHandler(log_queue)
+    _handler.addFilter(SamplingFilter(parse_sample_rates(LOG_SAMPLE_RATES) if sample_rates is None else sample_rates))
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(SafeFormatter(json_output=(LOG_FORMAT == "json") if json_output is None else json_output))
+    _listener = QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    logger.addHandler(_handler)
+    logger.propagate = False
+    atexit.register(shutdown_logging)
+    return _handler
+
+
+def shutdown_logging():
+    """キューに残ったレコードを書き出してリスナーを止める"""
+    global _listener, _handler
+    if _listener is not None:
+        _listener.stop()
+        logging.getLogger("ai_edu_api").removeHandler(_handler)
+    _listener = None
+    _handler = None
+
+
+class CorrelationIdMiddleware:
+    """リクエストごとに相関IDを払い出し、ログとレスポンスヘッダ（X-Request-ID）に載せる
+
+    クライアントがX-Request-IDを送ってきた場合はそれを引き継ぐ。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = None
+        for name, value in scope.get("headers", ()):
+            if name == REQUEST_ID_HEADER.encode():
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or new_request_id()
+        token = request_id_var.set(request_id)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [
+                    (REQUEST_ID_HEADER.encode(), request_id.encode("latin-1"))
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id_var.reset(token)
@@ -0,0 +1,306 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# --- ホットパスの計測とPrometheus形式のメトリクス ---
+# 区間（span）ごとの処理時間・アップストリームの待ち時間と生成時間・TTFT・トークン数を
+# ヒストグラムに記録し、/metrics でPrometheusのテキスト形式として公開する。
+# 記録は perf_counter 2回とバケットの二分探索だけなので、本番で常時有効にしておける。
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+RATE_BUCKETS = (1, 5, 10, 20, 40, 80, 160, 320)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}  # ラベル値のタプル -> [バケットごとの件数..., +Inf件数, 合計]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def count(self, *label_values):
+        series = self._series.get(label_values)
+        return sum(series[:-1]) if series else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+        for labels, series in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, hits in zip(self.buckets, series):
+                cumulative += hits
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, ('le', bound))} {cumulative}")
+            cumulative += series[len(self.buckets)]
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, ('le', '+Inf'))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            snapshot = dict(self._values)
+        for labels, value in sorted(snapshot.items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}")
+        return lines
+
+
+class Gauge:
+    """読み出し時に関数を呼んで現在値を得るゲージ（キュー長・in-flight数など）。
+    read が無ければ set() で最後に書いた値を返す（バックグラウンド処理の遅延など）"""
+
+    def __init__(self, name, help_text, read=None):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+    def render(self):
+        try:
+            value = self.read() if self.read is not None else self.value
+        except Exception:
+            return []
+        if value is None:
+            return []
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {_format_value(value)}"]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        # 同名のメトリクスはモジュールの再読み込み等でも1つにまとめる
+        return self._metrics.setdefault(metric.name, metric)
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, label_names, buckets))
+
+    def counter(self, name, help_text, label_names=()):
+        return self._register(Counter(name, help_text, label_names))
+
+    def gauge(self, name, help_text, read=None):
+        gauge = Gauge(name, help_text, read)
+        self._metrics[name] = gauge  # 読み出し関数は最新の登録で置き換える
+        return gauge
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+HTTP_REQUEST_SECONDS = registry.histogram(
+    "http_request_duration_seconds", "HTTPリクエストの処理時間（レスポンス送信完了まで）", ("method", "path", "status")
+)
+STAGE_SECONDS = registry.histogram(
+    "chat_stage_duration_seconds", "チャット処理の区間ごとの処理時間", ("endpoint", "stage")
+)
+UPSTREAM_QUEUE_SECONDS = registry.histogram(
+    "upstream_queue_seconds", "アップストリームの同時実行枠を待った時間", ("kind", "priority")
+)
+UPSTREAM_SECONDS = registry.histogram(
+    "upstream_request_seconds", "アップストリーム呼び出しの所要時間（ネットワーク＋生成）", ("kind", "model")
+)
+STREAM_TTFT_SECONDS = registry.histogram(
+    "stream_time_to_first_token_seconds", "ストリーミングで最初のトークンを送るまでの時間", ("endpoint",)
+)
+STREAM_TOKENS_PER_SECOND = registry.histogram(
+    "stream_tokens_per_second", "ストリーミングの生成速度（最初のトークン以降）", ("endpoint",), RATE_BUCKETS
+)
+PROMPT_TOKENS = registry.histogram(
+    "upstream_prompt_tokens", "1リクエストあたりのプロンプトトークン数", ("model",), TOKEN_BUCKETS
+)
+COMPLETION_TOKENS = registry.histogram(
+    "upstream_completion_tokens", "1リクエストあたりの生成トークン数", ("model",), TOKEN_BUCKETS
+)
+CACHED_PROMPT_TOKENS = registry.histogram(
+    "upstream_cached_prompt_tokens", "1リクエストあたりのプロンプトキャッシュに乗ったトークン数", ("model",), TOKEN_BUCKETS
+)
+PROMPT_TOKENS_TOTAL = registry.counter(
+    "upstream_prompt_tokens_total", "プロンプトトークン数の累計", ("model",)
+)
+CACHED_PROMPT_TOKENS_TOTAL = registry.counter(
+    "upstream_cached_prompt_tokens_total", "プロンプトキャッシュに乗ったトークン数の累計（ヒット率 = これ / prompt_tokens_total）", ("model",)
+)
+UPSTREAM_ERRORS = registry.counter(
+    "upstream_errors_total", "アップストリーム呼び出しの失敗数", ("kind", "model")
+)
+UPSTREAM_COALESCED = registry.counter(
+    "upstream_coalesced_total", "実行中の同一リクエストに合流してアップストリーム呼び出しを省いた数"
+)
+UPSTREAM_RETRIES = registry.counter(
+    "upstream_retries_total", "429・5xx・タイムアウトでアップストリーム呼び出しを再試行した数", ("kind", "model")
+)
+UPSTREAM_SHED = registry.counter(
+    "upstream_shed_total", "受付制御で断ったリクエスト数（rate_limited / queue_full / preempted / queue_timeout）", ("reason",)
+)
+MODEL_HEDGES = registry.counter(
+    "model_hedges_total", "期限内に応答が無く予備のモデルへ出したリクエスト（fired）と、予備が先に返した数（won）", ("mode", "result")
+)
+MODEL_FALLBACKS = registry.counter(
+    "model_fallbacks_total", "モデルの失敗で次のモデルに切り替えた数", ("mode", "model")
+)
+QUIZ_POOL_REQUESTS = registry.counter(
+    "quiz_pool_requests_total", "問題プールへの取り出し要求（hit: ストックから即答 / miss: 同期生成へ）", ("result",)
+)
+QUIZ_POOL_PROBLEMS = registry.counter(
+    "quiz_pool_problems_total", "問題プールに追加した問題数", ("result",)
+)
+RESPONSE_CACHE_HITS = registry.counter(
+    "response_cache_hits_total", "問題生成キャッシュのヒット数（tier: 応答したキャッシュ層 memory / disk）", ("tier",)
+)
+RESPONSE_CACHE_MISSES = registry.counter(
+    "response_cache_misses_total", "問題生成キャッシュのミス数（tier: 最後に引いたキャッシュ層 memory / disk）", ("tier",)
+)
+KNOWLEDGE_LAG_SECONDS = registry.gauge(
+    "knowledge_graph_lag_seconds", "知識グラフの取り込みの遅れ（最新のメッセージと取り込み済みのcreated_atの差）"
+)
+KNOWLEDGE_BATCH_SECONDS = registry.histogram(
+    "knowledge_graph_batch_seconds", "知識グラフの増分取り込み1バッチの所要時間（取得＋反映）"
+)
+KNOWLEDGE_ROWS = registry.counter(
+    "knowledge_graph_rows_total", "知識グラフに取り込んだメッセージ数"
+)
+
+
+@contextmanager
+def span(endpoint, stage):
+    """with span("chat", "upstream"): ... の区間の処理時間を記録する"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, endpoint, stage)
+
+
+def record_usage(model, usage):
+    """レスポンスのusage（prompt_tokens / completion_tokens）を記録する"""
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    if isinstance(prompt_tokens, int):
+        PROMPT_TOKENS.observe(prompt_tokens, model)
+        PROMPT_TOKENS_TOTAL.inc(prompt_tokens, model)
+        # 上流の自動プロンプトキャッシュに乗った分（usage.prompt_tokens_details.cached_tokens）
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) if details is not None else None
+        if isinstance(cached_tokens, int):
+            CACHED_PROMPT_TOKENS.observe(cached_tokens, model)
+            CACHED_PROMPT_TOKENS_TOTAL.inc(cached_tokens, model)
+    if isinstance(completion_tokens, int):
+        COMPLETION_TOKENS.observe(completion_tokens, model)
+
+
+class StreamTimer:
+    """ストリーミング応答のTTFTと生成速度を計測する"""
+
+    def __init__(self, endpoint, start=None):
+        self.endpoint = endpoint
+        self.start = start if start is not None else time.perf_counter()
+        self.first_token_at = None
+        self.tokens = 0
+        self._tokens_at_first = 0
+
+    def token(self):
+        """クライアントへ送ったアップストリームのトークン1つ分"""
+        self.tokens += 1
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+            self._tokens_at_first = self.tokens
+            STREAM_TTFT_SECONDS.observe(self.first_token_at - self.start, self.endpoint)
+
+    def finish(self):
+        if self.first_token_at is None:
+            return
+        elapsed = time.perf_counter() - self.first_token_at
+        generated = self.tokens - self._tokens_at_first
+        if elapsed > 0 and generated > 0:
+            # 最初のトークンまではTTFTに含めたので、それ以降のトークン数で速度を出す
+            STREAM_TOKENS_PER_SECOND.observe(generated / elapsed, self.endpoint)
+
+
+class TimingMiddleware:
+    """ASGIミドルウェア: ルートのパステンプレート単位でリクエスト処理時間を記録する
+
+    BaseHTTPMiddlewareと違いレスポンスをバッファしないので、ストリーミングにも使える。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "<unmatched>"
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, scope["method"], path, status[0])
@@ -0,0 +1,325 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from ai_edu_api.ai_logic.metrics import MODEL_FALLBACKS, MODEL_HEDGES
+from ai_edu_api.ai_logic.upstream_scheduler import UpstreamUnavailable
+
+# --- モデルのルーティング（フォールバックとヘッジ） ---
+# クライアントが送ってくるmodelをそのまま上流に渡さず、モードごと（chat / quiz / stream）の
+# フォールバックリストに沿って呼び出す。
+#   - 先頭のモデルが失敗したら次のモデルで再試行する（フォールバック）
+#   - 期限内に応答（ストリーミングは最初のトークン）が無ければ、より速いモデルへ
+#     予備のリクエストを出し、先に成功した方を採用して負けた方はキャンセルする（ヘッジ）
+#   - 期限はモデル・モードごとの直近のレイテンシのパーセンタイルから決めるので、遅延が出れば自動で追従する
+#     （問題生成は会話より長くかかるので、会話のレイテンシで問題生成の期限を決めない）
+
+MODEL_ROUTES = {
+    "chat": os.environ.get("MODEL_ROUTES_CHAT", "gpt-4o,gpt-4o-mini"),
+    "quiz": os.environ.get("MODEL_ROUTES_QUIZ", "gpt-4o,gpt-4o-mini"),
+    "stream": os.environ.get("MODEL_ROUTES_STREAM", "gpt-4o,gpt-4o-mini"),
+}
+MODEL_HEDGE_ENABLED = os.environ.get("MODEL_HEDGE_ENABLED", "1") != "0"
+MODEL_HEDGE_PERCENTILE = float(os.environ.get("MODEL_HEDGE_PERCENTILE", "0.95"))
+MODEL_HEDGE_DEFAULT_DELAY = float(os.environ.get("MODEL_HEDGE_DEFAULT_DELAY", "3"))  # サンプルが少ない間の期限
+# モードごとのサンプルが少ない間の期限。問題生成は3秒を超えるのが普通なので、
+# 共通の既定値のままだとほぼ毎回ヘッジしてヘッジの予算を使い切ってしまう
+MODEL_HEDGE_DEFAULT_DELAYS = {
+    "chat": float(os.environ.get("MODEL_HEDGE_DEFAULT_DELAY_CHAT", str(MODEL_HEDGE_DEFAULT_DELAY))),
+    "quiz": float(os.environ.get("MODEL_HEDGE_DEFAULT_DELAY_QUIZ", "10")),
+    "stream": float(os.environ.get("MODEL_HEDGE_DEFAULT_DELAY_STREAM", str(MODEL_HEDGE_DEFAULT_DELAY))),
+}
+MODEL_HEDGE_MIN_DELAY = float(os.environ.get("MODEL_HEDGE_MIN_DELAY", "0.3"))
+MODEL_HEDGE_MAX_DELAY = float(os.environ.get("MODEL_HEDGE_MAX_DELAY", "15"))
+MODEL_HEDGE_MIN_SAMPLES = int(os.environ.get("MODEL_HEDGE_MIN_SAMPLES", "20"))
+# ヘッジで増えるリクエストの上限（全リクエストに対する割合）。障害時に上流への負荷を倍にしない
+MODEL_HEDGE_BUDGET = float(os.environ.get("MODEL_HEDGE_BUDGET", "0.1"))
+MODEL_LATENCY_WINDOW = int(os.environ.get("MODEL_LATENCY_WINDOW", "200"))
+
+logger = logging.getLogger(__name__)
+
+
+def parse_routes(text):
+    return [model.strip() for model in (text or "").split(",") if model.strip()]
+
+
+class LatencyTracker:
+    """モデル・種類（complete / ttft）・モードごとの直近のレイテンシ
+
+    mode を省略して読むと全モードをまとめた値になる（予備モデルの速さの比較などに使う）。
+    """
+
+    def __init__(self, window=MODEL_LATENCY_WINDOW):
+        self.window = window
+        self._samples = {}
+
+    def record(self, model, kind, seconds, mode=None):
+        samples = self._samples.get((model, kind, mode))
+        if samples is None:
+            samples = self._samples[(model, kind, mode)] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def _select(self, model, kind, mode=None):
+        if mode is not None:
+            return list(self._samples.get((model, kind, mode)) or ())
+        return [
+            value
+            for (m, k, _), samples in self._samples.items()
+            if m == model and k == kind
+            for value in samples
+        ]
+
+    def count(self, model, kind, mode=None):
+        return len(self._select(model, kind, mode))
+
+    def percentile(self, model, kind, q, mode=None):
+        samples = self._select(model, kind, mode)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def as_dict(self):
+        return {
+            ":".join(part for part in (model, kind, mode) if part): {
+                "count": len(samples),
+                "p50": round(self.percentile(model, kind, 0.5, mode), 4),
+                "p95": round(self.percentile(model, kind, 0.95, mode), 4),
+            }
+            for (model, kind, mode), samples in sorted(self._samples.items(), key=lambda item: tuple(map(str, item[0])))
+            if samples
+        }
+
+
+class ModelRouter:
+    def __init__(
+        self,
+        routes=None,
+        hedge_enabled=MODEL_HEDGE_ENABLED,
+        percentile=MODEL_HEDGE_PERCENTILE,
+        default_delay=MODEL_HEDGE_DEFAULT_DELAYS,
+        min_delay=MODEL_HEDGE_MIN_DELAY,
+        max_delay=MODEL_HEDGE_MAX_DELAY,
+        min_samples=MODEL_HEDGE_MIN_SAMPLES,
+        hedge_budget=MODEL_HEDGE_BUDGET,
+        tracker=None,
+    ):
+        routes = routes if routes is not None else MODEL_ROUTES
+        self.routes = {mode: parse_routes(models) if isinstance(models, str) else list(models) for mode, models in routes.items()}
+        self.hedge_enabled = hedge_enabled
+        self.percentile = percentile
+        # 数値ならすべてのモードに同じ期限を使う
+        if isinstance(default_delay, dict):
+            self.default_delays = dict(default_delay)
+            self.default_delay = self.default_delays.get("chat", MODEL_HEDGE_DEFAULT_DELAY)
+        else:
+            self.default_delays = {}
+            self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self.hedge_budget = hedge_budget
+        self.tracker = tracker or LatencyTracker()
+        self.stats = {"requests": 0, "hedges": 0, "hedge_wins": 0, "fallbacks": 0, "rejected_models": 0}
+
+    def resolve(self, mode, requested=None):
+        """モードのフォールバックリストを返す。要求されたモデルが許可されていれば先頭にする"""
+        models = self.routes.get(mode) or self.routes["chat"]
+        if not requested or requested == models[0]:
+            return list(models)
+        allowed = {model for route in self.routes.values() for model in route}
+        if requested not in allowed:
+            # 任意の文字列をそのまま上流に渡さない
+            self.stats["rejected_models"] += 1
+            logger.debug("未許可のモデル %s を %s に置き換えます", requested, models[0])
+            return list(models)
+        return [requested] + [model for model in models if model != requested]
+
+    def hedge_delay(self, model, kind, mode=None):
+        """予備のリクエストを出すまでの秒数（そのモードの直近のレイテンシのパーセンタイル）"""
+        if self.tracker.count(model, kind, mode) < self.min_samples:
+            return self.default_delays.get(mode, self.default_delay)
+        value = self.tracker.percentile(model, kind, self.percentile, mode)
+        return max(self.min_delay, min(self.max_delay, value))
+
+    def backup_model(self, models):
+        """予備に使うモデル: 2番目以降で直近の中央値が最も速いもの（データが無ければリスト順）"""
+        candidates = models[1:]
+        if not candidates:
+            return None
+
+        def speed(item):
+            index, model = item
+            median = self.tracker.percentile(model, "complete", 0.5)
+            return (median is None, median or 0.0, index)
+
+        return min(enumerate(candidates), key=speed)[1]
+
+    def _can_hedge(self, models):
+        if not self.hedge_enabled or len(models) < 2:
+            return False
+        # 予算: ヘッジ数がリクエスト数の一定割合（＋少しの余裕）を超えない
+        return self.stats["hedges"] < self.hedge_budget * self.stats["requests"] + 1
+
+    async def complete(self, upstream, mode, requested=None, **kwargs):
+        """フォールバックとヘッジ付きで upstream.complete を呼ぶ（レスポンスに使ったモデルは response.model）"""
+        models = self.resolve(mode, requested)
+        self.stats["requests"] += 1
+        error = None
+        for index, model in enumerate(models):
+            try:
+                if index == 0 and self._can_hedge(models):
+                    return await self._hedged_complete(upstream, mode, models, **kwargs)
+                return await self._timed_complete(upstream, mode, model, **kwargs)
+            except (asyncio.CancelledError, UpstreamUnavailable):
+                # 混雑・レート超過は別モデルで呼び直しても上流の負荷を増やすだけ
+                raise
+            except Exception as e:
+                error = e
+                if index + 1 < len(models):
+                    self.stats["fallbacks"] += 1
+                    MODEL_FALLBACKS.inc(1, mode, models[index + 1])
+                    logger.warning("%s が失敗したため %s にフォールバックします: %s", model, models[index + 1], e)
+        raise error
+
+    async def _timed_complete(self, upstream, mode, model, **kwargs):
+        started = time.perf_counter()
+        response = await upstream.complete(model=model, **kwargs)
+        self.tracker.record(model, "complete", time.perf_counter() - started, mode)
+        return response
+
+    async def _hedged_complete(self, upstream, mode, models, **kwargs):
+        primary = models[0]
+        started = time.perf_counter()
+        first = asyncio.ensure_future(self._timed_complete(upstream, mode, primary, **kwargs))
+        try:
+            done, _ = await asyncio.wait({first}, timeout=self.hedge_delay(primary, "complete", mode))
+        except asyncio.CancelledError:
+            first.cancel()
+            raise
+        if done:
+            return first.result()
+        backup = self.backup_model(models)
+        self._hedge_fired(mode)
+        second = asyncio.ensure_future(self._timed_complete(upstream, mode, backup, **kwargs))
+        return await self._first_success(mode, first, second, primary, started)
+
+    async def _first_success(self, mode, first, second, primary, started, kind="complete", discard=None):
+        """先に成功した方を返し、もう一方はキャンセルする（片方が失敗したらもう一方を待つ）
+
+        discard(result) は負けた側が成功していた場合の後始末（ストリームを閉じるなど）。
+        """
+        pending = {first, second}
+        winner = None
+        error = None
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task
+        finally:
+            if first in pending:
+                # 負けた先頭モデルの経過時間は下限値として記録し、期限が短くなりすぎないようにする
+                self.tracker.record(primary, kind, time.perf_counter() - started, mode)
+            losers = [task for task in (first, second) if task is not winner]
+            for task in losers:
+                task.cancel()
+            results = await asyncio.gather(*losers, return_exceptions=True)
+            if discard is not None:
+                for result in results:
+                    if not isinstance(result, BaseException):
+                        await discard(result)
+        if winner is None:
+            raise error
+        if winner is second:
+            self._hedge_won(mode)
+        return winner.result()
+
+    async def stream_tokens(self, upstream, mode, requested=None, **kwargs):
+        """フォールバックとヘッジ付きの upstream.stream_tokens。期限は最初のトークンまでの時間"""
+        models = self.resolve(mode, requested)
+        self.stats["requests"] += 1
+        stream, first_token = await self._open_stream(upstream, mode, models, **kwargs)
+        try:
+            if first_token is None:
+                return
+            yield first_token
+            async for token in stream:
+                yield token
+        finally:
+            await stream.aclose()
+
+    async def _open_stream(self, upstream, mode, models, **kwargs):
+        """最初のトークンが届いたストリームと、そのトークンを返す"""
+        error = None
+        for index, model in enumerate(models):
+            try:
+                if index == 0 and self._can_hedge(models):
+                    return await self._hedged_first_token(upstream, mode, models, **kwargs)
+                return await self._first_token(upstream, mode, model, **kwargs)
+            except (asyncio.CancelledError, UpstreamUnavailable):
+                raise
+            except Exception as e:
+                error = e
+                if index + 1 < len(models):
+                    self.stats["fallbacks"] += 1
+                    MODEL_FALLBACKS.inc(1, mode, models[index + 1])
+                    logger.warning("%s のストリーミングが失敗したため %s にフォールバックします: %s", model, models[index + 1], e)
+        raise error
+
+    async def _first_token(self, upstream, mode, model, **kwargs):
+        started = time.perf_counter()
+        stream = upstream.stream_tokens(model=model, **kwargs)
+        try:
+            token = await stream.__anext__()
+        except StopAsyncIteration:
+            token = None
+        except BaseException:
+            await stream.aclose()
+            raise
+        self.tracker.record(model, "ttft", time.perf_counter() - started, mode)
+        return stream, token
+
+    async def _hedged_first_token(self, upstream, mode, models, **kwargs):
+        primary = models[0]
+        started = time.perf_counter()
+        first = asyncio.ensure_future(self._first_token(upstream, mode, primary, **kwargs))
+        try:
+            done, _ = await asyncio.wait({first}, timeout=self.hedge_delay(primary, "ttft", mode))
+        except asyncio.CancelledError:
+            first.cancel()
+            raise
+        if done:
+            return first.result()
+        backup = self.backup_model(models)
+        self._hedge_fired(mode)
+        second = asyncio.ensure_future(self._first_token(upstream, mode, backup, **kwargs))
+        return await self._first_success(
+            mode, first, second, primary, started, kind="ttft", discard=lambda result: result[0].aclose()
+        )
+
+    def _hedge_fired(self, mode):
+        self.stats["hedges"] += 1
+        MODEL_HEDGES.inc(1, mode, "fired")
+
+    def _hedge_won(self, mode):
+        self.stats["hedge_wins"] += 1
+        MODEL_HEDGES.inc(1, mode, "won")
+
+    def as_dict(self):
+        hedges = self.stats["hedges"]
+        return {
+            "routes": self.routes,
+            "stats": dict(self.stats),
+            "hedge_rate": round(hedges / self.stats["requests"], 4) if self.stats["requests"] else 0.0,
+            "hedge_win_rate": round(self.stats["hedge_wins"] / hedges, 4) if hedges else 0.0,
+            "latency": self.tracker.as_dict(),
+        }
+
+
+model_router = ModelRouter()
@@ -0,0 +1,114 @@
+# --- プロンプトテンプレート（上流のプロンプトキャッシュに乗せるための並び順） ---
+# OpenAIの自動プロンプトキャッシュは「先頭からバイト単位で一致する部分」にしか効かない。
+# そこでシステムプロンプトは必ず
+#   静的な指示（モジュール読み込み時に1回だけ組み立て）
+#   → 準静的な出題設定（難易度・タグ等。同じ設定なら同じ文字列）
+#   → ユーザーごとの情報（プロファイル）
+#   → 会話（要約）
+# の順に並べ、ユーザーや会話が違っても長い静的部分が共通の接頭辞になるようにする。
+
+SECTION_SEPARATOR = "\n\n"
+
+
+def normalize_tags(tags):
+    """タグの順序・重複・前後の空白で文字列が変わらないように正規化する（キャッシュキーと同じ規則）"""
+    return sorted({str(tag).strip() for tag in (tags or []) if str(tag).strip()})
+
+
+class PromptTemplate:
+    """静的ブロックを事前に確定させ、残りの区間を決まった順に連結するテンプレート"""
+
+    def __init__(self, static_text):
+        self.static_text = static_text.strip("\n")
+
+    def render(self, settings=None, user=None, conversation=None):
+        sections = [self.static_text]
+        for section in (settings, user, conversation):
+            if section:
+                sections.append(section.strip("\n"))
+        return SECTION_SEPARATOR.join(sections)
+
+    def message(self, settings=None, user=None, conversation=None):
+        return {"role": "system", "content": self.render(settings, user, conversation)}
+
+
+def quiz_settings_block(quiz_type, level, tags, layout, count, default_tags="一般的な文法・語彙"):
+    tags_text = ", ".join(normalize_tags(tags)) or default_tags
+    return (
+        "【今回の出題条件】\n"
+        f"- 問題数: {int(count)}問\n"
+        f"- 出題タイプ: {str(quiz_type).strip()}\n"
+        f"- 難易度: {str(level).strip()}\n"
+        f"- 出題範囲: {tags_text}\n"
+        f"- レイアウトテンプレート: {str(layout).strip()}\n"
+        f"上記の条件で **{int(count)}問** の問題を出題してください。"
+    )
+
+
+def profile_block(user_profile):
+    if not user_profile:
+        return ""
+    return (
+        "【ユーザー情報】\n"
+        f"このユーザーは「{user_profile.get('性格', '未知')}」な性格で、"
+        f"「{user_profile.get('傾向', '不明')}」な傾向があります。"
+    )
+
+
+def conversation_block(summary):
+    if not summary:
+        return ""
+    return f"以下はこれまでの会話の文脈です:\n{summary}\nこれを踏まえて、以下の質問に答えてください。"
+
+
+# 問題生成（main.py の /chat・/quiz/stream）
+QUIZ_TEMPLATE = PromptTemplate(
+    "あなたは教育AIです。指定された条件で問題を出題してください。\n\n"
+    "【出題ルール】\n"
+    "1. 各問題には文脈・応用・誤答誘導を含めること。\n"
+    "2. 出力形式は以下のJSON配列として返すこと：\n"
+    "[\n"
+    "  {\n"
+    "    \"type\": \"multiple_choice\",\n"
+    "    \"layout\": \"quiz_card_v1\",\n"
+    "    \"title\": \"前置詞の使い分け\",\n"
+    "    \"question\": \"...\",\n"
+    "    \"options\": [\"...\", \"...\", \"...\", \"...\"],\n"
+    "    \"answer\": \"...\",\n"
+    "    \"explanation\": \"...\",\n"
+    "    \"difficulty\": \"英検2級\",\n"
+    "    \"tags\": [\"to不定詞\", \"前置詞\"]\n"
+    "  }, ...\n"
+    "]"
+)
+
+# 通常会話（main.py の /chat と chat_endpoint_logic で共通）。
+# 感情ラベルはローカルの ai_logic/emotion_labeler.py で付けるので、返答の本文だけをプレーンテキストで返させる
+CHAT_TEMPLATE = PromptTemplate(
+    "あなたは教育AIアシスタントです。ユーザーの質問や発言に、学習者に寄り添ってわかりやすく答えてください。"
+    "返答は本文だけをプレーンテキストで返してください（JSONや前置きは不要です）。"
+)
+CHAT_SYSTEM_PROMPT = CHAT_TEMPLATE.message()
+
+# 汎用問題生成（ai_logic/generate_problem_prompt.py）
+GENERAL_QUIZ_TEMPLATE = PromptTemplate(
+    "あなたはあらゆる分野の出題に対応できる汎用問題生成AIです。\n"
+    "受験・学習・知的探究に役立つ高品質な問題を作成してください。\n\n"
+    "【出題ガイドライン】\n"
+    "1. 暗記ではなく、考えることで理解が深まるよう設計してください。\n"
+    "2. 文脈・例・ひっかけ・誤答誘導を意識した設問構成にしてください。\n"
+    "3. 正答だけでなく、なぜ他の選択肢が誤りなのかも解説に必ず含めてください。\n"
+    "4. 各問題は以下のJSON構造で返答してください。\n\n"
+    "[{\n"
+    "  \"type\": \"multiple_choice\",\n"
+    "  \"layout\": \"quiz_card_v1\",\n"
+    "  \"title\": \"タイトル\",\n"
+    "  \"question\": \"問題文\",\n"
+    "  \"options\": [\"選択肢1\", \"選択肢2\", \"選択肢3\", \"選択肢4\"],\n"
+    "  \"answer\": \"正解の選択肢\",\n"
+    "  \"explanation\": \"各選択肢の違いや誤答理由を含む詳しい解説\",\n"
+    "  \"difficulty\": \"出題設定の難易度\",\n"
+    "  \"tags\": [\"タグ1\", \"タグ2\"]\n"
+    "}]\n\n"
+    "上記の形式に完全準拠し、出題設定の問題数分のJSON配列を返してください。"
+)
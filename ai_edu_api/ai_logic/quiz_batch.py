@@ -0,0 +1,167 @@
+import asyncio
+import json
+import logging
+import os
+
+from ai_edu_api.ai_logic.upstream_scheduler import UpstreamUnavailable
+
+# --- 複数問の問題生成を並列化・ストリーミングする ---
+# countが大きいと1回の補完で巨大なJSON配列を待つことになるため、小さな単位に分割して
+# 並列に生成し、ストリーミング中のJSONから完成した問題を1問ずつ取り出して返す。
+
+QUIZ_BATCH_SIZE = int(os.environ.get("QUIZ_BATCH_SIZE", "2"))  # 1リクエストあたりの問題数
+QUIZ_BATCH_CONCURRENCY = int(os.environ.get("QUIZ_BATCH_CONCURRENCY", "5"))
+QUIZ_BATCH_MAX_RETRIES = int(os.environ.get("QUIZ_BATCH_MAX_RETRIES", "2"))
+
+logger = logging.getLogger(__name__)
+
+
+class IncrementalJSONArrayParser:
+    """ストリーミング中のテキストから、配列の要素になっているオブジェクトを完成しだい取り出す。
+
+    ```json のような前後の余計なテキストや {"problems": [...]} のような外側の
+    オブジェクトは読み飛ばす。壊れた要素は errors に数えて捨てる。
+    """
+
+    def __init__(self):
+        self._stack = []  # 開いているコンテナ（'[' または '{'）
+        self._in_string = False
+        self._escape = False
+        self._capture = None  # 取り出し中の要素のテキスト
+        self._capture_depth = 0
+        self.errors = 0
+
+    def feed(self, text):
+        completed = []
+        for char in text:
+            if self._capture is not None:
+                self._capture.append(char)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if char == '"':
+                if self._stack:
+                    self._in_string = True
+            elif char in "[{":
+                if char == "{" and self._capture is None and self._stack and self._stack[-1] == "[":
+                    self._capture = [char]
+                    self._capture_depth = len(self._stack)
+                self._stack.append(char)
+            elif char in "]}":
+                if not self._stack:
+                    continue
+                self._stack.pop()
+                if self._capture is not None and len(self._stack) == self._capture_depth:
+                    raw = "".join(self._capture)
+                    self._capture = None
+                    try:
+                        completed.append(json.loads(raw))
+                    except ValueError:
+                        self.errors += 1
+        return completed
+
+
+def validate_problem(problem):
+    """問題として最低限の形（問題文・正解、選択肢があれば正解を含む）になっているか"""
+    if not isinstance(problem, dict):
+        return False
+    if not str(problem.get("question") or "").strip() or not str(problem.get("answer") or "").strip():
+        return False
+    options = problem.get("options")
+    if options is not None:
+        if not isinstance(options, list) or len(options) < 2 or problem["answer"] not in options:
+            return False
+    return True
+
+
+def split_counts(count, per_request=QUIZ_BATCH_SIZE):
+    """countをper_request問ずつのサブリクエストに分割する（例: 5, 2 -> [2, 2, 1]）"""
+    per_request = max(1, per_request)
+    return [min(per_request, count - start) for start in range(0, count, per_request)]
+
+
+async def generate_quiz_batch(
+    upstream,
+    build_prompt,
+    count,
+    messages=None,
+    model="gpt-4o",
+    per_request=QUIZ_BATCH_SIZE,
+    concurrency=QUIZ_BATCH_CONCURRENCY,
+    max_retries=QUIZ_BATCH_MAX_RETRIES,
+    sleep=asyncio.sleep,
+):
+    """問題を並列に生成し、検証済みの問題をできた順にイベントとして返す非同期ジェネレータ。
+
+    build_prompt(n) はn問分のシステムプロンプトを返す関数。イベントは
+    {"type": "problem", "index": i, "problem": {...}} と、最後の
+    {"type": "done", "count": 生成数, "failed": 不足数} の2種類。
+    """
+    queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    messages = list(messages or [])
+
+    async def produce(wanted):
+        delivered = 0
+        attempt = 0
+        # 足りなかった分だけを再生成する
+        while delivered < wanted and attempt <= max_retries:
+            attempt += 1
+            missing = wanted - delivered
+            parser = IncrementalJSONArrayParser()
+            try:
+                async with semaphore:
+                    async for delta in upstream.stream_tokens(
+                        model=model,
+                        messages=[build_prompt(missing)] + messages,
+                    ):
+                        for problem in parser.feed(delta):
+                            if delivered < wanted and validate_problem(problem):
+                                delivered += 1
+                                await queue.put(problem)
+            except asyncio.CancelledError:
+                raise
+            except UpstreamUnavailable as e:
+                # 混雑・レート超過で断られた場合は、すぐに再試行せず Retry-After だけ待つ（枠は手放して待つ）
+                logger.warning("問題生成が受け付けられませんでした（%d回目）: %s", attempt, e)
+                if attempt <= max_retries:
+                    await sleep(e.retry_after)
+            except Exception as e:
+                logger.warning("問題生成に失敗しました（%d回目）: %s", attempt, e)
+        return wanted - delivered
+
+    async def run_all():
+        try:
+            results = await asyncio.gather(*[produce(n) for n in split_counts(count, per_request)])
+            return sum(results)
+        finally:
+            await queue.put(None)
+
+    runner = asyncio.ensure_future(run_all())
+    index = 0
+    try:
+        while True:
+            problem = await queue.get()
+            if problem is None:
+                break
+            yield {"type": "problem", "index": index, "problem": problem}
+            index += 1
+        failed = await runner
+        yield {"type": "done", "count": index, "failed": failed}
+    finally:
+        # クライアント切断などで途中終了した場合は残りの生成を止める
+        if not runner.done():
+            runner.cancel()
+
+
+def format_event(event, stream_format="sse"):
+    """イベントをSSEまたはNDJSONの1行に整形する"""
+    payload = json.dumps(event, ensure_ascii=False)
+    if stream_format == "ndjson":
+        return payload + "\n"
+    return f"data: {payload}\n\n"
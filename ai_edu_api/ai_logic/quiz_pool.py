@@ -0,0 +1,314 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+
+from ai_edu_api.ai_logic.metrics import QUIZ_POOL_REQUESTS, QUIZ_POOL_PROBLEMS
+from ai_edu_api.ai_logic.prompt_templates import normalize_tags
+from ai_edu_api.ai_logic.quiz_batch import generate_quiz_batch, validate_problem
+from ai_edu_api.ai_logic.upstream_scheduler import PRIORITY_BACKGROUND, upstream_priority
+
+# --- 事前生成した問題のプール ---
+# 問題生成の意図（「問題を作って」等）のたびに同期で生成すると数秒待たせるため、
+# 出題条件 (model, level, quiz_type, tags, layout) ごとに検証済みの問題をストックしておき、
+# リクエストにはストックから即座に返す。補充はバックグラウンドのタスクが需要の多い条件から行う。
+#   - ストックが低水位（LOW）を下回ったら高水位（HIGH）まで補充する
+#   - 条件ごとのメモリ上限（バイト数）と、条件数の上限（需要の少ない条件から捨てる）
+#   - ほぼ同じ問題（問題文の文字3-gramのJaccard係数が閾値以上）は重複として捨てる
+# プールの問題はユーザーに依存しない（プロファイルはプロンプトに含めずに生成する）。
+# 生徒の発言に出題キーワード以外の話題（「関係代名詞の」等）があればプールは使わない。
+
+QUIZ_POOL_ENABLED = os.environ.get("QUIZ_POOL_ENABLED", "1") != "0"
+# 起動時に既定の出題条件の需要を入れて補充を始めるか（既定はオフ。スリープ復帰のたびにトークンを使わない）
+QUIZ_POOL_SEED = os.environ.get("QUIZ_POOL_SEED", "0") == "1"
+QUIZ_POOL_LOW_WATERMARK = int(os.environ.get("QUIZ_POOL_LOW_WATERMARK", "3"))
+QUIZ_POOL_HIGH_WATERMARK = int(os.environ.get("QUIZ_POOL_HIGH_WATERMARK", "10"))
+QUIZ_POOL_MAX_BUCKETS = int(os.environ.get("QUIZ_POOL_MAX_BUCKETS", "32"))
+QUIZ_POOL_MAX_BUCKET_BYTES = int(os.environ.get("QUIZ_POOL_MAX_BUCKET_BYTES", str(256 * 1024)))
+QUIZ_POOL_DEDUP_THRESHOLD = float(os.environ.get("QUIZ_POOL_DEDUP_THRESHOLD", "0.85"))
+# 需要の半減期（秒）。しばらく使われない条件は補充対象から外れ、APIの無駄な消費を防ぐ
+QUIZ_POOL_DEMAND_HALF_LIFE = float(os.environ.get("QUIZ_POOL_DEMAND_HALF_LIFE", "3600"))
+QUIZ_POOL_MIN_DEMAND = float(os.environ.get("QUIZ_POOL_MIN_DEMAND", "0.5"))
+QUIZ_POOL_REFILL_BATCH = int(os.environ.get("QUIZ_POOL_REFILL_BATCH", "4"))  # 1回の補充で生成する問題数
+QUIZ_POOL_REFILL_INTERVAL = float(os.environ.get("QUIZ_POOL_REFILL_INTERVAL", "30"))  # 補充対象の再確認間隔
+QUIZ_POOL_SERVED_HISTORY = 64  # 重複判定に使う、提供済みの問題の件数（条件ごと）
+
+logger = logging.getLogger(__name__)
+
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+def pool_key(model, quiz_type, level, tags, layout):
+    """出題条件を正規化したキー（タグの順序・重複・空白に依存しない）"""
+    return (str(model), str(quiz_type).strip(), str(level).strip(), tuple(normalize_tags(tags)), str(layout).strip())
+
+
+def question_shingles(problem, size=3):
+    """問題文を正規化（NFKC・小文字・記号と空白を除去）した文字n-gramの集合"""
+    text = unicodedata.normalize("NFKC", str(problem.get("question") or "")).lower()
+    text = _NON_WORD.sub("", text)
+    if len(text) <= size:
+        return frozenset([text])
+    return frozenset(text[i:i + size] for i in range(len(text) - size + 1))
+
+
+def similarity(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class _Bucket:
+    __slots__ = ("key", "problems", "size", "demand", "demand_at", "recent")
+
+    def __init__(self, key, now):
+        self.key = key
+        self.problems = deque()  # (問題, 3-gram集合, バイト数)
+        self.size = 0
+        self.demand = 0.0
+        self.demand_at = now
+        self.recent = deque(maxlen=QUIZ_POOL_SERVED_HISTORY)  # 提供済みの問題の3-gram集合
+
+
+class QuizPool:
+    def __init__(
+        self,
+        low_watermark=QUIZ_POOL_LOW_WATERMARK,
+        high_watermark=QUIZ_POOL_HIGH_WATERMARK,
+        max_buckets=QUIZ_POOL_MAX_BUCKETS,
+        max_bucket_bytes=QUIZ_POOL_MAX_BUCKET_BYTES,
+        dedup_threshold=QUIZ_POOL_DEDUP_THRESHOLD,
+        demand_half_life=QUIZ_POOL_DEMAND_HALF_LIFE,
+        min_demand=QUIZ_POOL_MIN_DEMAND,
+        clock=time.monotonic,
+    ):
+        self.low_watermark = low_watermark
+        self.high_watermark = max(high_watermark, low_watermark)
+        self.max_buckets = max_buckets
+        self.max_bucket_bytes = max_bucket_bytes
+        self.dedup_threshold = dedup_threshold
+        self.demand_half_life = demand_half_life
+        self.min_demand = min_demand
+        self.clock = clock
+        self.on_refill_needed = None  # ストックが低水位を下回ったときに呼ぶ関数（補充タスクが設定）
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            "hits": 0, "misses": 0, "served": 0, "added": 0,
+            "duplicates": 0, "invalid": 0, "overflow": 0, "evicted_buckets": 0,
+        }
+
+    def take(self, key, count=1):
+        """ストックからcount問を取り出す。足りなければNone（部分的には取り出さない）"""
+        with self._lock:
+            bucket = self._bucket(key)
+            self._add_demand(bucket, 1.0)
+            if len(bucket.problems) < count:
+                self.stats["misses"] += 1
+                problems = None
+            else:
+                problems = []
+                for _ in range(count):
+                    problem, shingles, size = bucket.problems.popleft()
+                    bucket.size -= size
+                    bucket.recent.append(shingles)
+                    problems.append(problem)
+                self.stats["hits"] += 1
+                self.stats["served"] += count
+            low = len(bucket.problems) < self.low_watermark
+        QUIZ_POOL_REQUESTS.inc(1, "hit" if problems is not None else "miss")
+        if low and self.on_refill_needed is not None:
+            self.on_refill_needed()
+        return problems
+
+    def add(self, key, problem):
+        """生成した問題をストックに加える。加えたらTrue（不正・重複・上限超過はFalse）"""
+        if not validate_problem(problem):
+            return self._reject("invalid")
+        shingles = question_shingles(problem)
+        size = len(json.dumps(problem, ensure_ascii=False).encode("utf-8"))
+        with self._lock:
+            bucket = self._bucket(key)
+            if len(bucket.problems) >= self.high_watermark or bucket.size + size > self.max_bucket_bytes:
+                self.stats["overflow"] += 1
+                return False
+            for other in list(bucket.recent) + [item[1] for item in bucket.problems]:
+                if similarity(shingles, other) >= self.dedup_threshold:
+                    self.stats["duplicates"] += 1
+                    return False
+            bucket.problems.append((problem, shingles, size))
+            bucket.size += size
+            self.stats["added"] += 1
+        QUIZ_POOL_PROBLEMS.inc(1, "added")
+        return True
+
+    def seed(self, key, demand=1.0):
+        """需要を先に登録しておき、最初のリクエストより前に補充させる"""
+        with self._lock:
+            self._add_demand(self._bucket(key), demand)
+
+    def next_refill(self):
+        """補充すべき条件のキーと不足数を返す（需要 × 不足数が最大のもの）。無ければNone"""
+        best = None
+        with self._lock:
+            now = self.clock()
+            for bucket in self._buckets.values():
+                demand = self._decayed(bucket, now)
+                if demand < self.min_demand or len(bucket.problems) >= self.low_watermark:
+                    continue
+                if bucket.size >= self.max_bucket_bytes:
+                    continue
+                deficit = self.high_watermark - len(bucket.problems)
+                if best is None or demand * deficit > best[0]:
+                    best = (demand * deficit, bucket.key, deficit)
+        return None if best is None else (best[1], best[2])
+
+    def stock(self, key=None):
+        with self._lock:
+            if key is not None:
+                bucket = self._buckets.get(key)
+                return len(bucket.problems) if bucket else 0
+            return sum(len(bucket.problems) for bucket in self._buckets.values())
+
+    @property
+    def hit_rate(self):
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+    def as_dict(self):
+        with self._lock:
+            now = self.clock()
+            buckets = [
+                {
+                    "model": bucket.key[0], "quiz_type": bucket.key[1], "level": bucket.key[2],
+                    "tags": list(bucket.key[3]), "layout": bucket.key[4],
+                    "stock": len(bucket.problems), "bytes": bucket.size,
+                    "demand": round(self._decayed(bucket, now), 3),
+                }
+                for bucket in self._buckets.values()
+            ]
+        return {"stats": dict(self.stats), "hit_rate": round(self.hit_rate, 4), "buckets": buckets}
+
+    def _reject(self, reason):
+        with self._lock:
+            self.stats[reason] += 1
+        return False
+
+    def _bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket(key, self.clock())
+            self._evict()
+        return bucket
+
+    def _evict(self):
+        # 条件数が上限を超えたら、需要の最も少ない条件をストックごと捨てる
+        while len(self._buckets) > self.max_buckets:
+            now = self.clock()
+            victim = min(list(self._buckets.values())[:-1], key=lambda b: self._decayed(b, now))
+            del self._buckets[victim.key]
+            self.stats["evicted_buckets"] += 1
+
+    def _decayed(self, bucket, now):
+        if self.demand_half_life <= 0:
+            return bucket.demand
+        return bucket.demand * 0.5 ** ((now - bucket.demand_at) / self.demand_half_life)
+
+    def _add_demand(self, bucket, amount):
+        now = self.clock()
+        bucket.demand = self._decayed(bucket, now) + amount
+        bucket.demand_at = now
+
+
+class QuizPoolRefiller:
+    """プールの補充を行うバックグラウンドタスク。
+
+    build_prompt(key, n) はn問分のシステムプロンプトを返す関数。ライブのリクエストを
+    圧迫しないよう、補充は1条件ずつ・同時実行1で行う。
+    """
+
+    def __init__(
+        self,
+        pool,
+        get_upstream,
+        build_prompt,
+        batch_size=QUIZ_POOL_REFILL_BATCH,
+        interval=QUIZ_POOL_REFILL_INTERVAL,
+    ):
+        self.pool = pool
+        self.get_upstream = get_upstream
+        self.build_prompt = build_prompt
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self._task = None
+        self._wakeup = None
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self.pool.on_refill_needed = self._wakeup.set
+        self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def stop(self):
+        self.pool.on_refill_needed = None
+        task, self._task = self._task, None
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def refill_once(self):
+        """最も補充が必要な条件を1回分補充し、追加した問題数を返す（対象が無ければNone）"""
+        target = self.pool.next_refill()
+        if target is None:
+            return None
+        key, deficit = target
+        wanted = min(self.batch_size, deficit)
+        added = 0
+        async for event in generate_quiz_batch(
+            self.get_upstream(),
+            lambda n: self.build_prompt(key, n),
+            wanted,
+            model=key[0],
+            concurrency=1,
+            max_retries=0,
+        ):
+            if event["type"] == "problem" and self.pool.add(key, event["problem"]):
+                added += 1
+        logger.debug("問題プールを補充しました: %s %d/%d問", key, added, wanted)
+        return added
+
+    async def _run(self):
+        # 補充はライブのリクエストより後回し（同時実行枠が空いたときだけ）
+        upstream_priority.set(PRIORITY_BACKGROUND)
+        failures = 0
+        while True:
+            self._wakeup.clear()
+            try:
+                added = await self.refill_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("問題プールの補充に失敗しました: %s", e)
+                added = 0
+            if added:
+                failures = 0
+            elif added == 0:
+                # 1問も追加できなかった（アップストリームの障害・重複ばかり）ときは間隔を延ばして再試行
+                failures += 1
+                await asyncio.sleep(self.interval * (2 ** min(failures - 1, 5)))
+            else:
+                # 補充対象が無い間は、ストックが減るか一定時間たつまで待つ
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+
+quiz_pool = QuizPool()
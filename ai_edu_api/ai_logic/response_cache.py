@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from ai_edu_api.ai_logic.metrics import RESPONSE_CACHE_HITS, RESPONSE_CACHE_MISSES
+from ai_edu_api.supabase_logic.profile_store import EMOTION_INDEX
+
+# --- 問題生成レスポンスのキャッシュ（プロセス内LRU + 任意のディスク層） ---
+# 同じ出題条件（quiz_type, level, tags, layout, count, 依頼の話題）の問題生成は生徒間で頻繁に重なるため、
+# 正規化したパラメータをキーに補完結果を再利用する。
+
+QUIZ_CACHE_TTL = float(os.environ.get("QUIZ_CACHE_TTL", "3600"))
+QUIZ_CACHE_MAX_ENTRIES = int(os.environ.get("QUIZ_CACHE_MAX_ENTRIES", "512"))
+QUIZ_CACHE_MAX_BYTES = int(os.environ.get("QUIZ_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+QUIZ_CACHE_VARIANTS = int(os.environ.get("QUIZ_CACHE_VARIANTS", "3"))
+QUIZ_CACHE_PATH = os.environ.get("QUIZ_CACHE_PATH")  # 未設定ならディスク層なし
+
+# バケットに使うラベル（ProfileRecord.to_profile が出す値）。これ以外の自由記述は「その他」に丸める
+PERSONALITY_LABELS = ("おおらか", "繊細", "好奇心旺盛")
+MOOD_LABELS = ("ポジティブ多め", "ネガティブ多め", "感情穏やか")
+
+
+def profile_bucket(user_profile):
+    """プロファイルを生の値ではなく粗いバケットに丸める（キーの爆発を防ぐ）
+
+    性格・傾向は自由記述も入り得るので、既知のラベル以外は「その他」にする。
+    傾向は「夜型・返信早い・ポジティブ多め」のような組み合わせのうち、出題に効く感情の傾き
+    だけを使う（活動時間帯や返信速度まで含めると同じ問題を共有できる生徒がほとんど居なくなる）。
+    """
+    if not user_profile:
+        return "default"
+    personality = str(user_profile.get("性格") or "").strip()
+    if personality not in PERSONALITY_LABELS:
+        personality = "その他"
+    segments = {s.strip() for s in str(user_profile.get("傾向") or "").split("・")}
+    mood = next((label for label in MOOD_LABELS if label in segments), "その他")
+    emotions = [e for e in user_profile.get("感情履歴") or [] if e in EMOTION_INDEX]
+    dominant = Counter(emotions).most_common(1)[0][0] if emotions else "なし"
+    return "|".join([personality, mood, dominant])
+
+
+def quiz_cache_key(
+    user_profile=None,
+    quiz_type="multiple_choice",
+    level="中級",
+    tags=None,
+    layout="quiz_card_v1",
+    count=1,
+    model="gpt-4o",
+    topic=""
+):
+    """generate_problem_promptの引数と、生徒の依頼にある話題から正規化したキャッシュキーを作る"""
+    normalized = {
+        "model": model,
+        "quiz_type": str(quiz_type).strip(),
+        "level": str(level).strip(),
+        "tags": sorted({str(tag).strip() for tag in (tags or []) if str(tag).strip()}),
+        "layout": str(layout).strip(),
+        "count": int(count),
+        "profile": profile_bucket(user_profile),
+        "topic": " ".join(str(topic or "").split()),
+    }
+    raw = json.dumps(normalized, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class _CacheEntry:
+    __slots__ = ("variants", "created_at", "cursor", "size")
+
+    def __init__(self, variants, created_at):
+        self.variants = list(variants)
+        self.created_at = created_at
+        self.cursor = 0
+        self.size = sum(len(v.encode("utf-8")) for v in self.variants)
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        max_entries=QUIZ_CACHE_MAX_ENTRIES,
+        max_bytes=QUIZ_CACHE_MAX_BYTES,
+        ttl=QUIZ_CACHE_TTL,
+        variants=QUIZ_CACHE_VARIANTS,
+        disk_path=QUIZ_CACHE_PATH,
+        clock=time.time,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.variants = max(1, variants)
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk = None
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, variants TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._disk.commit()
+        self.stats = {"hits": 0, "misses": 0, "disk_hits": 0, "evictions": 0, "expired": 0}
+
+    def get(self, key):
+        """キャッシュ済みのバリエーションを1つ返す。
+
+        バリエーションがまだN個揃っていない間は None を返し、呼び出し側に新しい
+        問題を生成させる（全員が同じ問題を受け取らないようにするため）。
+        """
+        with self._lock:
+            tier = "memory"
+            entry = self._entries.get(key)
+            if entry is None and self._disk is not None:
+                tier = "disk"
+                entry = self._load_from_disk(key)
+            if entry is not None and self._expired(entry):
+                self._remove(key)
+                self._delete_from_disk(key)
+                self.stats["expired"] += 1
+                entry = None
+            if entry is not None and tier == "disk":
+                self.stats["disk_hits"] += 1
+            if entry is None or len(entry.variants) < self.variants:
+                self.stats["misses"] += 1
+                RESPONSE_CACHE_MISSES.inc(1, tier)
+                return None
+            self._entries.move_to_end(key)
+            value = entry.variants[entry.cursor % len(entry.variants)]
+            entry.cursor += 1
+            self.stats["hits"] += 1
+            RESPONSE_CACHE_HITS.inc(1, tier)
+            return value
+
+    def put(self, key, value):
+        """生成結果をバリエーションとして追加する（同一内容は重複させない）
+
+        メモリに無いキーはディスク層から読み戻してから追記する。先に get() を呼んでいなくても、
+        再起動前に貯めたバリエーションを空のエントリで上書きしない。
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._load_from_disk(key)
+            if entry is None or self._expired(entry):
+                self._remove(key)
+                entry = _CacheEntry([], self.clock())
+                self._entries[key] = entry
+            if value in entry.variants or len(entry.variants) >= self.variants:
+                return
+            entry.variants.append(value)
+            added = len(value.encode("utf-8"))
+            entry.size += added
+            self._bytes += added
+            self._entries.move_to_end(key)
+            self._evict()
+            self._save_to_disk(key, entry)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+    def _expired(self, entry):
+        return self.clock() - entry.created_at > self.ttl
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _evict(self):
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+        ):
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self.stats["evictions"] += 1
+
+    def _load_from_disk(self, key):
+        if self._disk is None:
+            return None
+        row = self._disk.execute(
+            "SELECT variants, created_at FROM response_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        entry = _CacheEntry(json.loads(row[0]), row[1])
+        self._entries[key] = entry
+        self._bytes += entry.size
+        self._evict()
+        return entry
+
+    def _save_to_disk(self, key, entry):
+        if self._disk is None:
+            return
+        self._disk.execute(
+            "INSERT OR REPLACE INTO response_cache (key, variants, created_at) VALUES (?, ?, ?)",
+            (key, json.dumps(entry.variants, ensure_ascii=False), entry.created_at),
+        )
+        self._disk.commit()
+
+    def _delete_from_disk(self, key):
+        if self._disk is None:
+            return
+        self._disk.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+        self._disk.commit()
+
+
+quiz_cache = ResponseCache()
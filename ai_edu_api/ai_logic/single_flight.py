@@ -0,0 +1,87 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+from ai_edu_api.ai_logic.metrics import UPSTREAM_COALESCED
+
+# --- 同一リクエストのシングルフライト（合流）---
+# 授業中は同じ出題条件（= 同じシステムプロンプト）のリクエストが一斉に届くため、
+# (model, messages, response_format) が同じ補完は実行中の1回に相乗りさせ、結果を共有する。
+# 待っている全員が離れた（切断・ヘッジで負けてキャンセルされた）呼び出しは上流ごと止め、同時実行枠を返す。
+
+COALESCE_ENABLED = os.environ.get("COALESCE_ENABLED", "1") != "0"
+# 共有した結果を完了後も相乗り可能にしておく秒数（0なら実行中のみ合流）
+COALESCE_WINDOW = float(os.environ.get("COALESCE_WINDOW", "0.5"))
+
+
+def coalesce_key(**kwargs):
+    """補完リクエストの引数から正規化したハッシュキーを作る（キーの順序や空白に依存しない）"""
+    canonical = json.dumps(kwargs, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    def __init__(self, window=COALESCE_WINDOW, clock=time.monotonic):
+        self.window = window
+        self.clock = clock
+        self._calls = {}  # key -> (task, 完了時刻 or None)
+        self._waiters = {}  # 実行中のtask -> 待っている呼び出し元の数
+        self.stats = {"leaders": 0, "coalesced": 0, "errors": 0, "cancelled": 0}
+
+    async def do(self, key, call):
+        """同じkeyの呼び出しが実行中（または完了直後）なら合流し、無ければcall()を実行する"""
+        entry = self._calls.get(key)
+        if entry is not None:
+            task, finished_at = entry
+            if finished_at is None or self.clock() - finished_at <= self.window:
+                self.stats["coalesced"] += 1
+                UPSTREAM_COALESCED.inc()
+                return await self._wait(task)
+            del self._calls[key]
+
+        self.stats["leaders"] += 1
+        task = asyncio.ensure_future(call())
+        self._calls[key] = (task, None)
+        task.add_done_callback(lambda t: self._finished(key, t))
+        return await self._wait(task)
+
+    async def _wait(self, task):
+        # 待っている1人がキャンセルされても、他に待っている人がいれば共有中の呼び出しは止めない
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            remaining = self._waiters[task] - 1
+            if remaining:
+                self._waiters[task] = remaining
+            else:
+                del self._waiters[task]
+                if not task.done():
+                    # 最後の1人が離れたら上流の呼び出しもキャンセルする（結果を受け取る人がいない）
+                    self.stats["cancelled"] += 1
+                    task.cancel()
+
+    def _finished(self, key, task):
+        entry = self._calls.get(key)
+        if entry is None or entry[0] is not task:
+            return
+        if task.cancelled() or task.exception() is not None:
+            # 失敗は共有し続けない（次のリクエストで再試行させる）
+            self.stats["errors"] += 1
+            del self._calls[key]
+        elif self.window > 0:
+            self._calls[key] = (task, self.clock())
+            asyncio.get_running_loop().call_later(self.window, self._expire, key, task)
+        else:
+            del self._calls[key]
+
+    def _expire(self, key, task):
+        entry = self._calls.get(key)
+        if entry is not None and entry[0] is task:
+            del self._calls[key]
+
+    @property
+    def in_flight(self):
+        return sum(1 for _, finished_at in self._calls.values() if finished_at is None)
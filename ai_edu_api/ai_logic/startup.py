@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+# --- コールドスタートの計測とウォームアップ ---
+# Renderの無料プランはスリープから復帰するたびにプロセスを起動し直すため、
+# 重い初期化（openaiの読み込み・クライアント生成・ResidentAIの起動）は lifespan から
+# バックグラウンドで行い、/ へのpingにはすぐ応答できるようにする。
+# 各区間の所要時間と最初のリクエストのレイテンシは /startup で確認できる。
+
+IMPORT_STARTED = time.perf_counter()  # main.py の最初の import で読み込まれる
+
+# background: 起動を待たずにウォームアップ / blocking: 完了してから受け付け / off: しない
+STARTUP_WARMUP = os.environ.get("STARTUP_WARMUP", "background")
+# 1ならウォームアップでアップストリームへの接続（TLS含む）も張っておく
+STARTUP_WARM_UPSTREAM = os.environ.get("STARTUP_WARM_UPSTREAM", "0") == "1"
+
+MAX_FIRST_REQUEST_PATHS = 32  # 未知のパスへのアクセスで記録が増え続けないように
+
+logger = logging.getLogger(__name__)
+
+
+def process_age():
+    """プロセス起動からの経過秒数（Linux以外ではNone）"""
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupReport:
+    def __init__(self, started=IMPORT_STARTED, clock=time.perf_counter):
+        self.started = started
+        self.clock = clock
+        self.process_age_at_import = process_age()
+        self.marks = {}  # 区間名 -> import開始からの秒数
+        self.steps = {}  # ウォームアップの手順 -> 所要秒数
+        self.first_requests = {}  # パス -> {"at": import開始からの秒数, "latency": 秒}
+        self.warmup_error = None
+        self._lock = threading.Lock()
+
+    def mark(self, name):
+        self.marks[name] = round(self.clock() - self.started, 4)
+
+    def record_step(self, name, seconds):
+        self.steps[name] = round(seconds, 4)
+
+    def record_request(self, path, latency):
+        if path in self.first_requests:
+            return
+        with self._lock:
+            if path in self.first_requests:
+                return
+            self.first_requests[path] = {
+                "at": round(self.clock() - self.started, 4),
+                "latency": round(latency, 4),
+            }
+        logger.info("最初の %s: 起動から%.3f秒・処理%.3f秒", path, self.first_requests[path]["at"], latency)
+
+    def as_dict(self):
+        return {
+            "process_age_at_import": self.process_age_at_import,
+            "marks": dict(self.marks),
+            "warmup_steps": dict(self.steps),
+            "warmup_error": self.warmup_error,
+            "first_requests": dict(self.first_requests),
+        }
+
+
+startup_report = StartupReport()
+
+
+async def run_warmup(steps, report=startup_report):
+    """(名前, 関数) の手順を順に実行する。同期関数はスレッドで実行しイベントループを塞がない"""
+    report.mark("warmup_start")
+    try:
+        for name, step in steps:
+            started = time.perf_counter()
+            if asyncio.iscoroutinefunction(step):
+                await step()
+            else:
+                await asyncio.to_thread(step)
+            report.record_step(name, time.perf_counter() - started)
+    except Exception as e:
+        report.warmup_error = f"{name}: {e}"
+        logger.warning("ウォームアップに失敗しました（%s）: %s", name, e)
+    report.mark("warmup_done")
+    logger.info("ウォームアップ完了: %s", report.steps)
+
+
+_warmup_task = None
+
+
+def start_warmup(steps, report=startup_report):
+    """ウォームアップをバックグラウンドのタスクとして開始する"""
+    global _warmup_task
+    _warmup_task = asyncio.create_task(run_warmup(steps, report))
+    return _warmup_task
+
+
+async def wait_for_warmup():
+    """ウォームアップ中なら完了を待つ（イベントループは塞がない）。
+
+    ウォームアップ中に同じ初期化をリクエスト側で同期的に始めると、ロック待ちでループ全体が止まるため、
+    アップストリームやResidentAIを使うエンドポイントは最初にこれを待つ。
+    """
+    task = _warmup_task
+    if task is not None and not task.done():
+        await asyncio.shield(task)
+
+
+async def stop_warmup():
+    global _warmup_task
+    task, _warmup_task = _warmup_task, None
+    if task is not None and not task.done():
+        task.cancel()
+
+
+class FirstRequestMiddleware:
+    """パスごとに最初のリクエストの処理時間だけを記録するASGIミドルウェア"""
+
+    def __init__(self, app, report=startup_report):
+        self.app = app
+        self.report = report
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["path"] in self.report.first_requests
+            or len(self.report.first_requests) >= MAX_FIRST_REQUEST_PATHS
+        ):
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.report.record_request(scope["path"], time.perf_counter() - started)
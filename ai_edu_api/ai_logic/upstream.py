@@ -0,0 +1,182 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+from ai_edu_api.ai_logic.metrics import UPSTREAM_ERRORS, UPSTREAM_SECONDS, record_usage
+from ai_edu_api.ai_logic.single_flight import COALESCE_ENABLED, SingleFlight, coalesce_key
+from ai_edu_api.ai_logic.upstream_scheduler import (
+    PRIORITY_INTERACTIVE, UpstreamScheduler, call_with_retries, next_retry_delay, upstream_priority
+)
+
+# --- OpenAIへの非同期アップストリーム層 ---
+# 全リクエストで1つのAsyncOpenAIクライアント（= 1つのコネクションプール）を共有し、
+# イベントループをブロックせずに補完APIを呼び出す。
+
+# コネクションプール・同時実行数の設定（環境変数で調整可能）
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.environ.get("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get("UPSTREAM_MAX_CONCURRENCY", "64"))
+UPSTREAM_TIMEOUT = float(os.environ.get("UPSTREAM_TIMEOUT", "60"))
+
+
+class UpstreamClient:
+    def __init__(
+        self,
+        client=None,
+        max_connections=UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive=UPSTREAM_MAX_KEEPALIVE,
+        keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        max_concurrency=UPSTREAM_MAX_CONCURRENCY,
+        timeout=UPSTREAM_TIMEOUT,
+        coalescer=None,
+        scheduler=None,
+    ):
+        if client is None:
+            # openai / httpx の読み込みは重いので、クライアント生成時まで遅らせる（起動時間短縮）
+            import httpx
+            from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+            http_client = DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_keepalive,
+                    keepalive_expiry=keepalive_expiry,
+                ),
+                timeout=timeout,
+            )
+            client = AsyncOpenAI(
+                api_key=os.environ.get("OPENAI_API_KEY"),
+                http_client=http_client,
+                max_retries=0,  # 再試行は同時実行枠を手放してから行う（UpstreamScheduler側）
+            )
+        self.client = client
+        self.max_concurrency = max_concurrency
+        # 同時実行数の上限・優先度付きキュー・ユーザーごとのレート制限・再試行
+        self.scheduler = scheduler if scheduler is not None else UpstreamScheduler(max_concurrency)
+        self.in_flight = 0
+        # 同一リクエストを実行中の1回に合流させるSingleFlight（Noneなら合流しない）
+        self.coalescer = coalescer
+
+    async def complete(self, **kwargs):
+        """補完APIを呼び出し、レスポンス全体を返す"""
+        if self.coalescer is not None:
+            return await self.coalescer.do(coalesce_key(**kwargs), lambda: self._complete(**kwargs))
+        return await self._complete(**kwargs)
+
+    async def _complete(self, **kwargs):
+        model = kwargs.get("model", "")
+
+        async def call():
+            started = time.perf_counter()
+            self.in_flight += 1
+            try:
+                response = await self.client.chat.completions.create(**kwargs)
+            except Exception:
+                UPSTREAM_ERRORS.inc(1, "complete", model)
+                raise
+            finally:
+                self.in_flight -= 1
+            UPSTREAM_SECONDS.observe(time.perf_counter() - started, "complete", model)
+            record_usage(model, getattr(response, "usage", None))
+            return response
+
+        return await call_with_retries(call, self.scheduler, "complete", model)
+
+    async def stream_tokens(self, **kwargs):
+        """ストリーミング補完を呼び出し、差分テキストを順に返す非同期ジェネレータ"""
+        model = kwargs.get("model", "")
+        # 最後のチャンクでトークン数（usage）を受け取る
+        kwargs.setdefault("stream_options", {"include_usage": True})
+        attempt = 0
+        while True:
+            yielded = False
+            try:
+                async with self.scheduler.slot("stream"):
+                    started = time.perf_counter()
+                    self.in_flight += 1
+                    try:
+                        stream = await self.client.chat.completions.create(stream=True, **kwargs)
+                        async for chunk in stream:
+                            record_usage(model, getattr(chunk, "usage", None))
+                            if not chunk.choices:
+                                continue
+                            delta = chunk.choices[0].delta.content if chunk.choices[0].delta else None
+                            if delta:
+                                yielded = True
+                                yield delta
+                        UPSTREAM_SECONDS.observe(time.perf_counter() - started, "stream", model)
+                        return
+                    except Exception:
+                        UPSTREAM_ERRORS.inc(1, "stream", model)
+                        raise
+                    finally:
+                        self.in_flight -= 1
+            except Exception as e:
+                # 送り始めた後は途中から再開できないので、再試行は最初のトークンの前だけ
+                if yielded:
+                    raise
+                delay = next_retry_delay(e, attempt, self.scheduler, "stream", model)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def aclose(self):
+        close = getattr(self.client, "close", None)
+        if close is not None:
+            await close()
+
+
+def sse_event(payload):
+    """辞書をSSEの1イベント（data: {...}）に整形する"""
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+_upstream = None
+_upstream_lock = threading.Lock()
+# 受付制御はクライアント（openaiの読み込み）より先に使うので別に持つ
+_scheduler = UpstreamScheduler(UPSTREAM_MAX_CONCURRENCY)
+
+
+def get_upstream():
+    """プロセス共有のUpstreamClientを返す（未初期化なら生成する）"""
+    global _upstream
+    if _upstream is None:
+        # 起動時のウォームアップ（別スレッド）と最初のリクエストが同時に来ても1つだけ作る
+        with _upstream_lock:
+            if _upstream is None:
+                _upstream = UpstreamClient(
+                    coalescer=SingleFlight() if COALESCE_ENABLED else None,
+                    scheduler=_scheduler,
+                )
+    return _upstream
+
+
+def upstream_in_flight():
+    """実行中の補完リクエスト数（クライアント未生成なら0。メトリクス読み出しで生成しない）"""
+    return _upstream.in_flight if _upstream is not None else 0
+
+
+def upstream_queue_depth():
+    """同時実行枠を待っている補完リクエスト数"""
+    return _scheduler.queue_depth
+
+
+def admit_upstream(user_id=None, priority=PRIORITY_INTERACTIVE):
+    """リクエストの受付時に呼ぶ。以降のアップストリーム呼び出しの優先度を設定し、
+    ユーザーの上限超過（429）・混雑（503）ならUpstreamUnavailableを投げる"""
+    upstream_priority.set(priority)
+    _scheduler.admit(user_id, priority)
+
+
+def set_upstream(upstream):
+    global _upstream
+    _upstream = upstream
+
+
+async def close_upstream():
+    global _upstream
+    if _upstream is not None:
+        await _upstream.aclose()
+        _upstream = None
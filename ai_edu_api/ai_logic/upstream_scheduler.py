@@ -0,0 +1,312 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import random
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+
+from ai_edu_api.ai_logic.metrics import UPSTREAM_QUEUE_SECONDS, UPSTREAM_RETRIES, UPSTREAM_SHED
+
+# --- アップストリーム呼び出しの受付制御（アドミッションコントロール） ---
+# OpenAIが429を返したり遅くなったりしたときに、リクエストを無制限に積み増して全体が
+# 倒れないようにする。
+#   - 全体の同時実行数の上限と、上限を超えた分を待たせる有界の優先度付きキュー
+#     （対話のチャット > 問題の一括生成 > プールの補充 の順に枠を渡す）
+#   - キューが満杯なら待たせずに503で即座に断る（より優先度の低い待ちがあればそれを押し出す）
+#   - user_idごとのトークンバケット（超えたら429）
+#   - 429・5xx・タイムアウトはジッター付き指数バックオフで再試行し、Retry-Afterに従う
+#     （待っている間は同時実行枠を手放す。Retry-After中は全体で新規の送信を止める）
+
+UPSTREAM_MAX_QUEUE = int(os.environ.get("UPSTREAM_MAX_QUEUE", "200"))
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get("UPSTREAM_QUEUE_TIMEOUT", "30"))  # キューで待てる最大秒数
+UPSTREAM_USER_RATE = float(os.environ.get("UPSTREAM_USER_RATE", "1"))  # ユーザーごとの補充速度（回/秒、0で無制限）
+UPSTREAM_USER_BURST = float(os.environ.get("UPSTREAM_USER_BURST", "10"))
+UPSTREAM_USER_BUCKETS = int(os.environ.get("UPSTREAM_USER_BUCKETS", "10000"))  # 保持するユーザー数の上限
+UPSTREAM_MAX_RETRIES = int(os.environ.get("UPSTREAM_MAX_RETRIES", "3"))
+UPSTREAM_RETRY_BASE_DELAY = float(os.environ.get("UPSTREAM_RETRY_BASE_DELAY", "0.5"))
+UPSTREAM_RETRY_MAX_DELAY = float(os.environ.get("UPSTREAM_RETRY_MAX_DELAY", "20"))  # これより長いRetry-Afterは待たない
+
+# 値が小さいほど先に枠を受け取る
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BULK: "bulk", PRIORITY_BACKGROUND: "background"}
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+# エンドポイントで設定し、そのリクエストから出るアップストリーム呼び出しに引き継ぐ
+upstream_priority = contextvars.ContextVar("upstream_priority", default=PRIORITY_INTERACTIVE)
+
+
+class UpstreamUnavailable(Exception):
+    """アップストリームを今は呼べない（クライアントにはstatus_codeとRetry-Afterで返す）"""
+
+    status_code = 503
+
+    def __init__(self, message, retry_after=1.0):
+        super().__init__(message)
+        self.retry_after = max(1.0, float(retry_after))
+
+
+class UpstreamOverloaded(UpstreamUnavailable):
+    status_code = 503
+
+
+class UpstreamRateLimited(UpstreamUnavailable):
+    status_code = 429
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated_at")
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated_at = now
+
+
+class UserRateLimiter:
+    """user_idごとのトークンバケット（rate回/秒で補充、最大burst）"""
+
+    def __init__(self, rate=UPSTREAM_USER_RATE, burst=UPSTREAM_USER_BURST, max_users=UPSTREAM_USER_BUCKETS, clock=time.monotonic):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.max_users = max_users
+        self.clock = clock
+        self._buckets = OrderedDict()
+
+    def acquire(self, user_id):
+        """1回分のトークンを取る。足りなければトークンが溜まるまでの秒数を返す（取れたら0）"""
+        if user_id is None or self.rate <= 0:
+            return 0.0
+        now = self.clock()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.burst, now)
+            while len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated_at) * self.rate)
+            bucket.updated_at = now
+            self._buckets.move_to_end(user_id)
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return 0.0
+        return (1 - bucket.tokens) / self.rate
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "future", "queued_at")
+
+    def __init__(self, priority, seq, future, queued_at):
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        self.queued_at = queued_at
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class UpstreamScheduler:
+    def __init__(
+        self,
+        max_concurrency,
+        max_queue=UPSTREAM_MAX_QUEUE,
+        queue_timeout=UPSTREAM_QUEUE_TIMEOUT,
+        rate_limiter=None,
+        clock=time.monotonic,
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rate_limiter = rate_limiter if rate_limiter is not None else UserRateLimiter()
+        self.clock = clock
+        self.active = 0
+        self.paused_until = 0.0  # Retry-Afterによる全体の送信停止（clockの時刻）
+        self.avg_hold = 1.0  # 枠を使う平均秒数（Retry-Afterの見積もり用の指数移動平均）
+        self._queue = []  # _Waiterのヒープ（キャンセル・押し出し済みのものは遅延削除）
+        self._queued = 0
+        self._seq = itertools.count()
+
+    @property
+    def queue_depth(self):
+        return self._queued
+
+    def retry_after_hint(self):
+        """キューが捌けるまでの見積もり秒数（503/429のRetry-Afterに使う）"""
+        return self.avg_hold * (self._queued + 1) / self.max_concurrency
+
+    def admit(self, user_id=None, priority=PRIORITY_INTERACTIVE):
+        """リクエストの受付時に呼ぶ。ユーザーの上限超過なら429、満杯で割り込めないなら503を投げる。
+
+        ストリーミングではレスポンスを返し始める前にここで断れるようにする。
+        """
+        wait = self.rate_limiter.acquire(user_id)
+        if wait > 0:
+            UPSTREAM_SHED.inc(1, "rate_limited")
+            raise UpstreamRateLimited("リクエストが多すぎます。しばらくしてから再試行してください", wait)
+        if self._queued >= self.max_queue and self._lowest_waiter(priority) is None:
+            UPSTREAM_SHED.inc(1, "queue_full")
+            raise UpstreamOverloaded("混み合っています。しばらくしてから再試行してください", self.retry_after_hint())
+
+    @asynccontextmanager
+    async def slot(self, kind="complete", priority=None):
+        """同時実行枠を1つ確保する。空きが無ければ優先度順に待つ
+
+        Retry-Afterの停止中は枠を取る前に待つ。枠を持ったまま待つと、429が1回来ただけで
+        全部の枠が埋まったまま何も送らない状態になる。
+        """
+        priority = upstream_priority.get() if priority is None else priority
+        queued_at = time.perf_counter()
+        while True:
+            pause = self.paused_until - self.clock()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            if self.active < self.max_concurrency and self._queued == 0:
+                self.active += 1
+            else:
+                await self._wait(priority)
+            if self.paused_until <= self.clock():
+                break
+            # 並んでいる間に停止された：枠は次に回して、停止が明けてから取り直す
+            self._release()
+        UPSTREAM_QUEUE_SECONDS.observe(time.perf_counter() - queued_at, kind, PRIORITY_NAMES.get(priority, str(priority)))
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.avg_hold = 0.9 * self.avg_hold + 0.1 * max(0.0, self.clock() - started)
+            self._release()
+
+    def pause(self, seconds):
+        """Retry-Afterの間は新規の送信を止める"""
+        self.paused_until = max(self.paused_until, self.clock() + seconds)
+
+    async def _wait(self, priority):
+        if self._queued >= self.max_queue:
+            victim = self._lowest_waiter(priority)
+            if victim is None:
+                UPSTREAM_SHED.inc(1, "queue_full")
+                raise UpstreamOverloaded("混み合っています。しばらくしてから再試行してください", self.retry_after_hint())
+            # より優先度の低い待ちを押し出して場所を空ける
+            self._queued -= 1
+            victim.future.set_exception(
+                UpstreamOverloaded("優先度の高いリクエストのため処理できませんでした", self.retry_after_hint())
+            )
+            UPSTREAM_SHED.inc(1, "preempted")
+        waiter = _Waiter(priority, next(self._seq), asyncio.get_running_loop().create_future(), self.clock())
+        heapq.heappush(self._queue, waiter)
+        self._queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._abandon(waiter)
+            UPSTREAM_SHED.inc(1, "queue_timeout")
+            raise UpstreamOverloaded("混み合っています。しばらくしてから再試行してください", self.retry_after_hint())
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+
+    def _abandon(self, waiter):
+        if waiter.future.done():
+            if not waiter.future.cancelled() and waiter.future.exception() is None:
+                # 枠を受け取った直後に諦めた場合は、次の待ちに渡す
+                self._release()
+            return
+        waiter.future.cancel()
+        self._queued -= 1
+
+    def _lowest_waiter(self, priority):
+        """priorityより優先度の低い待ちのうち、最も後回しになるもの"""
+        candidates = [w for w in self._queue if not w.future.done() and w.priority > priority]
+        return max(candidates, default=None)
+
+    def _release(self):
+        while self._queue:
+            waiter = heapq.heappop(self._queue)
+            if waiter.future.done():
+                continue
+            self._queued -= 1
+            waiter.future.set_result(None)  # 枠をそのまま渡す（activeは減らさない）
+            return
+        self.active -= 1
+
+
+def parse_retry_after(error):
+    """例外に付いたレスポンスヘッダからRetry-After（秒）を読む。無ければNone"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error):
+    if isinstance(error, UpstreamUnavailable):
+        return False  # 自分で断ったもの（キュー満杯など）は再試行しない
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    # 接続エラー・タイムアウト（openai.APIConnectionError / APITimeoutError）
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError") or isinstance(error, asyncio.TimeoutError)
+
+
+def backoff_delay(attempt, retry_after=None, base=UPSTREAM_RETRY_BASE_DELAY, cap=UPSTREAM_RETRY_MAX_DELAY, rand=random.random):
+    """attempt回目（0始まり）の再試行までの秒数。Full Jitter、Retry-Afterがあればそれ以上待つ"""
+    delay = min(cap, base * (2 ** attempt)) * rand()
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def next_retry_delay(error, attempt, scheduler, kind, model, max_retries=UPSTREAM_MAX_RETRIES, max_delay=UPSTREAM_RETRY_MAX_DELAY):
+    """再試行できる失敗なら次の試行までの秒数を返し、できなければ例外を投げる。
+
+    再試行を使い切った（または待つべき時間が長すぎる）場合はUpstreamOverloadedにして、
+    クライアントには生の例外ではなく503とRetry-Afterを返す。
+    """
+    if not is_retryable(error):
+        raise error
+    retry_after = parse_retry_after(error)
+    if retry_after is not None:
+        scheduler.pause(retry_after)
+    if attempt >= max_retries or (retry_after is not None and retry_after > max_delay):
+        raise UpstreamOverloaded(
+            "アップストリームが混み合っています。しばらくしてから再試行してください",
+            retry_after if retry_after is not None else scheduler.retry_after_hint(),
+        ) from error
+    UPSTREAM_RETRIES.inc(1, kind, model)
+    return backoff_delay(attempt, retry_after, cap=max_delay)
+
+
+async def call_with_retries(call, scheduler, kind, model, max_retries=UPSTREAM_MAX_RETRIES, sleep=asyncio.sleep):
+    """call() を同時実行枠の中で実行し、再試行できる失敗はバックオフして繰り返す（待つ間は枠を手放す）"""
+    attempt = 0
+    while True:
+        async with scheduler.slot(kind):
+            try:
+                return await call()
+            except Exception as e:
+                error = e
+        await sleep(next_retry_delay(error, attempt, scheduler, kind, model, max_retries))
+        attempt += 1
@@ -1,20 +1,25 @@
 from fastapi.responses import JSONResponse, StreamingResponse
-import json
 from ai_edu_api.ai_logic.generate_problem_prompt import generate_problem_prompt
-from ai_edu_api.supabase_logic.resident_ai_agent import ResidentAIAgent
-from openai import OpenAI
-import os
+from ai_edu_api.ai_logic.prompt_templates import CHAT_TEMPLATE, conversation_block
+from ai_edu_api.ai_logic.emotion_labeler import emotion_labeler
+from ai_edu_api.supabase_logic.resident_ai_agent import get_resident_ai
+from ai_edu_api.supabase_logic.conversation_store import InvalidSequence, SequenceConflict, parse_last_seq
+from ai_edu_api.ai_logic.upstream import admit_upstream, get_upstream, sse_event
+from ai_edu_api.ai_logic.model_router import model_router
+from ai_edu_api.ai_logic.context_builder import context_builder
+from ai_edu_api.ai_logic.metrics import span
 import logging
 
-logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
 
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-resident_ai = ResidentAIAgent()
+SPAN_ENDPOINT = "chat_endpoint_logic"  # /metrics の区間計測で使うラベル
 
-def chat_endpoint_logic(data):
-    logging.debug(f"Received data: {data}")
+async def chat_endpoint_logic(data):
+    logger.debug("Received data: %s", data)
+    resident_ai = get_resident_ai()  # main.py の /chat と同じ1つのエージェントを共有する
     messages = data.get("messages", [])
     chat_id = data.get("chat_id")
+    last_seq = data.get("last_seq")  # あれば messages は前回以降の新しいメッセージだけ
     mode = data.get("mode", "normal")
     model = data.get("model", "gpt-4o")
     user_id = data.get("user_id", None)
@@ -26,91 +31,109 @@ def chat_endpoint_logic(data):
     count = int(data.get("count", 1))
 
     if not chat_id or not user_id:
-        logging.error(f"Missing chat_id or user_id in request: chat_id={chat_id}, user_id={user_id}")
+        logger.error("Missing chat_id or user_id in request: chat_id=%s, user_id=%s", chat_id, user_id)
         return JSONResponse(status_code=400, content={"error": "Missing chat_id or user_id."})
 
-    # フロントエンドから履歴を受け取る
-    if data and 'messages' in data:
-        resident_messages = data['messages']
-    else:
+    if not data or 'messages' not in data:
         raise ValueError("No messages provided by frontend")
 
     try:
-        openai_messages = resident_ai.get_openai_history(chat_id) if chat_id else []
-        logging.debug(f"OpenAI messages retrieved: {openai_messages}")
-    except Exception as e:
-        logging.error(f"Error retrieving OpenAI messages: {e}")
-        openai_messages = []
-
-    # ユーザープロファイルを分析し、プロンプトに統合
-    user_profile = resident_ai.analyze_user(user_id, messages) if user_id else {}
-    context_messages = "\n".join([msg["content"] for msg in resident_messages + openai_messages + messages])
-    system_prompt = {
-        "role": "system",
-        "content": f"以下はこれまでの会話の文脈です:\n{context_messages}\nこれを踏まえて、以下の質問に答えてください。\n\nユーザープロファイル:\n性格: {user_profile.get('性格', '不明')}\n傾向: {user_profile.get('傾向', '不明')}"
-    }
-    full_messages = [system_prompt] + resident_messages + openai_messages + messages
+        last_seq = parse_last_seq(last_seq)
+    except InvalidSequence as e:
+        logger.info("Invalid last_seq: %s", e)
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+    # フロントエンドから受け取った差分（または全履歴）とサーバー側の履歴を合わせる。
+    # 会話ストアへの書き込みは返答が得られてから（失敗・受付拒否なら同じlast_seqで再送できる）
+    try:
+        with span(SPAN_ENDPOINT, "history"):
+            openai_messages = resident_ai.get_openai_history(chat_id, messages, last_seq)
+    except SequenceConflict as e:
+        # 取りこぼし・順序の入れ替わり。クライアントは全履歴を（last_seqなしで）送り直す
+        logger.info("Sequence conflict: %s", e)
+        return JSONResponse(status_code=409, content={
+            "error": "Sequence mismatch. Resend the full history without last_seq.",
+            "seq": e.current_seq
+        })
+    logger.debug("OpenAI messages retrieved: %d件 (last_seq=%s)", len(openai_messages), last_seq)
+
+    # ユーザープロファイルをプロンプトに統合（今回の発言は返答を会話ストアに書くときに畳み込む）
+    with span(SPAN_ENDPOINT, "profile"):
+        user_profile = resident_ai.user_profiles.get(user_id) or {}
+
+    # 履歴は重複排除し、古いターンは要約・直近はそのまま、トークン予算内で組み立てる
+    with span(SPAN_ENDPOINT, "context"):
+        context = context_builder.build(chat_id, openai_messages)
+    # 静的な指示 → ユーザープロファイル → 会話の要約 の順（上流のプロンプトキャッシュが効くように）
+    system_prompt = CHAT_TEMPLATE.message(
+        user=f"ユーザープロファイル:\n性格: {user_profile.get('性格', '不明')}\n傾向: {user_profile.get('傾向', '不明')}",
+        conversation=conversation_block(context.summary)
+    )
+    full_messages = [system_prompt] + context.messages
+    context_headers = {"X-Context-Tokens-Saved": str(context.saved_tokens)}
+    logger.debug(
+        "Context tokens: raw=%d sent=%d saved=%d", context.raw_tokens, context.sent_tokens, context.saved_tokens
+    )
 
     # Resident AI モード
     creative_result = None
     if mode == "creative":
-        creative_result = resident_ai.creative_thinking(
-            question,
-            full_messages,
-            user_id=user_id
-        )
+        with span(SPAN_ENDPOINT, "creative_thinking"):
+            creative_result = resident_ai.creative_thinking(
+                question,
+                full_messages,
+                user_id=user_id
+            )
 
     if model == "higash-ai":
-        if user_id:
-            resident_ai.analyze_user(user_id, messages)
-        creative_result = resident_ai.creative_thinking(
-            question,
-            full_messages,
-            user_id=user_id
-        )
+        with span(SPAN_ENDPOINT, "creative_thinking"):
+            creative_result = resident_ai.creative_thinking(
+                question,
+                full_messages,
+                user_id=user_id
+            )
         reply = creative_result.get("idea", "ResidentAI: 準備中です。")
+        seq = resident_ai.record_turn(chat_id, messages, last_seq, reply, user_id=user_id)
         return JSONResponse(content={
             "reply": reply,
             "emotion": "ニュートラル",
-            "creative": creative_result
-        }, media_type="application/json; charset=utf-8")
-
-    # GPT-4など通常モデル
-    response = client.chat.completions.create(
-        model=model,
-        messages=full_messages,
-        temperature=0.7,
-        response_format={"type": "json_object"}
-    )
+            "creative": creative_result,
+            "seq": seq
+        }, media_type="application/json; charset=utf-8", headers=context_headers)
+
+    # GPT-4など通常モデル（上限超過・混雑時はUpstreamUnavailable → 429/503）
+    admit_upstream(user_id)
+    with span(SPAN_ENDPOINT, "upstream"):
+        response = await model_router.complete(
+            get_upstream(),
+            "chat",
+            model,
+            messages=full_messages,
+            temperature=0.7
+        )
 
-    try:
-        result = json.loads(response.choices[0].message.content)
-        reply = result.get("reply", "")
-        emotion = result.get("emotion", "ニュートラル")
-    except Exception:
-        reply = response.choices[0].message.content
-        emotion = "ニュートラル"
+    # 返答はプレーンテキスト。感情ラベルはローカルのラベラーで付ける
+    reply = response.choices[0].message.content or ""
+    with span(SPAN_ENDPOINT, "emotion"):
+        emotion = emotion_labeler.label(reply)
 
+    # 次のリクエストでは seq を last_seq として、新しいメッセージだけを送ればよい
+    seq = resident_ai.record_turn(chat_id, messages, last_seq, reply, user_id=user_id)
     return JSONResponse(content={
         "reply": reply,
         "emotion": emotion,
-        "creative": creative_result
-    }, media_type="application/json; charset=utf-8")
+        "creative": creative_result,
+        "seq": seq
+    }, media_type="application/json; charset=utf-8", headers=context_headers)
 
 
 def chat_stream_endpoint_logic(data):
     messages = data.get("messages", [])
 
-    def event_stream():
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            stream=True
-        )
-        for chunk in response:
-            delta = chunk.choices[0].delta.content if chunk.choices[0].delta else None
-            if delta:
-                yield f"data: {json.dumps({'token': delta})}\n\n"
+    async def event_stream():
+        # モデルはフォールバックリストに沿って選ぶ（最初のトークンが遅ければ予備のモデルへヘッジ）
+        async for delta in model_router.stream_tokens(get_upstream(), "stream", data.get("model"), messages=messages):
+            yield sse_event({"token": delta})
         yield "data: [DONE]\n\n"
 
     return StreamingResponse(event_stream(), media_type="text/event-stream")
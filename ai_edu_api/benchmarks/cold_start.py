@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from ai_edu_api.benchmarks.run_benchmark import SCENARIOS, free_port, start_server, stop_server, wait_until_ready
+
+# --- コールドスタートの計測 ---
+# スリープからの復帰を想定し、APIサーバーをプロセスごと起動し直して
+#   - import時間（python -X importtime の内訳）
+#   - 起動から / に最初に応答するまでの時間
+#   - 最初の /chat のレイテンシ
+#   - サーバー内部の区間（/startup）
+# をJSONで出力する。アップストリームはモックのOpenAIサーバーを使う。
+#   python -m ai_edu_api.benchmarks.cold_start --runs 5 --output cold_start.json
+
+_IMPORT_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def parse_importtime(stderr, top=15):
+    """-X importtime の出力から合計時間と、累積時間の大きいモジュールを返す（ミリ秒）"""
+    modules = []
+    for line in stderr.splitlines():
+        match = _IMPORT_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append((name, int(cumulative_us), len(indent)))
+    if not modules:
+        return {"total_ms": None, "top": []}
+    root = min(depth for _, _, depth in modules)
+    total = sum(cumulative for _, cumulative, depth in modules if depth == root)
+    # 直下（ルート+1段）までを対象に、累積時間の大きい順に並べる
+    candidates = [(name, cumulative) for name, cumulative, depth in modules if depth <= root + 2]
+    candidates.sort(key=lambda item: item[1], reverse=True)
+    return {
+        "total_ms": round(total / 1000, 2),
+        "top": [{"module": name, "cumulative_ms": round(cumulative / 1000, 2)} for name, cumulative in candidates[:top]],
+    }
+
+
+def measure_import(module="ai_edu_api.main", env=None):
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env, capture_output=True, text=True,
+    )
+    report = parse_importtime(result.stderr)
+    report["wall_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    return report
+
+
+def time_to_first_response(url, timeout=60.0, interval=0.01):
+    """プロセス起動直後から / をポーリングし、最初に200が返るまでの秒数"""
+    started = time.perf_counter()
+    deadline = started + timeout
+    while time.perf_counter() < deadline:
+        try:
+            if httpx.get(url + "/", timeout=1.0).status_code == 200:
+                return time.perf_counter() - started
+        except httpx.HTTPError:
+            pass
+        time.sleep(interval)
+    return None
+
+
+def measure_run(app_env, scenario="chat_gpt"):
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    spawned = time.perf_counter()
+    app = start_server("ai_edu_api.main:app", port, app_env)
+    try:
+        ttfr = time_to_first_response(url)
+        method, path, _, build_body = SCENARIOS[scenario]
+        started = time.perf_counter()
+        response = httpx.request(method, url + path, json=build_body(0) if build_body else None, timeout=60.0)
+        first_chat = time.perf_counter() - started
+        server = httpx.get(url + "/startup", timeout=5.0).json()
+        return {
+            "time_to_first_response_s": round(ttfr, 4) if ttfr is not None else None,
+            "first_request_s": round(first_chat, 4),
+            "first_request_status": response.status_code,
+            "total_s": round(time.perf_counter() - spawned, 4),
+            "server": server,
+        }
+    finally:
+        stop_server(app)
+
+
+def summarize_runs(runs):
+    def values(key):
+        return sorted(r[key] for r in runs if r.get(key) is not None)
+
+    summary = {}
+    for key in ("time_to_first_response_s", "first_request_s"):
+        vals = values(key)
+        if vals:
+            summary[key] = {"min": vals[0], "median": vals[len(vals) // 2], "max": vals[-1]}
+    return summary
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ)
+        env.update({"MOCK_LATENCY": str(args.latency), "MOCK_JITTER": "0", "MOCK_TOKEN_RATE": "0"})
+        mock_port = free_port()
+        mock = start_server("ai_edu_api.benchmarks.mock_openai:app", mock_port, env)
+        app_env = dict(env)
+        app_env.update({
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{mock_port}/v1",
+            "OPENAI_API_KEY": "benchmark",
+            "KG_SQLITE_PATH": os.path.join(workdir, "messages.sqlite3"),
+            "KG_WATERMARK_PATH": os.path.join(workdir, "watermark.json"),
+            "STARTUP_WARMUP": args.warmup,
+        })
+        try:
+            wait_until_ready(f"http://127.0.0.1:{mock_port}", "/stats")
+            report = {
+                "config": {"runs": args.runs, "warmup": args.warmup, "scenario": args.scenario, "mock_latency": args.latency},
+                "import": measure_import(env=app_env),
+                "runs": [measure_run(app_env, args.scenario) for _ in range(args.runs)],
+            }
+            report["summary"] = summarize_runs(report["runs"])
+            return report
+        finally:
+            stop_server(mock)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ai_edu_api のコールドスタート計測")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--warmup", default="background", choices=["background", "blocking", "off"])
+    parser.add_argument("--scenario", default="chat_gpt", choices=[s for s in SCENARIOS if s != "health"])
+    parser.add_argument("--latency", type=float, default=0.05, help="モックの応答遅延（秒）")
+    parser.add_argument("--output", help="結果JSONの出力先（省略時は標準出力）")
+    args = parser.parse_args(argv)
+    text = json.dumps(run(args), ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import argparse
+import json
+import os
+import time
+from collections import Counter
+
+from ai_edu_api.ai_logic.emotion_labeler import EmotionLabeler
+
+# --- ローカル感情ラベラーの精度とスループット ---
+# ラベル付きの小さなフィクスチャ（emotion_fixture.jsonl: {"text", "label"} の1行1件）で
+#   - 正解率・ラベルごとの再現率・混同行列・誤りの一覧
+#   - 1件ずつの label() と label_batch() の1件あたりの処理時間・スループット
+# をJSONで出力する。上流は呼ばないので、そのまま手元で実行できる。
+#   python -m ai_edu_api.benchmarks.emotion_benchmark --batch-size 256 --output emotion.json
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), "emotion_fixture.jsonl")
+
+
+def load_fixture(path=FIXTURE_PATH):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def evaluate(labeler, rows):
+    predicted = labeler.label_batch([row["text"] for row in rows])
+    confusion = Counter((row["label"], label) for row, label in zip(rows, predicted))
+    totals = Counter(row["label"] for row in rows)
+    correct = sum(confusion[(label, label)] for label in totals)
+    return {
+        "examples": len(rows),
+        "accuracy": round(correct / len(rows), 4) if rows else None,
+        "recall": {label: round(confusion[(label, label)] / count, 4) for label, count in sorted(totals.items())},
+        "confusion": {
+            expected: {label: confusion[(expected, label)] for label in labeler.labels if confusion[(expected, label)]}
+            for expected in sorted(totals)
+        },
+        "errors": [
+            {"text": row["text"], "expected": row["label"], "predicted": label}
+            for row, label in zip(rows, predicted) if label != row["label"]
+        ],
+    }
+
+
+def measure_throughput(labeler, texts, batch_size=256, repeat=5):
+    """1件ずつ・バッチそれぞれで、全件を処理した最速の回から1件あたりの時間を出す"""
+    batch = (texts * (batch_size // max(1, len(texts)) + 1))[:batch_size]
+
+    def best_of(run, count):
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return {
+            "us_per_message": round(best / count * 1e6, 2),
+            "messages_per_second": round(count / best) if best > 0 else None,
+        }
+
+    return {
+        "single": best_of(lambda: [labeler.label(text) for text in texts], len(texts)),
+        "batch": dict(best_of(lambda: labeler.label_batch(batch), len(batch)), batch_size=len(batch)),
+    }
+
+
+def run(args):
+    rows = load_fixture(args.fixture)
+    labeler = EmotionLabeler()
+    return {
+        "config": {"fixture": args.fixture, "batch_size": args.batch_size, "repeat": args.repeat},
+        "accuracy": evaluate(labeler, rows),
+        "throughput": measure_throughput(labeler, [row["text"] for row in rows], args.batch_size, args.repeat),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ローカル感情ラベラーの精度・スループット計測")
+    parser.add_argument("--fixture", default=FIXTURE_PATH)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="結果JSONの出力先（省略時は標準出力）")
+    args = parser.parse_args(argv)
+    text = json.dumps(run(args), ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import asyncio
+import json
+import os
+import random
+import re
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# --- ベンチマーク用のOpenAI互換モックサーバー ---
+# /v1/chat/completions だけを実装し、応答までの遅延・トークン生成速度・エラー率を
+# 環境変数で指定できる。本番と同じクライアント（AsyncOpenAI）からOPENAI_BASE_URLで向ける。
+#   python -m uvicorn ai_edu_api.benchmarks.mock_openai:app --port 9100
+
+MOCK_LATENCY = float(os.environ.get("MOCK_LATENCY", "0.3"))  # 最初のトークンまでの秒数
+MOCK_JITTER = float(os.environ.get("MOCK_JITTER", "0.1"))  # 遅延のばらつき（±秒）
+MOCK_TOKEN_RATE = float(os.environ.get("MOCK_TOKEN_RATE", "50"))  # 1秒あたりの生成トークン数
+MOCK_ERROR_RATE = float(os.environ.get("MOCK_ERROR_RATE", "0"))  # 0〜1
+MOCK_REPLY_TOKENS = int(os.environ.get("MOCK_REPLY_TOKENS", "40"))
+MOCK_SEED = os.environ.get("MOCK_SEED")
+# プロンプトキャッシュの再現（OpenAIと同じく1024トークン以上・128トークン単位の先頭一致）
+MOCK_CACHE_MIN_TOKENS = int(os.environ.get("MOCK_CACHE_MIN_TOKENS", "1024"))
+MOCK_CACHE_BLOCK_TOKENS = 128
+
+_QUIZ_COUNT = re.compile(r"\*\*(\d+)問\*\*")
+_EMOTIONS = ("ポジティブ", "ネガティブ", "喜び", "怒り", "驚き", "悲しみ", "ニュートラル")
+
+
+class PromptCacheSimulator:
+    """過去のリクエストと先頭が一致した分を cached_tokens として返す"""
+
+    def __init__(self, min_tokens=MOCK_CACHE_MIN_TOKENS, block_tokens=MOCK_CACHE_BLOCK_TOKENS, max_entries=100000):
+        self.min_tokens = min_tokens
+        self.block_chars = block_tokens * 2  # 2文字 = 1トークンとみなす
+        self.max_entries = max_entries
+        self._seen = set()
+
+    def lookup(self, messages):
+        text = "".join(f"{m.get('role')}:{m.get('content', '')}\n" for m in messages)
+        boundaries = range(self.block_chars, len(text) + 1, self.block_chars)
+        cached = 0
+        for end in boundaries:
+            if end // 2 >= self.min_tokens and hash(text[:end]) in self._seen:
+                cached = end // 2
+        if len(self._seen) > self.max_entries:
+            self._seen.clear()
+        self._seen.update(hash(text[:end]) for end in boundaries)
+        return cached
+
+
+class MockSettings:
+    def __init__(
+        self,
+        latency=MOCK_LATENCY,
+        jitter=MOCK_JITTER,
+        token_rate=MOCK_TOKEN_RATE,
+        error_rate=MOCK_ERROR_RATE,
+        reply_tokens=MOCK_REPLY_TOKENS,
+        seed=MOCK_SEED,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.token_rate = token_rate
+        self.error_rate = error_rate
+        self.reply_tokens = reply_tokens
+        self.random = random.Random(seed)
+        self.prompt_cache = PromptCacheSimulator()
+        self.stats = {"requests": 0, "streams": 0, "errors": 0}
+
+    def first_token_delay(self):
+        return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def token_interval(self):
+        return 1.0 / self.token_rate if self.token_rate > 0 else 0.0
+
+
+_SUBJECTS = ["I", "She", "My brother", "The teacher", "Our class", "They", "Ken", "The students"]
+_VERBS = ["went", "talked", "listened", "looked", "walked", "waited", "wrote", "belonged"]
+_OBJECTS = ["the station", "the library", "her friend", "the music", "the park", "the window", "the club", "a letter"]
+
+
+def make_question(rand):
+    # 問題プールの重複判定で弾かれないよう、問題文は毎回ランダムに組み立てる
+    return f"{rand.choice(_SUBJECTS)} {rand.choice(_VERBS)} ___ {rand.choice(_OBJECTS)}. Choose the correct word."
+
+
+def make_problem(i, question=None):
+    return {
+        "type": "multiple_choice",
+        "layout": "quiz_card_v1",
+        "title": f"ベンチマーク問題{i + 1}",
+        "question": question or f"Choose the correct word ({i + 1}).",
+        "options": ["to", "for", "with", "at"],
+        "answer": "to",
+        "explanation": "ベンチマーク用の固定解説です。",
+        "difficulty": "英検2級",
+        "tags": ["前置詞"],
+    }
+
+
+def make_content(messages, settings, json_mode=False):
+    """システムプロンプトから出題か通常会話かを判定し、それらしい応答を返す（通常会話はJSONモードの時だけJSON）"""
+    system = next((m.get("content", "") for m in messages if m.get("role") == "system"), "")
+    match = _QUIZ_COUNT.search(system)
+    if match:
+        problems = [make_problem(i, make_question(settings.random)) for i in range(int(match.group(1)))]
+        return json.dumps(problems, ensure_ascii=False)
+    reply = "".join("練習" for _ in range(settings.reply_tokens))
+    if not json_mode:
+        return reply
+    return json.dumps({"reply": reply, "emotion": settings.random.choice(_EMOTIONS)}, ensure_ascii=False)
+
+
+def split_tokens(text):
+    # 本物のトークナイザの代わりに2文字ずつを1トークンとみなす
+    return [text[i:i + 2] for i in range(0, len(text), 2)]
+
+
+def usage(messages, tokens, cached_tokens=0):
+    prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 2
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": len(tokens),
+        "total_tokens": prompt_tokens + len(tokens),
+        "prompt_tokens_details": {"cached_tokens": min(cached_tokens, prompt_tokens)},
+    }
+
+
+def create_app(settings=None):
+    settings = settings or MockSettings()
+    app = FastAPI()
+    app.state.settings = settings
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        settings.stats["requests"] += 1
+        if settings.random.random() < settings.error_rate:
+            settings.stats["errors"] += 1
+            await asyncio.sleep(settings.first_token_delay())
+            return JSONResponse(
+                status_code=500,
+                content={"error": {"message": "mock upstream error", "type": "server_error"}},
+            )
+
+        messages = body.get("messages", [])
+        model = body.get("model", "gpt-4o")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        json_mode = (body.get("response_format") or {}).get("type") == "json_object"
+        tokens = split_tokens(make_content(messages, settings, json_mode))
+        cached_tokens = settings.prompt_cache.lookup(messages)
+
+        if body.get("stream"):
+            settings.stats["streams"] += 1
+
+            async def event_stream():
+                await asyncio.sleep(settings.first_token_delay())
+                interval = settings.token_interval()
+                for token in tokens:
+                    chunk = {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": created,
+                        "model": model,
+                        "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                    }
+                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                    if interval:
+                        await asyncio.sleep(interval)
+                last = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                }
+                yield f"data: {json.dumps(last)}\n\n"
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    usage_chunk = {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": created,
+                        "model": model,
+                        "choices": [],
+                        "usage": usage(messages, tokens, cached_tokens),
+                    }
+                    yield f"data: {json.dumps(usage_chunk)}\n\n"
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+        await asyncio.sleep(settings.first_token_delay() + len(tokens) * settings.token_interval())
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(tokens)},
+                "finish_reason": "stop",
+            }],
+            "usage": usage(messages, tokens, cached_tokens),
+        }
+
+    @app.get("/stats")
+    async def stats():
+        return settings.stats
+
+    return app
+
+
+app = create_app()
@@ -0,0 +1,278 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+# --- 負荷テスト・レイテンシベンチマーク ---
+# モックのOpenAIサーバーとAPIサーバーをそれぞれ別プロセスで起動し、
+# 各エンドポイントを指定の並列度で叩いて、スループット・p50/p95/p99・
+# 最初のトークンまでの時間（TTFT）・APIプロセスのピークRSSをJSONで出力する。
+#   python -m ai_edu_api.benchmarks.run_benchmark --requests 200 --concurrency 20 --output before.json
+
+QUIZ_TAGS = [["前置詞"], ["to不定詞"], ["関係代名詞"], ["時制"]]
+
+# シナリオ名 -> (メソッド, パス, ストリーミングか, リクエストボディを作る関数)
+SCENARIOS = {
+    "health": ("GET", "/", False, None),
+    "chat_gpt": ("POST", "/chat", False, lambda i: {
+        "messages": [{"role": "user", "content": f"今日の英語の勉強を振り返りたいです（{i}）"}],
+        "model": "gpt-4o",
+        "user_id": f"bench-{i % 50}",
+    }),
+    "chat_gpt_quiz": ("POST", "/chat", False, lambda i: {
+        "messages": [{"role": "user", "content": "問題を作って"}],
+        "model": "gpt-4o",
+        "user_id": f"bench-{i % 50}",
+        "tags": QUIZ_TAGS[i % len(QUIZ_TAGS)],
+        "count": 1,
+    }),
+    "chat_resident": ("POST", "/chat", False, lambda i: {
+        "messages": [{"role": "user", "content": f"おすすめの勉強法は？（{i}）"}],
+        "model": "higash-ai",
+        "user_id": f"bench-{i % 50}",
+    }),
+    "chat_resident_quiz": ("POST", "/chat", False, lambda i: {
+        "messages": [{"role": "user", "content": "問題を作って"}],
+        "model": "higash-ai",
+        "user_id": f"bench-{i % 50}",
+    }),
+    "chat_stream": ("POST", "/chat/stream", True, lambda i: {
+        "messages": [{"role": "user", "content": f"励ましてください（{i}）"}],
+        "model": "gpt-4o",
+        "user_id": f"bench-{i % 50}",
+    }),
+}
+
+
+def percentile(values, p):
+    """線形補間によるパーセンタイル（valuesはソート済みでなくてよい）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def distribution_ms(values):
+    if not values:
+        return None
+    return {
+        "mean": round(sum(values) / len(values) * 1000, 2),
+        "p50": round(percentile(values, 50) * 1000, 2),
+        "p95": round(percentile(values, 95) * 1000, 2),
+        "p99": round(percentile(values, 99) * 1000, 2),
+        "max": round(max(values) * 1000, 2),
+    }
+
+
+def summarize(samples, elapsed):
+    """1シナリオ分の計測結果（dictのリスト）を集計する"""
+    ok = [s for s in samples if s["ok"]]
+    return {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "error_rate": round((len(samples) - len(ok)) / len(samples), 4) if samples else 0.0,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed > 0 else None,
+        "latency_ms": distribution_ms([s["latency"] for s in ok]),
+        "ttft_ms": distribution_ms([s["ttft"] for s in ok if s.get("ttft") is not None]),
+    }
+
+
+def peak_rss_mb(pid):
+    """プロセスのピークRSS（VmHWM）をMBで返す。Linux以外ではNone"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+async def send(client, scenario, i):
+    method, path, stream, build_body = SCENARIOS[scenario]
+    body = build_body(i) if build_body else None
+    start = time.perf_counter()
+    ttft = None
+    try:
+        if stream:
+            async with client.stream(method, path, json=body) as response:
+                async for line in response.aiter_lines():
+                    if ttft is None and line.startswith("data: ") and '"token"' in line:
+                        ttft = time.perf_counter() - start
+                ok = response.status_code == 200
+        else:
+            response = await client.request(method, path, json=body)
+            ok = response.status_code == 200
+    except httpx.HTTPError:
+        ok = False
+    return {"ok": ok, "latency": time.perf_counter() - start, "ttft": ttft}
+
+
+async def run_scenario(client, scenario, requests, concurrency, warmup=1):
+    for i in range(warmup):
+        await send(client, scenario, -1 - i)
+    samples = []
+    next_index = iter(range(requests))
+
+    async def worker():
+        for i in next_index:
+            samples.append(await send(client, scenario, i))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(max(1, concurrency))])
+    return summarize(samples, time.perf_counter() - start)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_ready(url, path="/", timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url + path, timeout=1.0)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} が起動しませんでした")
+
+
+def start_server(app_path, port, env, workers=1):
+    command = [
+        sys.executable, "-m", "uvicorn", app_path,
+        "--host", "127.0.0.1", "--port", str(port),
+        "--workers", str(workers), "--log-level", "warning",
+    ]
+    return subprocess.Popen(command, env=env)
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def drive(base_url, scenarios, requests, concurrency, warmup, app_pid=None):
+    results = {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120.0) as client:
+        for scenario in scenarios:
+            results[scenario] = await run_scenario(client, scenario, requests, concurrency, warmup)
+            if app_pid is not None:
+                # VmHWMは単調増加なので、そのシナリオ終了時点までのピーク
+                results[scenario]["peak_rss_mb"] = peak_rss_mb(app_pid)
+    return results
+
+
+def run(args):
+    config = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "warmup": args.warmup,
+        "workers": args.workers,
+        "user_rate_limit": {"rate": args.user_rate, "burst": args.user_burst},
+        "mock": {
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "token_rate": args.token_rate,
+            "error_rate": args.error_rate,
+            "seed": args.seed,
+        },
+    }
+    report = {"config": config, "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+    if args.base_url:
+        # 起動済みのサーバーを計測する（モックは使わない）
+        report["scenarios"] = asyncio.run(drive(args.base_url, args.scenarios, args.requests, args.concurrency, args.warmup))
+        return report
+
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ)
+        env.update({
+            "MOCK_LATENCY": str(args.latency),
+            "MOCK_JITTER": str(args.jitter),
+            "MOCK_TOKEN_RATE": str(args.token_rate),
+            "MOCK_ERROR_RATE": str(args.error_rate),
+            "MOCK_SEED": str(args.seed),
+        })
+        mock_port = free_port()
+        mock = start_server("ai_edu_api.benchmarks.mock_openai:app", mock_port, env)
+        app_env = dict(env)
+        app_env.update({
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{mock_port}/v1",
+            "OPENAI_API_KEY": "benchmark",
+            # Supabaseの代わりに空のローカルSQLiteを読む
+            "KG_SQLITE_PATH": os.path.join(workdir, "messages.sqlite3"),
+            "KG_WATERMARK_PATH": os.path.join(workdir, "watermark.json"),
+            # 既定のユーザーごとの上限（1回/秒、バースト10）だと1ユーザー10件を超えた分が429になる
+            "UPSTREAM_USER_RATE": str(args.user_rate),
+            "UPSTREAM_USER_BURST": str(args.user_burst),
+        })
+        app_port = free_port()
+        app = start_server("ai_edu_api.main:app", app_port, app_env, workers=args.workers)
+        try:
+            mock_url = f"http://127.0.0.1:{mock_port}"
+            app_url = f"http://127.0.0.1:{app_port}"
+            wait_until_ready(mock_url, "/stats")
+            wait_until_ready(app_url)
+            started = time.perf_counter()
+            report["scenarios"] = asyncio.run(
+                drive(app_url, args.scenarios, args.requests, args.concurrency, args.warmup, app_pid=app.pid)
+            )
+            report["total_elapsed_s"] = round(time.perf_counter() - started, 3)
+            report["app_peak_rss_mb"] = peak_rss_mb(app.pid)
+            report["mock_stats"] = httpx.get(mock_url + "/stats").json()
+        finally:
+            stop_server(app)
+            stop_server(mock)
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="ai_edu_api の負荷テスト・レイテンシベンチマーク")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=100, help="シナリオごとのリクエスト数")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=1, help="計測前に送るリクエスト数")
+    parser.add_argument("--workers", type=int, default=1, help="APIサーバーのuvicornワーカー数")
+    parser.add_argument("--latency", type=float, default=0.3, help="モックの最初のトークンまでの秒数")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--token-rate", type=float, default=50, help="モックの1秒あたりトークン数")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--user-rate", type=float, default=0, help="ユーザーごとのリクエスト上限（回/秒、0で無制限。--base-url ではサーバー側の設定のまま）")
+    parser.add_argument("--user-burst", type=float, default=10, help="ユーザーごとのバースト上限")
+    parser.add_argument("--base-url", help="起動済みサーバーを計測する場合のURL")
+    parser.add_argument("--output", help="結果JSONの出力先（省略時は標準出力）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
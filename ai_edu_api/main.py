@@ -1,17 +1,88 @@
+from ai_edu_api.ai_logic.startup import (
+    startup_report, run_warmup, start_warmup, stop_warmup, wait_for_warmup, FirstRequestMiddleware,
+    STARTUP_WARMUP, STARTUP_WARM_UPSTREAM
+)
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
-from openai import OpenAI
-import os
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from contextlib import asynccontextmanager
 import pathlib
 import json
-from threading import Thread
+import unicodedata
+import logging
 import time
+from ai_edu_api.ai_logic.upstream import (
+    get_upstream, close_upstream, sse_event, upstream_in_flight, upstream_queue_depth, admit_upstream
+)
+from ai_edu_api.ai_logic.upstream_scheduler import UpstreamUnavailable, PRIORITY_INTERACTIVE, PRIORITY_BULK
+from ai_edu_api.ai_logic.model_router import model_router
+from ai_edu_api.ai_logic.emotion_labeler import emotion_labeler
+from ai_edu_api.ai_logic.prompt_templates import (
+    QUIZ_TEMPLATE, CHAT_TEMPLATE, CHAT_SYSTEM_PROMPT, quiz_settings_block, profile_block, conversation_block
+)
+from ai_edu_api.ai_logic.metrics import registry, span, StreamTimer, TimingMiddleware
+from ai_edu_api.ai_logic.log_setup import setup_logging, CorrelationIdMiddleware
+from ai_edu_api.ai_logic.response_cache import quiz_cache, quiz_cache_key
+from ai_edu_api.ai_logic.context_builder import context_builder
+from ai_edu_api.ai_logic.quiz_batch import QUIZ_BATCH_SIZE, generate_quiz_batch, format_event
+from ai_edu_api.ai_logic.quiz_pool import QUIZ_POOL_ENABLED, QUIZ_POOL_SEED, QuizPoolRefiller, quiz_pool, pool_key
+from ai_edu_api.supabase_logic.resident_ai_agent import get_resident_ai, close_resident_ai
+from ai_edu_api.supabase_logic.conversation_store import InvalidSequence, SequenceConflict, parse_last_seq
+from ai_edu_api.supabase_logic.knowledge_graph import extract_terms
 
 # プロジェクトルートディレクトリのパスを取得（今後使う場合のみ）
 root_dir = pathlib.Path(__file__).parent.parent.absolute()
 
-app = FastAPI()
+# ✅ ログはキューに積んでバックグラウンドで出力（リクエスト処理をブロックしない）
+setup_logging()
+logger = logging.getLogger(__name__)
+
+def warm_hot_path():
+    # 最初のリクエストで初めて通るコード（プロンプト生成・用語抽出・JSON）を一度実行しておく
+    json.loads(json.dumps(generate_problem_prompt(tags=["前置詞"]), ensure_ascii=False))
+    extract_terms("ウォームアップ用のメッセージです warm up")
+    emotion_labeler.label("ウォームアップ用のメッセージです")
+
+async def warm_upstream_connection():
+    # TLSハンドシェイクを済ませ、最初の補完でコネクションを張らずに済むようにする
+    await get_upstream().client.models.list()
+
+def warmup_steps():
+    steps = [
+        # openaiの読み込みとクライアント（コネクションプール共有）の生成
+        ("upstream_client", get_upstream),
+        # ResidentAI（プロファイル・知識グラフ・増分アップデータ）はプロセスで1つだけ
+        ("resident_ai", lambda: get_resident_ai().start()),
+        ("hot_path", warm_hot_path),
+    ]
+    if STARTUP_WARM_UPSTREAM:
+        steps.append(("upstream_connection", warm_upstream_connection))
+    return steps
+
+@asynccontextmanager
+async def lifespan(app):
+    # ✅ 重い初期化は起動後にバックグラウンドで行い、スリープ復帰直後の / にすぐ応答する
+    startup_report.mark("lifespan_start")
+    if STARTUP_WARMUP == "blocking":
+        await run_warmup(warmup_steps())
+    elif STARTUP_WARMUP != "off":
+        start_warmup(warmup_steps())
+    # ✅ 問題プールの補充（実際の需要がある出題条件だけ。QUIZ_POOL_SEED=1 なら既定の条件を最初から用意する）
+    refiller = None
+    if QUIZ_POOL_ENABLED:
+        if QUIZ_POOL_SEED:
+            quiz_pool.seed(pool_key("gpt-4o", "multiple_choice", "英検2級", [], "quiz_card_v1"))
+        refiller = QuizPoolRefiller(quiz_pool, get_upstream, pool_prompt)
+        refiller.start()
+    startup_report.mark("ready")
+    yield
+    if refiller is not None:
+        await refiller.stop()
+    await stop_warmup()
+    close_resident_ai()
+    await close_upstream()
+
+app = FastAPI(lifespan=lifespan)
 
 # ✅ CORS設定（Flutter Web・モバイル・本番環境すべて許可）
 app.add_middleware(
@@ -27,55 +98,42 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# ✅ エンドポイントごとの処理時間を記録（/metrics で公開）
+app.add_middleware(TimingMiddleware)
+# ✅ リクエストごとの相関ID（ログとX-Request-IDヘッダに載せる）
+app.add_middleware(CorrelationIdMiddleware)
+# ✅ パスごとの最初のリクエストの処理時間（/startup で確認）
+app.add_middleware(FirstRequestMiddleware)
+registry.gauge("upstream_in_flight", "アップストリームで実行中の補完リクエスト数", upstream_in_flight)
+registry.gauge("upstream_queue_depth", "同時実行枠を待っている補完リクエスト数", upstream_queue_depth)
+registry.gauge("quiz_pool_stock", "問題プールにストックされている問題数", quiz_pool.stock)
+registry.gauge(
+    "profile_update_queue_depth", "バックグラウンドでの反映を待っているプロファイル更新数",
+    lambda: get_resident_ai().profile_updater.queue_depth
+)
 
-# ✅ OpenAIクライアント（.envファイルからOPENAI_API_KEYを読み込み）
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-
-# --- 独自AIエージェント: DBやOpenAIの裏で“住み着く”知識グラフ・推論エンジン ---
-class ResidentAIAgent:
-    def __init__(self):
-        self.knowledge_graph = {}
-        self.user_profiles = {}  # user_idごとの性格・傾向・感情履歴
-        self.last_update = time.time()
-        self.running = True
-        self.thread = Thread(target=self._background_loop, daemon=True)
-        self.thread.start()
-
-    def _background_loop(self):
-        while self.running:
-            self.update_knowledge()
-            time.sleep(60)  # 1分ごとに知識グラフを更新
-
-    def update_knowledge(self):
-        try:
-            print("[ResidentAIAgent] 知識グラフの更新を開始します。")
-            # TODO: Supabaseの'message'テーブルからデータを取得して知識グラフを更新
-        except Exception as e:
-            print(f"[ResidentAIAgent] 知識グラフの更新中にエラーが発生しました: {e}")
-        self.last_update = time.time()
-
-    def analyze_user(self, user_id, chat_history):
-        # ユーザーの話し方・頻度・時間帯・速度・感情傾向などを解析し、性格や特徴を推定
-        # TODO: 実際の解析ロジックを実装
-        profile = {
-            "性格": "おおらか",
-            "傾向": "夜型・返信早い・ポジティブ多め",
-            "感情履歴": ["喜び", "驚き", "ニュートラル"]
-        }
-        self.user_profiles[user_id] = profile
-        return profile
-
-    def creative_thinking(self, user_input, context, user_id=None):
-        # ユーザーごとの性格・傾向・感情を参照し、独自の仮説や“この人らしい”提案を生成
-        profile = self.user_profiles.get(user_id, None)
-        # TODO: 実際の連想・仮説生成ロジック
-        return {
-            "creative": True,
-            "idea": f"{user_id}さんは{profile['性格'] if profile else 'ユニーク'}な方なので、こういう提案も面白いかも！",
-            "reasoning": f"過去の傾向: {profile['傾向'] if profile else 'データ不足'}"
-        } if user_id else None
-
-resident_ai = ResidentAIAgent()
+@app.exception_handler(UpstreamUnavailable)
+async def upstream_unavailable(request: Request, exc: UpstreamUnavailable):
+    # 混雑・レート超過は生の例外ではなく429/503とRetry-Afterで返す
+    retry_after = int(exc.retry_after + 0.999)
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"error": str(exc), "retry_after": retry_after},
+        headers={"Retry-After": str(retry_after)},
+    )
+
+@app.exception_handler(SequenceConflict)
+async def sequence_conflict(request: Request, exc: SequenceConflict):
+    # 差分の取りこぼし・順序の入れ替わり。クライアントは全履歴を（last_seqなしで）送り直す
+    return JSONResponse(
+        status_code=409,
+        content={"error": "Sequence mismatch. Resend the full history without last_seq.", "seq": exc.current_seq},
+    )
+
+@app.exception_handler(InvalidSequence)
+async def invalid_sequence(request: Request, exc: InvalidSequence):
+    # last_seq が数値でない・負の値など。500ではなく400で返す
+    return JSONResponse(status_code=400, content={"error": str(exc)})
 
 @app.get("/")
 async def health_check():
@@ -85,138 +143,386 @@ async def health_check():
     """
     return {"status": "ok", "message": "API is running"}
 
+@app.get("/startup")
+async def startup():
+    """
+    import・ウォームアップ・最初のリクエストの所要時間（コールドスタートの確認用）
+    """
+    return startup_report.as_dict()
+
+@app.get("/quiz/pool")
+async def quiz_pool_stats():
+    """
+    問題プールのヒット率と、出題条件ごとのストック数・需要
+    """
+    return quiz_pool.as_dict()
+
+@app.get("/models")
+async def models():
+    """
+    モードごとのフォールバックリスト・モデル別のレイテンシ・ヘッジの発生率と勝率
+    """
+    return model_router.as_dict()
+
+@app.get("/metrics")
+async def metrics():
+    """
+    区間ごとの処理時間・TTFT・トークン数などをPrometheusのテキスト形式で返す
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 def generate_problem_prompt(
     user_profile=None,
     quiz_type="multiple_choice",
     level="英検2級",
     tags=None,
     layout="quiz_card_v1",
-    count=1
+    count=1,
+    summary=""
 ):
-    profile_context = ""
-    if user_profile:
-        profile_context += (
-            f"このユーザーは「{user_profile.get('性格', '未知')}」な性格で、"
-            f"「{user_profile.get('傾向', '不明')}」な傾向があります。\n"
-        )
-    tags_text = ", ".join(tags) if tags else "一般的な文法・語彙"
-    prompt = {
-        "role": "system",
-        "content": (
-            f"{profile_context}"
-            f"あなたは教育AIです。以下の条件で **{count}問** の問題を出題してください。\n"
-            f"- 出題タイプ: {quiz_type}\n"
-            f"- 難易度: {level}\n"
-            f"- 出題範囲: {tags_text}\n"
-            f"- レイアウトテンプレート: {layout}\n\n"
-            "【出題ルール】\n"
-            "1. 各問題には文脈・応用・誤答誘導を含めること。\n"
-            "2. 出力形式は以下のJSON配列として返すこと：\n"
-            "[\n"
-            "  {\n"
-            "    \"type\": \"multiple_choice\",\n"
-            "    \"layout\": \"quiz_card_v1\",\n"
-            "    \"title\": \"前置詞の使い分け\",\n"
-            "    \"question\": \"...\",\n"
-            "    \"options\": [\"...\", \"...\", \"...\", \"...\"],\n"
-            "    \"answer\": \"...\",\n"
-            "    \"explanation\": \"...\",\n"
-            "    \"difficulty\": \"英検2級\",\n"
-            "    \"tags\": [\"to不定詞\", \"前置詞\"]\n"
-            "  }, ...\n"
-            "]"
-        )
-    }
-    return prompt
+    # 静的な出題ルール → 出題条件 → ユーザー情報 → 会話の要約 の順（上流のプロンプトキャッシュが効くように）
+    return QUIZ_TEMPLATE.message(
+        settings=quiz_settings_block(quiz_type, level, tags, layout, count),
+        user=profile_block(user_profile),
+        conversation=conversation_block(summary)
+    )
 
-@app.post("/chat")
-async def chat(request: Request):
-    data = await request.json()
+QUIZ_KEYWORDS = ["問題生成", "問題を作って", "quiz", "問題を出して", "問題作成", "問題を自動生成"]
+# 出題の依頼に付く言い回し（話題ではないので取り除く）
+QUIZ_FILLERS = ["お願いします", "おねがいします", "お願い", "おねがい", "ください", "下さい", "please"]
+QUIZ_TOPIC_STRIP = " 、。,.!?・:;「」『』をのでにはがもとて"
+
+def quiz_topic(question):
+    """
+    出題の依頼から出題キーワード・言い回しを除いた話題（「関係代名詞の問題を作って」→「関係代名詞」）。
+    話題の無い依頼なら空文字で、その場合だけプールの問題を返せる
+    """
+    text = unicodedata.normalize("NFKC", str(question or "")).lower()
+    for phrase in QUIZ_KEYWORDS + QUIZ_FILLERS:
+        text = text.replace(phrase, " ")
+    return " ".join(part.strip(QUIZ_TOPIC_STRIP) for part in text.split()).strip(QUIZ_TOPIC_STRIP)
+
+def prepare_chat(data, endpoint="chat"):
+    """
+    /chat と /chat/stream で共通のリクエスト解釈・プロンプト組み立て
+    """
     messages = data.get("messages", [])
-    mode = data.get("mode", "normal")
-    model = data.get("model", "gpt-4o")
     user_id = data.get("user_id", None)
-    question = messages[-1]["content"] if messages else ""
-    context = json.dumps(messages[:-1]) if len(messages) > 1 else None
-    quiz_type = data.get("quiz_type") or "multiple_choice"
-    level = data.get("level") or "英検2級"
-    tags = data.get("tags") or []
-    layout = data.get("layout") or "quiz_card_v1"
-    count = int(data.get("count", 1))
+    ctx = {
+        "endpoint": endpoint,
+        "messages": messages,
+        "mode": data.get("mode", "normal"),
+        "model": data.get("model", "gpt-4o"),
+        "user_id": user_id,
+        "question": messages[-1]["content"] if messages else "",
+        "quiz_type": data.get("quiz_type") or "multiple_choice",
+        "level": data.get("level") or "英検2級",
+        "tags": data.get("tags") or [],
+        "layout": data.get("layout") or "quiz_card_v1",
+        "count": int(data.get("count", 1)),
+        "chat_id": data.get("chat_id"),
+        "new_messages": messages,
+        "last_seq": None,
+    }
+    if ctx["chat_id"]:
+        # chat_idがあれば会話はサーバー側に持つ。last_seqがあればmessagesは前回以降の差分だけ
+        # （連番が合わなければSequenceConflict → 409）
+        with span(endpoint, "history"):
+            ctx["last_seq"] = parse_last_seq(data.get("last_seq"))
+            ctx["messages"] = get_resident_ai().get_openai_history(ctx["chat_id"], messages, ctx["last_seq"])
+    get_resident_ai().notify_new_messages()
+    if user_id and not ctx["chat_id"]:
+        # 発言の感情ラベル付けとプロファイルへの反映はバックグラウンドでまとめて行う（応答を待たせない）。
+        # chat_idがあれば返答を会話ストアに書くとき（finish_reply）に新しい分だけを反映する
+        get_resident_ai().observe_messages(user_id, messages)
 
     # --- 出題意図の自動分類・プロファイル連携 ---
-    user_profile = resident_ai.user_profiles.get(user_id)
-    if any(x in question for x in ["問題生成", "問題を作って", "quiz", "問題を出して", "問題作成", "問題を自動生成"]):
-        system_prompt = generate_problem_prompt(
-            user_profile=user_profile,
-            quiz_type=quiz_type,
-            level=level,
-            tags=tags,
-            layout=layout,
-            count=count
-        )
-    else:
-        system_prompt = {
-            "role": "system",
-            "content": "あなたは教育AIアシスタントです。ユーザーの発言やAIの返答の感情を一言でラベル化してください（例: ポジティブ, ネガティブ, 喜び, 怒り, 驚き, 悲しみ, ニュートラル など）。返答と感情ラベルをJSON形式で返してください。例: {\"reply\": \"...\", \"emotion\": \"ポジティブ\"}"
-        }
-    full_messages = [system_prompt] + messages
+    with span(endpoint, "profile"):
+        ctx["user_profile"] = get_resident_ai().user_profiles.get(user_id)
+    with span(endpoint, "intent"):
+        ctx["is_quiz"] = any(x in ctx["question"] for x in QUIZ_KEYWORDS)
+        ctx["quiz_topic"] = quiz_topic(ctx["question"]) if ctx["is_quiz"] else ""
+    if ctx["model"] != "higash-ai":
+        # 任意のmodel文字列は上流に渡さず、許可されたモデル（モードのフォールバックリスト）に解決する
+        mode = "quiz" if ctx["is_quiz"] else ("stream" if endpoint == "chat_stream" else "chat")
+        ctx["model"] = model_router.resolve(mode, ctx["model"])[0]
+        # 受付制御: ユーザーごとの上限超過・混雑ならここで429/503（ストリーミングも返し始める前に断る）
+        # 対話のチャットは問題生成より先に同時実行枠を受け取る
+        admit_upstream(user_id, PRIORITY_BULK if ctx["is_quiz"] else PRIORITY_INTERACTIVE)
+    with span(endpoint, "context"):
+        # 履歴は重複排除し、古いターンは要約・直近はそのまま、トークン予算内で組み立てる
+        context = context_builder.build(ctx["chat_id"], ctx["messages"])
+        ctx["messages"] = context.messages
+        ctx["summary"] = context.summary
+        ctx["context_tokens_saved"] = context.saved_tokens
+    with span(endpoint, "prompt"):
+        if ctx["is_quiz"]:
+            system_prompt = quiz_prompt(ctx, ctx["count"])
+        else:
+            system_prompt = (
+                CHAT_TEMPLATE.message(conversation=conversation_block(ctx["summary"]))
+                if ctx["summary"] else CHAT_SYSTEM_PROMPT
+            )
+        ctx["full_messages"] = [system_prompt] + ctx["messages"]
 
     # --- ResidentAIによる独自発想・仮説生成 ---
-    creative_result = None
-    if mode == "creative":
-        creative_result = resident_ai.creative_thinking(messages[-1]["content"] if messages else "", full_messages)
-
-    if model == "higash-ai":
-        # ResidentAIのみで応答
-        # ユーザーのプロファイルを更新
-        if user_id:
-            # TODO: 実際はDBから履歴取得
-            resident_ai.analyze_user(user_id, messages)
-        creative_result = resident_ai.creative_thinking(messages[-1]["content"] if messages else "", full_messages, user_id=user_id)
-        reply = creative_result["idea"] if creative_result and "idea" in creative_result else "ResidentAI: 準備中です。"
+    ctx["creative_result"] = None
+    if ctx["mode"] == "creative":
+        with span(endpoint, "creative_thinking"):
+            ctx["creative_result"] = get_resident_ai().creative_thinking(ctx["question"], ctx["full_messages"])
+    return ctx
+
+def finish_reply(ctx, reply, payload):
+    # 返答が得られた時点で今回の発言と返答を会話ストアに書き、次のリクエストで last_seq として送る seq を返す
+    # （seqがnullなら次回は全履歴を送る）
+    if ctx["chat_id"]:
+        payload["seq"] = get_resident_ai().record_turn(
+            ctx["chat_id"], ctx["new_messages"], ctx["last_seq"], reply, user_id=ctx["user_id"]
+        )
+    return payload
+
+def quiz_prompt(ctx, count):
+    return generate_problem_prompt(
+        user_profile=ctx["user_profile"],
+        quiz_type=ctx["quiz_type"],
+        level=ctx["level"],
+        tags=ctx["tags"],
+        layout=ctx["layout"],
+        count=count,
+        summary=ctx["summary"]
+    )
+
+def resident_reply(ctx):
+    # ResidentAIのみで応答（ユーザーのプロファイルは prepare_chat でバックグラウンド更新に積んである）
+    with span(ctx["endpoint"], "creative_thinking"):
+        creative_result = get_resident_ai().creative_thinking(ctx["question"], ctx["full_messages"], user_id=ctx["user_id"])
+    reply = creative_result["idea"] if creative_result and "idea" in creative_result else "ResidentAI: 準備中です。"
+    return reply, creative_result
+
+def pool_prompt(key, count):
+    # プールの問題はユーザーに依存しないので、プロファイルなしで生成する
+    _, quiz_type, level, tags, layout = key
+    return generate_problem_prompt(quiz_type=quiz_type, level=level, tags=list(tags), layout=layout, count=count)
+
+def take_pooled_quiz(ctx):
+    # 事前生成した問題のストックから即座に返す（足りなければNoneで、同期生成に回す）
+    # プールの問題は話題を指定せずに生成しているので、生徒が話題を指定したら使わない
+    if not QUIZ_POOL_ENABLED or ctx["quiz_topic"]:
+        return None
+    problems = quiz_pool.take(
+        pool_key(ctx["model"], ctx["quiz_type"], ctx["level"], ctx["tags"], ctx["layout"]), ctx["count"]
+    )
+    return None if problems is None else json.dumps(problems, ensure_ascii=False)
+
+def quiz_key(ctx):
+    return quiz_cache_key(
+        user_profile=ctx["user_profile"],
+        quiz_type=ctx["quiz_type"],
+        level=ctx["level"],
+        tags=ctx["tags"],
+        layout=ctx["layout"],
+        count=ctx["count"],
+        model=ctx["model"],
+        topic=ctx["quiz_topic"]
+    )
+
+def cache_quiz(cache_key, content):
+    try:
+        json.loads(content)
+        quiz_cache.put(cache_key, content)
+    except Exception:
+        pass  # 壊れたJSONはキャッシュしない
+
+async def generate_quiz_content(ctx):
+    content = take_pooled_quiz(ctx)
+    if content is not None:
+        return content
+    # 問題生成は出題条件が同じなら生成済みの問題を再利用する
+    cache_key = quiz_key(ctx)
+    content = quiz_cache.get(cache_key)
+    if content is not None:
+        return content
+    if ctx["count"] > QUIZ_BATCH_SIZE:
+        # 問題数が多い場合は分割して並列生成し、検証済みの問題だけを配列にまとめる
+        problems = [
+            event["problem"]
+            async for event in generate_quiz_batch(
+                get_upstream(),
+                lambda n: quiz_prompt(ctx, n),
+                ctx["count"],
+                messages=ctx["messages"],
+                model=ctx["model"]
+            )
+            if event["type"] == "problem"
+        ]
+        content = json.dumps(problems, ensure_ascii=False)
+        if problems:
+            quiz_cache.put(cache_key, content)
+        return content
+    response = await model_router.complete(
+        get_upstream(),
+        "quiz",
+        ctx["model"],
+        messages=ctx["full_messages"],
+        response_format={"type": "json_object"}
+    )
+    content = response.choices[0].message.content
+    cache_quiz(cache_key, content)
+    return content
+
+@app.post("/chat")
+async def chat(request: Request):
+    with span("chat", "parse_request"):
+        data = await request.json()
+    with span("chat", "wait_warmup"):
+        await wait_for_warmup()
+    ctx = prepare_chat(data)
+    creative_result = ctx["creative_result"]
+
+    if ctx["model"] == "higash-ai":
+        reply, creative_result = resident_reply(ctx)
         emotion = "ニュートラル"
-        return JSONResponse(content={
+        return JSONResponse(content=finish_reply(ctx, reply, {
             "reply": reply,
             "emotion": emotion,
             "creative": creative_result
-        }, media_type="application/json; charset=utf-8")
+        }), media_type="application/json; charset=utf-8")
     else:
         # 通常のOpenAI（gpt-4o等）
-        response = client.chat.completions.create(
-            model=model,
-            messages=full_messages,
-            response_format={"type": "json_object"}
-        )
-        try:
-            result = json.loads(response.choices[0].message.content)
-            reply = result.get("reply", "")
-            emotion = result.get("emotion", "ニュートラル")
-        except Exception:
-            reply = response.choices[0].message.content
-            emotion = "ニュートラル"
-        print("GPT reply:", reply, "emotion:", emotion)
-        return JSONResponse(content={
+        if ctx["is_quiz"]:
+            with span("chat", "quiz"):
+                content = await generate_quiz_content(ctx)
+            with span("chat", "decode_response"):
+                try:
+                    result = json.loads(content)
+                    reply = result.get("reply", "")
+                    emotion = result.get("emotion", "ニュートラル")
+                except Exception:
+                    reply = content
+                    emotion = "ニュートラル"
+        else:
+            # 返答はプレーンテキストで受け取り、感情ラベルはローカルで付ける（JSONモード不要）
+            with span("chat", "upstream"):
+                response = await model_router.complete(
+                    get_upstream(),
+                    "chat",
+                    ctx["model"],
+                    messages=ctx["full_messages"]
+                )
+            reply = response.choices[0].message.content or ""
+            with span("chat", "emotion"):
+                emotion = emotion_labeler.label(reply)
+        logger.debug("GPT reply: %s emotion: %s", reply, emotion)
+        return JSONResponse(content=finish_reply(ctx, reply, {
             "reply": reply,
             "emotion": emotion,
             "creative": creative_result
-        }, media_type="application/json; charset=utf-8")
+        }), media_type="application/json; charset=utf-8")
 
-@app.post("/chat/stream")
-async def chat_stream(request: Request):
+@app.post("/quiz/stream")
+async def quiz_stream(request: Request):
+    """
+    複数問の問題を並列生成し、完成した問題から1問ずつ返すエンドポイント
+    format: "sse"（既定）または "ndjson"
+    """
     data = await request.json()
+    await wait_for_warmup()
     messages = data.get("messages", [])
+    model = model_router.resolve("quiz", data.get("model"))[0]
+    user_id = data.get("user_id", None)
+    ctx = {
+        "user_profile": get_resident_ai().user_profiles.get(user_id),
+        "quiz_type": data.get("quiz_type") or "multiple_choice",
+        "level": data.get("level") or "英検2級",
+        "tags": data.get("tags") or [],
+        "layout": data.get("layout") or "quiz_card_v1",
+    }
+    count = int(data.get("count", 1))
+    stream_format = "ndjson" if data.get("format") == "ndjson" else "sse"
+    admit_upstream(user_id, PRIORITY_BULK)
 
-    def event_stream():
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            stream=True
-        )
-        for chunk in response:
-            delta = chunk.choices[0].delta.content if chunk.choices[0].delta else None
-            if delta:
-                yield f"data: {json.dumps({'token': delta})}\n\n"
+    async def event_stream():
+        async for event in generate_quiz_batch(
+            get_upstream(), lambda n: quiz_prompt(ctx, n), count, messages=messages, model=model
+        ):
+            yield format_event(event, stream_format)
+
+    media_type = "application/x-ndjson" if stream_format == "ndjson" else "text/event-stream"
+    return StreamingResponse(event_stream(), media_type=media_type)
+
+@app.post("/chat/stream")
+async def chat_stream(request: Request):
+    """
+    /chat と同じ機能（システムプロンプト・model・mode・プロファイル）を持つストリーミング版
+    replyの文字を {"token": ...} で逐次送り、最後に {"emotion": ..., "creative": ...} を送る
+    """
+    started = time.perf_counter()
+    with span("chat_stream", "parse_request"):
+        data = await request.json()
+    with span("chat_stream", "wait_warmup"):
+        await wait_for_warmup()
+    ctx = prepare_chat(data, endpoint="chat_stream")
+
+    async def reply_stream():
+        # TTFTはリクエスト受信から最初のトークンを送るまで
+        timer = StreamTimer("chat_stream", start=started)
+        creative_result = ctx["creative_result"]
+        emotion = "ニュートラル"
+        if ctx["model"] == "higash-ai":
+            reply, creative_result = resident_reply(ctx)
+            timer.token()
+            yield sse_event({"token": reply})
+        elif ctx["is_quiz"]:
+            # 問題生成はJSON配列そのものを返すため、トークンをそのまま流す
+            cache_key = quiz_key(ctx)
+            content = take_pooled_quiz(ctx)
+            if content is None:
+                content = quiz_cache.get(cache_key)
+            if content is not None:
+                timer.token()
+                yield sse_event({"token": content})
+                reply = content
+            else:
+                chunks = []
+                async for delta in model_router.stream_tokens(
+                    get_upstream(),
+                    "quiz",
+                    ctx["model"],
+                    messages=ctx["full_messages"],
+                    response_format={"type": "json_object"}
+                ):
+                    chunks.append(delta)
+                    timer.token()
+                    yield sse_event({"token": delta})
+                reply = "".join(chunks)
+                cache_quiz(cache_key, reply)
+        else:
+            # 返答はプレーンテキストなので、トークンを到着しだいそのまま送る。感情ラベルは最後にローカルで付ける
+            chunks = []
+            async for delta in model_router.stream_tokens(
+                get_upstream(),
+                "stream",
+                ctx["model"],
+                messages=ctx["full_messages"]
+            ):
+                chunks.append(delta)
+                timer.token()
+                yield sse_event({"token": delta})
+            reply = "".join(chunks)
+            emotion = emotion_labeler.label(reply)
+        timer.finish()
+        yield sse_event(finish_reply(ctx, reply, {"emotion": emotion, "creative": creative_result}))
         yield "data: [DONE]\n\n"
 
+    async def event_stream():
+        try:
+            async for event in reply_stream():
+                yield event
+        except UpstreamUnavailable as e:
+            # 返し始めた後に混雑・再試行切れになった場合は、エラーのイベントで知らせて終える
+            yield sse_event({"error": str(e), "retry_after": int(e.retry_after + 0.999)})
+            yield "data: [DONE]\n\n"
+
     return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+startup_report.mark("imported")
@@ -0,0 +1,276 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+# --- サーバー側の会話ストア（chat_idごとの履歴と連番） ---
+# クライアントが毎回すべての履歴を送らなくて済むように、会話をサーバー側に持つ。
+# クライアントは新しいメッセージと chat_id・最後に受け取った連番（last_seq）だけを送り、
+# サーバーが履歴を組み立て直す。連番が合わない差分（取りこぼし・順序の入れ替わり）は拒否し、
+# クライアントには全履歴を送り直してもらう。
+#   - メモリ層: chat_idのLRU（会話数・1会話の件数・合計バイト数に上限）
+#   - 永続層: 状態バックエンド（RESIDENT_STATE_BACKEND）がSQLiteなら同じファイル、メモリなら
+#     CONVERSATION_STORE_PATH のローカルファイル（for_backend()）。どちらも連番の確認をSQLite側で行うので、
+#     複数ワーカーでも整合し、プロセスが再起動しても会話が消えない。空文字にするとメモリ層のみ。
+#     Renderのスリープ・再デプロイをまたぐには、永続ディスク上のパスを指定する。
+
+CONVERSATION_STORE_PATH = os.environ.get("CONVERSATION_STORE_PATH", "conversations.sqlite3")
+CONVERSATION_MAX_CHATS = int(os.environ.get("CONVERSATION_MAX_CHATS", "1000"))
+CONVERSATION_MAX_MESSAGES = int(os.environ.get("CONVERSATION_MAX_MESSAGES", "200"))  # 1会話で保持する直近の件数
+CONVERSATION_MAX_BYTES = int(os.environ.get("CONVERSATION_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# 保存するメッセージのキー（id・created_atは重複排除の同一性判定に使う）
+MESSAGE_FIELDS = ("role", "content", "id", "created_at")
+
+
+class SequenceConflict(Exception):
+    """差分の連番がサーバー側の連番と合わない（クライアントは全履歴を送り直す）"""
+
+    def __init__(self, chat_id, expected_seq, current_seq):
+        super().__init__(f"chat_id={chat_id}: last_seq={expected_seq} ですがサーバーは {current_seq} です")
+        self.chat_id = chat_id
+        self.expected_seq = expected_seq
+        self.current_seq = current_seq
+
+
+class InvalidSequence(ValueError):
+    """last_seq が0以上の整数として読めない（クライアントの誤り。400で返す）"""
+
+
+def parse_last_seq(value):
+    """クライアントが送ってきた last_seq を0以上の整数にする（無ければ None）。読めなければ InvalidSequence"""
+    if value is None:
+        return None
+    try:
+        seq = int(value)
+    except (TypeError, ValueError):
+        seq = None
+    # True/False や 1.5 のような値も、int() は黙って丸めてしまうので断る
+    if seq is None or seq < 0 or isinstance(value, bool) or isinstance(value, float) and seq != value:
+        raise InvalidSequence(f"last_seq は0以上の整数で指定してください: {value!r}")
+    return seq
+
+
+def normalize_message(message):
+    return {key: message[key] for key in MESSAGE_FIELDS if message.get(key) is not None}
+
+
+def message_size(message):
+    return len(json.dumps(message, ensure_ascii=False).encode("utf-8"))
+
+
+class _Conversation:
+    __slots__ = ("messages", "seq", "size")
+
+    def __init__(self, messages=(), seq=0):
+        self.messages = deque(messages)
+        self.seq = seq  # これまでに追加したメッセージの総数（= 最後のメッセージの連番）
+        self.size = sum(message_size(m) for m in self.messages)
+
+
+class ConversationStore:
+    def __init__(
+        self,
+        path=None,
+        max_chats=CONVERSATION_MAX_CHATS,
+        max_messages=CONVERSATION_MAX_MESSAGES,
+        max_bytes=CONVERSATION_MAX_BYTES,
+        clock=time.time,
+    ):
+        self.max_chats = max_chats
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self._chats = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk = None
+        if path:
+            self._disk = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute("PRAGMA synchronous=NORMAL")
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "chat_id TEXT PRIMARY KEY, seq INTEGER NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS conversation_messages ("
+                "chat_id TEXT NOT NULL, seq INTEGER NOT NULL, message TEXT NOT NULL, PRIMARY KEY (chat_id, seq))"
+            )
+        self.stats = {"appends": 0, "replaces": 0, "conflicts": 0, "disk_loads": 0, "evictions": 0}
+
+    def seq(self, chat_id):
+        with self._lock:
+            conversation = self._get(chat_id)
+            return conversation.seq if conversation else 0
+
+    def history(self, chat_id):
+        """保持している直近の履歴（古い順）"""
+        with self._lock:
+            conversation = self._get(chat_id)
+            return [dict(m) for m in conversation.messages] if conversation else []
+
+    @classmethod
+    def for_backend(cls, backend, default_path=CONVERSATION_STORE_PATH, **kwargs):
+        """状態バックエンドがワーカー間で共有されるSQLiteなら、同じファイルに会話も保存する。
+        メモリのバックエンドでは default_path のファイルに保存する（空ならメモリ層のみ）"""
+        path = getattr(backend, "path", None) if backend.shared else None
+        return cls(path=path or default_path or None, **kwargs)
+
+    def check_seq(self, chat_id, expected_seq):
+        """expected_seq がサーバー側の連番と一致するか確かめる（書き込まない）。合わなければ SequenceConflict"""
+        with self._lock:
+            conversation = self._get(chat_id)
+            current = conversation.seq if conversation else 0
+            if expected_seq != current:
+                self.stats["conflicts"] += 1
+                raise SequenceConflict(chat_id, expected_seq, current)
+            return current
+
+    def append(self, chat_id, messages, expected_seq=None):
+        """メッセージを末尾に追加し、新しい連番を返す。
+
+        expected_seq を渡した場合、サーバー側の連番と一致しなければ SequenceConflict。
+        """
+        messages = [normalize_message(m) for m in messages]
+        with self._lock:
+            if self._disk is not None:
+                return self._append_disk(chat_id, messages, expected_seq)
+            conversation = self._get(chat_id)
+            current = conversation.seq if conversation else 0
+            if expected_seq is not None and expected_seq != current:
+                self.stats["conflicts"] += 1
+                raise SequenceConflict(chat_id, expected_seq, current)
+            if conversation is None:
+                conversation = self._put(chat_id, _Conversation())
+            self._extend(conversation, messages)
+            self.stats["appends"] += 1
+            return conversation.seq
+
+    def replace(self, chat_id, messages):
+        """全履歴で置き換える（差分を送らない従来のクライアント・連番の再同期用）"""
+        messages = [normalize_message(m) for m in messages]
+        with self._lock:
+            if self._disk is not None:
+                self._disk.execute("BEGIN IMMEDIATE")
+                try:
+                    self._disk.execute("DELETE FROM conversation_messages WHERE chat_id = ?", (chat_id,))
+                    self._write_disk(chat_id, 0, messages)
+                except BaseException:
+                    self._disk.execute("ROLLBACK")
+                    raise
+                self._disk.execute("COMMIT")
+            self._remove(chat_id)
+            conversation = self._put(chat_id, _Conversation())
+            self._extend(conversation, messages)
+            self.stats["replaces"] += 1
+            return conversation.seq
+
+    def forget(self, chat_id):
+        with self._lock:
+            self._remove(chat_id)
+            if self._disk is not None:
+                self._disk.execute("DELETE FROM conversation_messages WHERE chat_id = ?", (chat_id,))
+                self._disk.execute("DELETE FROM conversations WHERE chat_id = ?", (chat_id,))
+
+    def __len__(self):
+        return len(self._chats)
+
+    @property
+    def size_bytes(self):
+        return self._bytes
+
+    def close(self):
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+
+    def _append_disk(self, chat_id, messages, expected_seq):
+        # 連番の確認と追加を1トランザクションで行い、他のワーカーの追加と直列化する
+        self._disk.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._disk.execute("SELECT seq FROM conversations WHERE chat_id = ?", (chat_id,)).fetchone()
+            current = row[0] if row else 0
+            if expected_seq is not None and expected_seq != current:
+                self.stats["conflicts"] += 1
+                raise SequenceConflict(chat_id, expected_seq, current)
+            self._write_disk(chat_id, current, messages)
+        except BaseException:
+            self._disk.execute("ROLLBACK")
+            raise
+        self._disk.execute("COMMIT")
+        conversation = self._chats.get(chat_id)
+        if conversation is not None and conversation.seq == current:
+            self._extend(conversation, messages)
+            self._chats.move_to_end(chat_id)
+        else:
+            # 他のワーカーが追加していた場合はメモリ層を捨てて次回読み直す
+            self._remove(chat_id)
+        self.stats["appends"] += 1
+        return current + len(messages)
+
+    def _write_disk(self, chat_id, start_seq, messages):
+        self._disk.executemany(
+            "INSERT OR REPLACE INTO conversation_messages (chat_id, seq, message) VALUES (?, ?, ?)",
+            [(chat_id, start_seq + i + 1, json.dumps(m, ensure_ascii=False)) for i, m in enumerate(messages)],
+        )
+        self._disk.execute(
+            "INSERT INTO conversations (chat_id, seq, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET seq = excluded.seq, updated_at = excluded.updated_at",
+            (chat_id, start_seq + len(messages), self.clock()),
+        )
+
+    def _get(self, chat_id):
+        conversation = self._chats.get(chat_id)
+        if self._disk is not None:
+            row = self._disk.execute("SELECT seq FROM conversations WHERE chat_id = ?", (chat_id,)).fetchone()
+            if row is None:
+                return None
+            if conversation is None or conversation.seq != row[0]:
+                conversation = self._load(chat_id, row[0])
+        if conversation is not None:
+            self._chats.move_to_end(chat_id)
+        return conversation
+
+    def _load(self, chat_id, seq):
+        rows = self._disk.execute(
+            "SELECT message FROM conversation_messages WHERE chat_id = ? ORDER BY seq DESC LIMIT ?",
+            (chat_id, self.max_messages),
+        ).fetchall()
+        self._remove(chat_id)
+        self.stats["disk_loads"] += 1
+        return self._put(chat_id, _Conversation([json.loads(row[0]) for row in reversed(rows)], seq))
+
+    def _put(self, chat_id, conversation):
+        self._chats[chat_id] = conversation
+        self._bytes += conversation.size
+        self._evict()
+        return conversation
+
+    def _extend(self, conversation, messages):
+        for message in messages:
+            size = message_size(message)
+            conversation.messages.append(message)
+            conversation.size += size
+            self._bytes += size
+            conversation.seq += 1
+        while len(conversation.messages) > self.max_messages:
+            removed = message_size(conversation.messages.popleft())
+            conversation.size -= removed
+            self._bytes -= removed
+        self._evict()
+
+    def _remove(self, chat_id):
+        conversation = self._chats.pop(chat_id, None)
+        if conversation is not None:
+            self._bytes -= conversation.size
+
+    def _evict(self):
+        # 最新の会話は残し、古い会話から追い出す（永続層があればそこから読み直せる）
+        while len(self._chats) > 1 and (len(self._chats) > self.max_chats or self._bytes > self.max_bytes):
+            _, conversation = self._chats.popitem(last=False)
+            self._bytes -= conversation.size
+            self.stats["evictions"] += 1
+
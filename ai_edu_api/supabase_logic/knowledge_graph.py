@@ -0,0 +1,381 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from itertools import combinations
+
+from ai_edu_api.ai_logic.metrics import KNOWLEDGE_BATCH_SECONDS, KNOWLEDGE_LAG_SECONDS, KNOWLEDGE_ROWS
+from ai_edu_api.supabase_logic.state_backend import BackendWatermarkStore, make_owner_id
+
+# --- ResidentAIの知識グラフと増分更新パイプライン ---
+# messagesテーブルを毎回全件読むのではなく、永続化したハイウォーターマーク
+# （created_at, id）より新しい行だけを一定件数ずつ取り込み、グラフをその場で更新する。
+
+KG_BATCH_SIZE = int(os.environ.get("KG_BATCH_SIZE", "500"))
+KG_MAX_BATCHES_PER_RUN = int(os.environ.get("KG_MAX_BATCHES_PER_RUN", "20"))
+KG_DEBOUNCE_SECONDS = float(os.environ.get("KG_DEBOUNCE_SECONDS", "2"))
+KG_INTERVAL_SECONDS = float(os.environ.get("KG_INTERVAL_SECONDS", "60"))
+KG_WATERMARK_PATH = os.environ.get("KG_WATERMARK_PATH")
+KG_SQLITE_PATH = os.environ.get("KG_SQLITE_PATH")  # 指定時はSupabaseの代わりにローカルSQLiteを読む
+
+LEADER_ROLE = "knowledge_updater"
+MAX_TERMS_PER_MESSAGE = 20  # 共起ペア数（n^2）を抑えるための上限
+
+logger = logging.getLogger(__name__)
+
+# 英数字の単語、カタカナ語、漢字の連続（2文字以上）を用語とみなす
+_TERM_PATTERN = re.compile(r"[A-Za-z][A-Za-z0-9_\-]+|[ァ-ヴー]{2,}|[一-龥々]{2,}")
+
+
+def extract_terms(text):
+    """本文から用語を抽出する（出現順・重複なし）"""
+    terms = []
+    seen = set()
+    for match in _TERM_PATTERN.findall(text or ""):
+        term = match.lower()
+        if term in seen:
+            continue
+        seen.add(term)
+        terms.append(term)
+        if len(terms) >= MAX_TERMS_PER_MESSAGE:
+            break
+    return terms
+
+
+def _timestamp(value):
+    if not value:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+
+class KnowledgeGraph:
+    def __init__(self):
+        self.term_counts = {}  # 用語 -> 出現メッセージ数
+        self.adjacency = {}  # 用語 -> 共起した用語の集合
+        self.cooccurrence = {}  # (用語a, 用語b)（a < b） -> 共起回数
+        self._lock = threading.Lock()
+
+    def add_message(self, text, delta=None):
+        """メッセージ1件分を反映する。deltaに(用語Counter, ペアCounter)を渡すと差分も記録する"""
+        terms = extract_terms(text)
+        if not terms:
+            return
+        with self._lock:
+            for term in terms:
+                self.term_counts[term] = self.term_counts.get(term, 0) + 1
+            for a, b in combinations(sorted(terms), 2):
+                self.cooccurrence[(a, b)] = self.cooccurrence.get((a, b), 0) + 1
+                self.adjacency.setdefault(a, set()).add(b)
+                self.adjacency.setdefault(b, set()).add(a)
+        if delta is not None:
+            term_delta, pair_delta = delta
+            term_delta.update(terms)
+            pair_delta.update(combinations(sorted(terms), 2))
+
+    def replace(self, term_counts, cooccurrence):
+        """共有バックエンドから読み込んだ内容でグラフを置き換える"""
+        adjacency = {}
+        for a, b in cooccurrence:
+            adjacency.setdefault(a, set()).add(b)
+            adjacency.setdefault(b, set()).add(a)
+        with self._lock:
+            self.term_counts = dict(term_counts)
+            self.cooccurrence = dict(cooccurrence)
+            self.adjacency = adjacency
+
+    def neighbors(self, term, limit=10):
+        """共起回数の多い順に関連語を返す"""
+        term = term.lower()
+        with self._lock:
+            related = self.adjacency.get(term, ())
+            scored = [
+                (other, self.cooccurrence[(term, other) if term < other else (other, term)])
+                for other in related
+            ]
+        scored.sort(key=lambda item: (-item[1], item[0]))
+        return scored[:limit]
+
+    def __len__(self):
+        return len(self.term_counts)
+
+
+# --- メッセージソース（fetch_after / latest を実装すれば差し替え可能） ---
+
+class SQLiteMessageSource:
+    """ローカルSQLiteのmessagesテーブル（テスト・ベンチマーク用のSupabase代替）"""
+
+    def __init__(self, path, table="messages"):
+        self.table = table
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "id TEXT PRIMARY KEY, chat_id TEXT, sender TEXT, content TEXT, created_at TEXT NOT NULL)"
+        )
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_created_at ON {table} (created_at, id)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def insert(self, rows):
+        with self._lock:
+            self._conn.executemany(
+                f"INSERT INTO {self.table} (id, chat_id, sender, content, created_at) "
+                "VALUES (:id, :chat_id, :sender, :content, :created_at)",
+                rows,
+            )
+            self._conn.commit()
+
+    def fetch_after(self, watermark, limit):
+        created_at = watermark.get("created_at") or ""
+        row_id = watermark.get("id") or ""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, chat_id, content, created_at FROM {self.table} "
+                "WHERE created_at > ? OR (created_at = ? AND id > ?) "
+                "ORDER BY created_at, id LIMIT ?",
+                (created_at, created_at, row_id, limit),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def latest(self):
+        with self._lock:
+            row = self._conn.execute(f"SELECT MAX(created_at) FROM {self.table}").fetchone()
+        return row[0] if row else None
+
+
+class SupabaseMessageSource:
+    """Supabaseのmessagesテーブル"""
+
+    def __init__(self, client=None, table="messages"):
+        if client is None:
+            from supabase import create_client
+            client = create_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_ANON_KEY"])
+        self.client = client
+        self.table = table
+
+    def fetch_after(self, watermark, limit):
+        created_at = watermark.get("created_at")
+        row_id = watermark.get("id") or ""
+        query = self.client.table(self.table).select("id,chat_id,content,created_at")
+        if created_at and row_id:
+            # (created_at, id) の順でウォーターマークより後の行だけをクエリで絞る。
+            # 取得後に絞ると、同じcreated_atの行がlimit件以上あったときに毎回空になり取り込みが止まる
+            # （値は "." や ":" を含むのでPostgRESTの引用符で囲む）
+            query = query.or_(
+                f'created_at.gt."{created_at}",and(created_at.eq."{created_at}",id.gt."{row_id}")'
+            )
+        elif created_at:
+            query = query.gte("created_at", created_at)
+        return query.order("created_at").order("id").limit(limit).execute().data or []
+
+    def latest(self):
+        rows = (
+            self.client.table(self.table).select("created_at")
+            .order("created_at", desc=True).limit(1).execute().data
+        )
+        return rows[0]["created_at"] if rows else None
+
+
+def default_message_source():
+    """環境変数から取り込み元を決める（未設定ならNone＝取り込みなし）"""
+    if KG_SQLITE_PATH:
+        return SQLiteMessageSource(KG_SQLITE_PATH)
+    if os.environ.get("SUPABASE_URL") and os.environ.get("SUPABASE_ANON_KEY"):
+        return SupabaseMessageSource()
+    return None
+
+
+# --- ハイウォーターマークの永続化 ---
+
+class FileWatermarkStore:
+    def __init__(self, path=None):
+        self.path = path
+        self._value = {}
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self._value = json.load(f)
+
+    def load(self):
+        return dict(self._value)
+
+    def save(self, watermark):
+        self._value = dict(watermark)
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._value, f)
+        os.replace(tmp_path, self.path)  # 書き込み途中で落ちても壊れないよう置き換える
+
+
+class KnowledgeUpdater:
+    def __init__(
+        self,
+        graph,
+        source,
+        watermark_store=None,
+        batch_size=KG_BATCH_SIZE,
+        max_batches_per_run=KG_MAX_BATCHES_PER_RUN,
+        debounce=KG_DEBOUNCE_SECONDS,
+        interval=KG_INTERVAL_SECONDS,
+        backend=None,
+        owner=None,
+    ):
+        self.graph = graph
+        self.source = source
+        # 共有バックエンドがある場合はワーカー間でリーダー1つだけが取り込みを行う
+        self.backend = backend if backend is not None and backend.shared else None
+        self.owner = owner or make_owner_id()
+        self.lease_ttl = max(interval * 3, 30.0)
+        if watermark_store is None:
+            watermark_store = (
+                BackendWatermarkStore(self.backend) if self.backend is not None
+                else FileWatermarkStore(KG_WATERMARK_PATH)
+            )
+        self.watermark_store = watermark_store
+        self.watermark = self.watermark_store.load()
+        self.is_leader = self.backend is None
+        self._graph_version = None
+        self.batch_size = batch_size
+        self.max_batches_per_run = max_batches_per_run
+        self.debounce = debounce
+        self.interval = interval
+        self._run_lock = threading.Lock()
+        self._wake = threading.Condition()
+        self._due_at = None
+        self._running = False
+        self._thread = None
+        self.stats = {
+            "runs": 0,
+            "batches": 0,
+            "rows": 0,
+            "last_batch_rows": 0,
+            "last_batch_seconds": 0.0,
+            "last_run_at": None,
+            "lag_seconds": None,
+            "errors": 0,
+            "role": "leader" if self.is_leader else "follower",
+        }
+
+    def run_once(self):
+        """ウォーターマーク以降の行をバッチ単位で取り込む。取り込んだ行数を返す"""
+        if self.source is None:
+            return 0
+        with self._run_lock:
+            if self.backend is not None and not self._ensure_leader():
+                self._sync_from_backend()
+                return 0
+            total = 0
+            for _ in range(self.max_batches_per_run):
+                started = time.perf_counter()
+                rows = self.source.fetch_after(self.watermark, self.batch_size)
+                if not rows:
+                    break
+                delta = (Counter(), Counter()) if self.backend is not None else None
+                for row in rows:
+                    self.graph.add_message(row.get("content"), delta)
+                last = rows[-1]
+                self.watermark = {"created_at": last["created_at"], "id": str(last["id"])}
+                if self.backend is not None:
+                    self.backend.apply_graph_delta(delta[0], delta[1], watermark=self.watermark)
+                    self._graph_version = self.backend.graph_version()
+                else:
+                    self.watermark_store.save(self.watermark)
+                total += len(rows)
+                self.stats["batches"] += 1
+                self.stats["last_batch_rows"] = len(rows)
+                self.stats["last_batch_seconds"] = time.perf_counter() - started
+                KNOWLEDGE_BATCH_SECONDS.observe(self.stats["last_batch_seconds"])
+                KNOWLEDGE_ROWS.inc(len(rows))
+                if len(rows) < self.batch_size:
+                    break
+            self.stats["runs"] += 1
+            self.stats["rows"] += total
+            self.stats["last_run_at"] = time.time()
+            self.stats["lag_seconds"] = self._lag()
+            KNOWLEDGE_LAG_SECONDS.set(self.stats["lag_seconds"])
+            if total:
+                logger.debug(
+                    "知識グラフに%d件を取り込みました（遅れ %s 秒）", total, self.stats["lag_seconds"]
+                )
+            return total
+
+    def trigger(self):
+        """更新を要求する（debounce秒以内の要求は1回の実行にまとめる）"""
+        with self._wake:
+            if self._due_at is None:
+                self._due_at = time.monotonic() + self.debounce
+                self._wake.notify()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._wake:
+            self._running = False
+            self._wake.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        if self.backend is not None and self.is_leader:
+            self.backend.release_leader(LEADER_ROLE, self.owner)
+            self.is_leader = False
+
+    def _ensure_leader(self):
+        was_leader = self.is_leader
+        self.is_leader = self.backend.try_acquire_leader(LEADER_ROLE, self.owner, self.lease_ttl)
+        self.stats["role"] = "leader" if self.is_leader else "follower"
+        if self.is_leader and not was_leader:
+            # 新たにリーダーになったら、前任者が進めた状態から再開する
+            self._sync_from_backend()
+            self.watermark = self.watermark_store.load()
+        return self.is_leader
+
+    def _sync_from_backend(self):
+        version = self.backend.graph_version()
+        if version != self._graph_version:
+            self.graph.replace(*self.backend.load_graph())
+            self._graph_version = version
+
+    def _loop(self):
+        next_periodic = time.monotonic()
+        while True:
+            with self._wake:
+                while self._running:
+                    now = time.monotonic()
+                    due = next_periodic if self._due_at is None else min(self._due_at, next_periodic)
+                    if now >= due:
+                        break
+                    self._wake.wait(timeout=due - now)
+                if not self._running:
+                    return
+                self._due_at = None
+            try:
+                self.run_once()
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error("知識グラフの更新中にエラーが発生しました: %s", e)
+            next_periodic = time.monotonic() + self.interval
+
+    def _lag(self):
+        latest = _timestamp(self.source.latest())
+        current = _timestamp(self.watermark.get("created_at"))
+        if latest is None:
+            return 0.0
+        if current is None:
+            return None
+        return max(0.0, latest - current)
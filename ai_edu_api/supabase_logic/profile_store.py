@@ -0,0 +1,420 @@
+import logging
+import math
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from datetime import datetime
+
+# --- ResidentAI用のユーザープロファイルストア ---
+# 生のメッセージ本文は保持せず、固定サイズの統計（感情カウント・時間帯ヒストグラム・
+# 返信速度のEWMA）だけをユーザーごとに持つ。LRU/TTLで追い出し、メモリ上限も設ける。
+
+EMOTION_LABELS = ("ポジティブ", "ネガティブ", "喜び", "怒り", "驚き", "悲しみ", "ニュートラル")
+EMOTION_INDEX = {label: i for i, label in enumerate(EMOTION_LABELS)}
+POSITIVE_EMOTIONS = (EMOTION_INDEX["ポジティブ"], EMOTION_INDEX["喜び"])
+NEGATIVE_EMOTIONS = (EMOTION_INDEX["ネガティブ"], EMOTION_INDEX["怒り"], EMOTION_INDEX["悲しみ"])
+
+RECENT_EMOTIONS = 8  # 感情履歴として返す直近の件数（リングバッファ）
+LATENCY_ALPHA = 0.3  # 返信速度EWMAの平滑化係数
+
+# 共有バックエンドに保存する際の固定長ヘッダ（カーソル・EWMA・件数・ウォーターマーク等）
+_RECORD_HEADER = struct.Struct("<BdIdd")
+
+PROFILE_MAX_USERS = int(os.environ.get("PROFILE_MAX_USERS", "10000"))
+PROFILE_TTL = float(os.environ.get("PROFILE_TTL", str(7 * 24 * 3600)))
+PROFILE_MAX_BYTES = int(os.environ.get("PROFILE_MAX_BYTES", str(16 * 1024 * 1024)))
+# 共有バックエンドのプロファイル表から、TTL切れ・件数上限を超えた古いユーザーを消す間隔（秒）
+PROFILE_PRUNE_INTERVAL = float(os.environ.get("PROFILE_PRUNE_INTERVAL", "300"))
+# バックグラウンド更新（ProfileUpdater）のキュー長と1回にまとめて処理する件数
+PROFILE_UPDATE_QUEUE = int(os.environ.get("PROFILE_UPDATE_QUEUE", "10000"))
+PROFILE_UPDATE_BATCH = int(os.environ.get("PROFILE_UPDATE_BATCH", "64"))
+
+logger = logging.getLogger(__name__)
+
+
+def _timestamp(value):
+    """created_at（ISO文字列またはエポック秒）をエポック秒に変換する"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+
+class ProfileRecord:
+    __slots__ = (
+        "emotion_counts",
+        "hour_histogram",
+        "recent_emotions",
+        "recent_cursor",
+        "latency_ewma",
+        "message_count",
+        "watermark_ts",
+        "last_ai_ts",
+        "last_access",
+    )
+
+    def __init__(self):
+        self.emotion_counts = array("I", [0] * len(EMOTION_LABELS))
+        self.hour_histogram = array("I", [0] * 24)
+        self.recent_emotions = array("b", [-1] * RECENT_EMOTIONS)
+        self.recent_cursor = 0
+        self.latency_ewma = -1.0  # 未計測は負の値
+        self.message_count = 0
+        self.watermark_ts = 0.0  # 取り込み済みメッセージのcreated_atの最大値
+        self.last_ai_ts = None
+        self.last_access = 0.0
+
+    def fold(self, message, now=None, emotion=None):
+        """メッセージ1件を統計に畳み込む（emotion はメッセージに感情が無い場合に使うラベル）"""
+        ts = _timestamp(message.get("created_at"))
+        role = message.get("role") or message.get("sender")
+        if role in ("assistant", "ai"):
+            self.last_ai_ts = ts
+            return
+        self.message_count += 1
+        hour = time.localtime(ts if ts is not None else (now or time.time())).tm_hour
+        self.hour_histogram[hour] += 1
+        emotion = EMOTION_INDEX.get(message.get("emotion") or emotion)
+        if emotion is not None:
+            self.add_emotion(emotion)
+        if ts is not None and self.last_ai_ts is not None and ts >= self.last_ai_ts:
+            latency = ts - self.last_ai_ts
+            if self.latency_ewma < 0:
+                self.latency_ewma = latency
+            else:
+                self.latency_ewma += LATENCY_ALPHA * (latency - self.latency_ewma)
+            self.last_ai_ts = None
+
+    def to_bytes(self):
+        """共有バックエンド保存用の固定長バイト列に変換する"""
+        header = _RECORD_HEADER.pack(
+            self.recent_cursor,
+            self.latency_ewma,
+            self.message_count,
+            self.watermark_ts,
+            math.nan if self.last_ai_ts is None else self.last_ai_ts,
+        )
+        return header + self.emotion_counts.tobytes() + self.hour_histogram.tobytes() + self.recent_emotions.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        record = cls()
+        (
+            record.recent_cursor,
+            record.latency_ewma,
+            record.message_count,
+            record.watermark_ts,
+            last_ai_ts,
+        ) = _RECORD_HEADER.unpack_from(data)
+        record.last_ai_ts = None if math.isnan(last_ai_ts) else last_ai_ts
+        offset = _RECORD_HEADER.size
+        for name in ("emotion_counts", "hour_histogram", "recent_emotions"):
+            values = getattr(record, name)
+            size = len(values) * values.itemsize
+            values[:] = array(values.typecode, data[offset:offset + size])
+            offset += size
+        return record
+
+    def add_emotion(self, emotion):
+        self.emotion_counts[emotion] += 1
+        self.recent_emotions[self.recent_cursor] = emotion
+        self.recent_cursor = (self.recent_cursor + 1) % RECENT_EMOTIONS
+
+    def recent_emotion_labels(self):
+        ordered = self.recent_emotions[self.recent_cursor:] + self.recent_emotions[:self.recent_cursor]
+        return [EMOTION_LABELS[i] for i in ordered if i >= 0]
+
+    def to_profile(self):
+        """従来のプロファイル辞書（性格・傾向・感情履歴）に変換する"""
+        total = sum(self.emotion_counts)
+        positive = sum(self.emotion_counts[i] for i in POSITIVE_EMOTIONS)
+        negative = sum(self.emotion_counts[i] for i in NEGATIVE_EMOTIONS)
+        surprise = self.emotion_counts[EMOTION_INDEX["驚き"]]
+
+        if total and negative * 2 > total:
+            personality = "繊細"
+        elif total and surprise * 3 > total:
+            personality = "好奇心旺盛"
+        else:
+            personality = "おおらか"
+
+        night = sum(self.hour_histogram[h] for h in (22, 23, 0, 1, 2, 3, 4))
+        morning = sum(self.hour_histogram[h] for h in range(5, 11))
+        if self.message_count and night * 2 >= self.message_count:
+            active = "夜型"
+        elif self.message_count and morning * 2 >= self.message_count:
+            active = "朝型"
+        else:
+            active = "昼型"
+        speed = "返信早い" if 0 <= self.latency_ewma < 60 else "じっくり返信"
+        if positive > negative:
+            mood = "ポジティブ多め"
+        elif negative > positive:
+            mood = "ネガティブ多め"
+        else:
+            mood = "感情穏やか"
+
+        return {
+            "性格": personality,
+            "傾向": f"{active}・{speed}・{mood}",
+            "感情履歴": self.recent_emotion_labels(),
+        }
+
+
+# 1レコードあたりのおおよそのメモリ使用量（ハードなメモリ上限の計算に使う）
+_sample = ProfileRecord()
+RECORD_BYTES = sys.getsizeof(_sample) + sum(
+    sys.getsizeof(getattr(_sample, name)) for name in ("emotion_counts", "hour_histogram", "recent_emotions")
+) + 128  # OrderedDictのエントリとuser_idキーの分
+del _sample
+
+
+class ProfileStore:
+    def __init__(
+        self,
+        max_users=PROFILE_MAX_USERS,
+        ttl=PROFILE_TTL,
+        max_bytes=PROFILE_MAX_BYTES,
+        clock=time.time,
+        backend=None,
+        labeler=None,
+    ):
+        self.max_users = min(max_users, max(1, max_bytes // RECORD_BYTES))
+        self.ttl = ttl
+        self.clock = clock
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        # ワーカー間で共有するバックエンドがあれば、そちらを正とする（プロセス内はキャッシュ）
+        self.backend = backend if backend is not None and backend.shared else None
+        # 感情の付いていない発言をラベル付けする（label_batch(texts) を持つもの。Noneなら感情は数えない）
+        self.labeler = labeler
+        self._pruned_at = clock()
+
+    def analyze(self, user_id, chat_history, delta=False):
+        """ウォーターマークより新しいメッセージだけを畳み込み、プロファイルを返す
+
+        delta=True は chat_history が新しいメッセージだけであることを示す（会話ストアが chat_id と連番で
+        新しい分を切り出したもの）。created_at の無い全履歴は、初回は全件・以降は末尾の1件を今回の発言とみなす。
+        """
+        if self.backend is not None:
+            return self._analyze_shared(user_id, chat_history, delta)
+        with self._lock:
+            record = self._touch(user_id, create=True)
+            self._fold_new(record, chat_history, self.clock(), delta)
+            return record.to_profile()
+
+    def get(self, user_id, default=None):
+        if self.backend is not None:
+            data = self.backend.get_profile(user_id)
+            return ProfileRecord.from_bytes(data).to_profile() if data else default
+        with self._lock:
+            record = self._touch(user_id, create=False)
+            return record.to_profile() if record is not None else default
+
+    def record(self, user_id):
+        with self._lock:
+            return self._touch(user_id, create=False)
+
+    def _analyze_shared(self, user_id, chat_history, delta=False):
+        now = self.clock()
+
+        def fold(data):
+            record = ProfileRecord.from_bytes(data) if data else ProfileRecord()
+            self._fold_new(record, chat_history, now, delta)
+            return record.to_bytes()
+
+        # 読み込み・畳み込み・書き込みをバックエンド側で1トランザクションとして行う
+        record = ProfileRecord.from_bytes(self.backend.update_profile(user_id, fold))
+        with self._lock:
+            record.last_access = now
+            self._records[user_id] = record
+            self._records.move_to_end(user_id)
+            self._evict()
+        if now - self._pruned_at >= PROFILE_PRUNE_INTERVAL:
+            # 共有バックエンドの表にも件数上限とTTLを効かせる（プロセス内のLRUだけでは表が増え続ける）
+            self._pruned_at = now
+            self.evictions += self.backend.prune_profiles(self.max_users, now - self.ttl)
+        return record.to_profile()
+
+    def __contains__(self, user_id):
+        return user_id in self._records
+
+    def __len__(self):
+        return len(self._records)
+
+    @property
+    def approx_bytes(self):
+        return len(self._records) * RECORD_BYTES
+
+    def _touch(self, user_id, create):
+        now = self.clock()
+        record = self._records.get(user_id)
+        if record is not None and now - record.last_access > self.ttl:
+            del self._records[user_id]
+            self.evictions += 1
+            record = None
+        if record is None:
+            if not create:
+                return None
+            record = ProfileRecord()
+            self._records[user_id] = record
+        record.last_access = now
+        self._records.move_to_end(user_id)
+        self._evict()
+        return record
+
+    def _evict(self):
+        while len(self._records) > self.max_users:
+            self._records.popitem(last=False)
+            self.evictions += 1
+
+    def _fold_new(self, record, chat_history, now, delta=False):
+        new_messages = self._new_messages(record, chat_history, delta)
+        for message, emotion in zip(new_messages, self._labels(new_messages)):
+            record.fold(message, now, emotion)
+
+    def _labels(self, messages):
+        # 感情の付いていないユーザーの発言だけを集め、ラベラーに1回のバッチで渡す
+        labels = [None] * len(messages)
+        if self.labeler is None:
+            return labels
+        pending = [
+            i for i, message in enumerate(messages)
+            if not message.get("emotion") and (message.get("role") or message.get("sender")) not in ("assistant", "ai")
+        ]
+        if pending:
+            texts = [messages[i].get("content") for i in pending]
+            for i, label in zip(pending, self.labeler.label_batch(texts)):
+                labels[i] = label
+        return labels
+
+    @staticmethod
+    def _new_messages(record, chat_history, delta=False):
+        # 履歴は時系列順なので、末尾からウォーターマークに達するまでだけを見る
+        history = chat_history or []
+        if delta:
+            # 差分はすべて新しいメッセージ。created_atのウォーターマークだけ進めておく
+            for message in history:
+                ts = _timestamp(message.get("created_at"))
+                if ts is not None and ts > record.watermark_ts:
+                    record.watermark_ts = ts
+            return list(history)
+        if history and _timestamp(history[-1].get("created_at")) is not None:
+            new_messages = []
+            for message in reversed(history):
+                ts = _timestamp(message.get("created_at"))
+                if ts is None:
+                    continue
+                if ts <= record.watermark_ts:
+                    break
+                new_messages.append(message)
+            new_messages.reverse()
+            if new_messages:
+                record.watermark_ts = _timestamp(new_messages[-1].get("created_at"))
+            return new_messages
+        # created_atもchat_idの連番も無ければ、本文で同一性は判定できない（同じ「はい」が何度も来る）。
+        # まだ何も畳み込んでいなければ全件、以降は1リクエスト＝1発言として末尾だけを新しいとみなす
+        if record.message_count == 0 and record.last_ai_ts is None:
+            return list(history)
+        return history[-1:]
+
+
+class ProfileUpdater:
+    """プロファイルの更新（感情のラベル付け＋畳み込み）をバックグラウンドのスレッドでまとめて行う
+
+    リクエスト側は submit() でキューに積むだけ。満杯なら待たずに捨てて件数を数える。
+    start() 前（テスト等）はその場で更新する。
+    """
+
+    def __init__(self, store, max_pending=PROFILE_UPDATE_QUEUE, batch_size=PROFILE_UPDATE_BATCH):
+        self.store = store
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._running = False
+        self._thread = None
+        self.stats = {"submitted": 0, "dropped": 0, "coalesced": 0, "updated": 0, "batches": 0, "errors": 0}
+
+    def submit(self, user_id, messages, delta=False):
+        if not user_id or not messages:
+            return
+        item = (user_id, list(messages), delta)
+        if self._thread is None:
+            self._update([item])
+            return
+        try:
+            self._queue.put_nowait(item)
+            self.stats["submitted"] += 1
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def run_once(self, timeout=None):
+        """キューに溜まった更新を最大 batch_size 件まとめて処理し、処理した件数を返す"""
+        try:
+            items = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return 0
+        while len(items) < self.batch_size:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        self._update(items)
+        self.stats["batches"] += 1
+        return len(items)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        # 積まれている更新は書き終えてから止める
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _loop(self):
+        while self._running or not self._queue.empty():
+            self.run_once(timeout=0.2)
+
+    def _update(self, items):
+        # 同じユーザーのcreated_at付きの全履歴が続けて積まれていれば、後の履歴に前の分が含まれるので
+        # 最後の1件だけ処理する（created_atの無い履歴は末尾の発言だけを畳み込むのでまとめない）
+        updates = []
+        last_full = {}
+        for user_id, messages, delta in items:
+            full = not delta and _timestamp(messages[-1].get("created_at")) is not None
+            if full and user_id in last_full:
+                updates[last_full[user_id]] = None
+                self.stats["coalesced"] += 1
+            updates.append((user_id, messages, delta))
+            if full:
+                last_full[user_id] = len(updates) - 1
+            else:
+                last_full.pop(user_id, None)
+        for update in updates:
+            if update is None:
+                continue
+            try:
+                self.store.analyze(*update)
+                self.stats["updated"] += 1
+            except Exception:
+                self.stats["errors"] += 1
+                logger.exception("プロファイルの更新に失敗しました: user_id=%s", update[0])
@@ -1,47 +1,153 @@
-import os
-import json
+import logging
+import threading
+import time
+from ai_edu_api.supabase_logic.profile_store import ProfileStore, ProfileUpdater
+from ai_edu_api.supabase_logic.knowledge_graph import KnowledgeGraph, KnowledgeUpdater, default_message_source
+from ai_edu_api.supabase_logic.state_backend import get_state_backend
+from ai_edu_api.supabase_logic.conversation_store import ConversationStore, InvalidSequence, SequenceConflict, parse_last_seq
+from ai_edu_api.ai_logic.emotion_labeler import emotion_labeler
 
-# Load environment variables from env.json
-env_path = os.path.join(os.path.dirname(__file__), '../../env.json')
-if os.path.exists(env_path):
-    with open(env_path, 'r') as env_file:
-        env_data = json.load(env_file)
-        # Supabase関連の環境変数を削除
-        # os.environ["SUPABASE_URL"] = env_data.get("SUPABASE_URL", "")
-        # os.environ["SUPABASE_ANON_KEY"] = env_data.get("SUPABASE_ANON_KEY", "")
+logger = logging.getLogger(__name__)
 
-SUPABASE_URL = os.environ.get("SUPABASE_URL")
-SUPABASE_KEY = os.environ.get("SUPABASE_ANON_KEY")
+# --- 独自AIエージェント: DBやOpenAIの裏で“住み着く”知識グラフ・推論エンジン ---
+# プロセスで1つだけ（get_resident_ai()）を /chat と chat_endpoint_logic で共有する。
+# 生成時は軽い状態だけを用意し、取り込み元への接続やバックグラウンドスレッドは start() で始める。
+class ResidentAIAgent:
+    def __init__(self, message_source=None, state_backend=None, conversations=None):
+        # RESIDENT_STATE_BACKEND=sqlite:///... なら複数ワーカーで状態を共有する
+        self.state_backend = state_backend or get_state_backend()
+        self.knowledge_graph = KnowledgeGraph()
+        # user_idごとの性格・傾向・感情履歴（統計のみ保持）。感情の無い発言はローカルのラベラーで付ける
+        self.user_profiles = ProfileStore(backend=self.state_backend, labeler=emotion_labeler)
+        # 応答を待たせないよう、プロファイルの更新はバックグラウンドでまとめて行う（start()で起動）
+        self.profile_updater = ProfileUpdater(self.user_profiles)
+        self.last_update = time.time()
+        self.message_source = message_source
+        # messagesテーブルの新しい行だけを取り込む増分アップデータ（start()で生成・起動）
+        self.updater = None
+        # chat_idごとの会話履歴（クライアントは新しいメッセージの差分だけを送れる）。
+        # 状態バックエンドがSQLiteなら同じファイル、メモリならローカルのSQLiteファイルに保存する
+        self.conversations = (
+            conversations if conversations is not None else ConversationStore.for_backend(self.state_backend)
+        )
 
-# Load OpenAI API key
-OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+    def start(self):
+        # 共有バックエンド使用時は、リースを取れたワーカー1つだけが取り込みを行う
+        if self.updater is None:
+            self.updater = KnowledgeUpdater(
+                self.knowledge_graph,
+                self.message_source if self.message_source is not None else default_message_source(),
+                backend=self.state_backend
+            )
+        self.updater.start()
+        self.profile_updater.start()
 
-# Example usage of OpenAI API key
-print(f"OpenAI API Key: {OPENAI_API_KEY}")
+    def stop(self):
+        if self.updater is not None:
+            self.updater.stop()
+        self.profile_updater.stop()
 
-class ResidentAIAgent:
-    def __init__(self):
-        self.user_profiles = {}
+    def update_knowledge(self):
+        if self.updater is None:
+            return
+        try:
+            rows = self.updater.run_once()
+            logger.info("知識グラフを更新しました（%d件）。", rows)
+        except Exception as e:
+            logger.error("知識グラフの更新中にエラーが発生しました: %s", e)
+        self.last_update = time.time()
+
+    def notify_new_messages(self):
+        # 新しいメッセージが書き込まれた可能性があるので、デバウンスして取り込みを要求
+        if self.updater is not None:
+            self.updater.trigger()
+
+    def get_openai_history(self, chat_id, messages, last_seq=None):
+        # 今回のリクエストで上流に送る履歴をOpenAIのmessages形式（role・contentのみ）で返す。
+        # last_seqがあればmessagesは新しいメッセージだけの差分（連番が合わなければSequenceConflict）、
+        # 無ければ全履歴。ここでは会話ストアに書き込まない（返答が得られたら record_turn で書く）
+        history = []
+        if last_seq is not None:
+            self.conversations.check_seq(chat_id, parse_last_seq(last_seq))
+            history = self.conversations.history(chat_id)
+        return [
+            {"role": message.get("role", "user"), "content": message.get("content", "")}
+            for message in history + list(messages)
+        ]
 
-    def analyze_user(self, user_id, chat_history):
+    def record_turn(self, chat_id, messages, last_seq, reply, user_id=None):
+        # ユーザーの発言とAIの返答をまとめて会話ストアに書き、クライアントが次に送るlast_seqを返す。
+        # 受付拒否・上流の失敗で返答が無ければ何も書かれないので、同じlast_seqでそのまま再送できる
+        messages = list(messages)
+        turn = messages + [{"role": "assistant", "content": reply}]
+        if last_seq is None:
+            # 全履歴の再送。この会話で保存済みの件数（連番）より後ろだけが新しい発言
+            stored = self.conversations.seq(chat_id)
+            new_messages = messages[stored:] if len(messages) > stored else messages[-1:]
+            seq = self.conversations.replace(chat_id, turn)
+        else:
+            try:
+                seq = self.conversations.append(chat_id, turn, expected_seq=parse_last_seq(last_seq))
+            except SequenceConflict as e:
+                # 同じ会話の別リクエストが先に書いた。返答は返すが保存せず、次回は全履歴で送り直してもらう
+                logger.info("会話ストアへの書き込みが競合しました: %s", e)
+                return None
+            new_messages = messages
+        if user_id:
+            # 会話ストアに新しく書いた分だけをプロファイルに畳み込む（chat_idごとの連番で判定するので、
+            # 同じ本文の発言が続いても、複数の会話を行き来しても数え間違えない）
+            self.profile_updater.submit(user_id, new_messages + turn[-1:], True)
+        return seq
+
+    def observe_messages(self, user_id, messages):
+        # chat_idの無いリクエストのプロファイルへの反映（感情のラベル付けを含む）をバックグラウンドの
+        # 更新キューに積むだけ。chat_idがあれば record_turn が新しい分だけを積む
+        self.profile_updater.submit(user_id, messages)
+
+    def analyze_user(self, user_id, chat_history, delta=False):
+        # ユーザーの話し方・頻度・時間帯・速度・感情傾向などを解析し、性格や特徴を推定
         if not chat_history:
-            print(f"[ResidentAI] No chat history provided for user_id: {user_id}")
+            logger.debug("No chat history provided for user_id: %s", user_id)
             return None
 
-        # Example logic to analyze chat history and update user profile
-        profile = {
-            "性格": "おおらか",
-            "傾向": "夜型・返信早い・ポジティブ多め",
-            "感情履歴": [msg.get("content", "") for msg in chat_history if "content" in msg]
-        }
-        self.user_profiles[user_id] = profile
-        print(f"[ResidentAI] Updated profile for user_id {user_id}: {profile}")
+        # 前回以降の新しいメッセージだけを統計に畳み込む
+        profile = self.user_profiles.analyze(user_id, chat_history, delta)
+        logger.debug("Updated profile for user_id %s: %s", user_id, profile)
         return profile
 
     def creative_thinking(self, user_input, context, user_id=None):
+        # ユーザーごとの性格・傾向・感情を参照し、独自の仮説や“この人らしい”提案を生成
         profile = self.user_profiles.get(user_id, None)
+        # TODO: 実際の連想・仮説生成ロジック
         return {
             "creative": True,
             "idea": f"{user_id}さんは{profile['性格'] if profile else 'ユニーク'}な方なので、こういう提案も面白いかも！",
             "reasoning": f"過去の傾向: {profile['傾向'] if profile else 'データ不足'}"
         } if user_id else None
+
+
+_resident_ai = None
+_resident_ai_lock = threading.Lock()
+
+
+def get_resident_ai():
+    """プロセス共有のResidentAIAgentを返す（未生成なら生成する。起動はしない）"""
+    global _resident_ai
+    if _resident_ai is None:
+        with _resident_ai_lock:
+            if _resident_ai is None:
+                _resident_ai = ResidentAIAgent()
+    return _resident_ai
+
+
+def set_resident_ai(agent):
+    global _resident_ai
+    _resident_ai = agent
+
+
+def close_resident_ai():
+    global _resident_ai
+    if _resident_ai is not None:
+        _resident_ai.stop()
+        _resident_ai.conversations.close()
+    _resident_ai = None
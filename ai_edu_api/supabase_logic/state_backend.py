@@ -0,0 +1,263 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# --- ResidentAIの状態バックエンド ---
+# プロファイル・知識グラフ・ウォーターマーク・リーダー選出を1か所にまとめる。
+# 既定はプロセス内メモリ。uvicorn --workers N で動かす場合は
+# RESIDENT_STATE_BACKEND=sqlite:///path/to/state.sqlite3 を指定して全ワーカーで共有する。
+
+RESIDENT_STATE_BACKEND = os.environ.get("RESIDENT_STATE_BACKEND", "memory")
+GRAPH_WATERMARK_KEY = "knowledge_graph_watermark"
+
+
+def make_owner_id():
+    """リーダー選出に使う、このプロセス固有のID"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class MemoryStateBackend:
+    """プロセス内メモリの状態（単一ワーカー用の既定）"""
+
+    shared = False
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._profiles = {}
+        self._profile_times = {}
+        self._terms = {}
+        self._pairs = {}
+        self._values = {}
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def update_profile(self, user_id, update):
+        with self._lock:
+            data = update(self._profiles.get(user_id))
+            self._profiles[user_id] = data
+            self._profile_times[user_id] = self.clock()
+            return data
+
+    def get_profile(self, user_id):
+        with self._lock:
+            return self._profiles.get(user_id)
+
+    def prune_profiles(self, max_users, older_than):
+        with self._lock:
+            ranked = sorted(self._profile_times.items(), key=lambda item: item[1], reverse=True)
+            stale = [user_id for i, (user_id, at) in enumerate(ranked) if i >= max_users or at < older_than]
+            for user_id in stale:
+                del self._profiles[user_id]
+                del self._profile_times[user_id]
+            return len(stale)
+
+    def apply_graph_delta(self, term_deltas, pair_deltas, watermark=None):
+        with self._lock:
+            for term, count in term_deltas.items():
+                self._terms[term] = self._terms.get(term, 0) + count
+            for pair, count in pair_deltas.items():
+                self._pairs[pair] = self._pairs.get(pair, 0) + count
+            self._values["graph_version"] = self._values.get("graph_version", 0) + 1
+            if watermark is not None:
+                self._values[GRAPH_WATERMARK_KEY] = dict(watermark)
+
+    def load_graph(self):
+        with self._lock:
+            return dict(self._terms), dict(self._pairs)
+
+    def graph_version(self):
+        with self._lock:
+            return self._values.get("graph_version", 0)
+
+    def get_value(self, name):
+        with self._lock:
+            return self._values.get(name)
+
+    def set_value(self, name, value):
+        with self._lock:
+            self._values[name] = value
+
+    def try_acquire_leader(self, role, owner, ttl):
+        with self._lock:
+            now = self.clock()
+            holder = self._leases.get(role)
+            if holder is None or holder[0] == owner or holder[1] <= now:
+                self._leases[role] = (owner, now + ttl)
+                return True
+            return False
+
+    def release_leader(self, role, owner):
+        with self._lock:
+            if self._leases.get(role, (None,))[0] == owner:
+                del self._leases[role]
+
+
+class SQLiteStateBackend:
+    """WALモードのSQLiteファイルで状態をワーカー間共有する"""
+
+    shared = True
+
+    def __init__(self, path, clock=time.time, busy_timeout=5.0):
+        self.path = path
+        self.clock = clock
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        with self._transaction() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS profiles (user_id TEXT PRIMARY KEY, data BLOB NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS kg_terms (term TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kg_pairs (a TEXT NOT NULL, b TEXT NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (a, b))"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases (role TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def _conn(self):
+        # sqlite3の接続はスレッドごとに持つ
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        # 書き込みロックを最初に取り、読み込み〜書き込みを他ワーカーと直列化する
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def update_profile(self, user_id, update):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT data FROM profiles WHERE user_id = ?", (user_id,)).fetchone()
+            data = update(row[0] if row else None)
+            conn.execute(
+                "INSERT INTO profiles (user_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                (user_id, data, self.clock()),
+            )
+            return data
+
+    def get_profile(self, user_id):
+        row = self._conn().execute("SELECT data FROM profiles WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def prune_profiles(self, max_users, older_than):
+        """更新がolder_thanより古いプロファイルと、新しい順にmax_users件を超えた分を消し、消した件数を返す"""
+        with self._transaction() as conn:
+            removed = conn.execute("DELETE FROM profiles WHERE updated_at < ?", (older_than,)).rowcount
+            removed += conn.execute(
+                "DELETE FROM profiles WHERE user_id NOT IN "
+                "(SELECT user_id FROM profiles ORDER BY updated_at DESC LIMIT ?)",
+                (max_users,),
+            ).rowcount
+            return removed
+
+    def apply_graph_delta(self, term_deltas, pair_deltas, watermark=None):
+        """グラフの差分とウォーターマークを1トランザクションで反映する（二重計上を防ぐ）"""
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT INTO kg_terms (term, count) VALUES (?, ?) "
+                "ON CONFLICT(term) DO UPDATE SET count = count + excluded.count",
+                term_deltas.items(),
+            )
+            conn.executemany(
+                "INSERT INTO kg_pairs (a, b, count) VALUES (?, ?, ?) "
+                "ON CONFLICT(a, b) DO UPDATE SET count = count + excluded.count",
+                [(a, b, count) for (a, b), count in pair_deltas.items()],
+            )
+            version = self._get_value(conn, "graph_version") or 0
+            self._set_value(conn, "graph_version", version + 1)
+            if watermark is not None:
+                self._set_value(conn, GRAPH_WATERMARK_KEY, dict(watermark))
+
+    def load_graph(self):
+        conn = self._conn()
+        terms = dict(conn.execute("SELECT term, count FROM kg_terms").fetchall())
+        pairs = {(a, b): count for a, b, count in conn.execute("SELECT a, b, count FROM kg_pairs")}
+        return terms, pairs
+
+    def graph_version(self):
+        return self.get_value("graph_version") or 0
+
+    def get_value(self, name):
+        return self._get_value(self._conn(), name)
+
+    def set_value(self, name, value):
+        with self._transaction() as conn:
+            self._set_value(conn, name, value)
+
+    def try_acquire_leader(self, role, owner, ttl):
+        """リースが空いている・期限切れ・自分が保持中なら取得（更新）してTrueを返す"""
+        with self._transaction() as conn:
+            now = self.clock()
+            row = conn.execute("SELECT owner, expires_at FROM leases WHERE role = ?", (role,)).fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO leases (role, owner, expires_at) VALUES (?, ?, ?)",
+                (role, owner, now + ttl),
+            )
+            return True
+
+    def release_leader(self, role, owner):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM leases WHERE role = ? AND owner = ?", (role, owner))
+
+    @staticmethod
+    def _get_value(conn, name):
+        row = conn.execute("SELECT value FROM kv WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @staticmethod
+    def _set_value(conn, name, value):
+        conn.execute("INSERT OR REPLACE INTO kv (name, value) VALUES (?, ?)", (name, json.dumps(value)))
+
+
+class BackendWatermarkStore:
+    """知識グラフのハイウォーターマークを状態バックエンドに保存する"""
+
+    def __init__(self, backend, name=GRAPH_WATERMARK_KEY):
+        self.backend = backend
+        self.name = name
+
+    def load(self):
+        return dict(self.backend.get_value(self.name) or {})
+
+    def save(self, watermark):
+        self.backend.set_value(self.name, dict(watermark))
+
+
+def make_state_backend(url=RESIDENT_STATE_BACKEND):
+    """'memory' または 'sqlite:///path' からバックエンドを生成する"""
+    if url.startswith("sqlite:///"):
+        return SQLiteStateBackend(url[len("sqlite:///"):])
+    if url in ("", "memory"):
+        return MemoryStateBackend()
+    raise ValueError(f"Unknown RESIDENT_STATE_BACKEND: {url}")
+
+
+_state_backend = None
+
+
+def get_state_backend():
+    """プロセス共有の状態バックエンドを返す"""
+    global _state_backend
+    if _state_backend is None:
+        _state_backend = make_state_backend()
+    return _state_backend
@@ -0,0 +1,38 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import pytest
+
+# テストでは作業ディレクトリに会話の保存ファイル（既定の CONVERSATION_STORE_PATH）を作らない
+os.environ.setdefault("CONVERSATION_STORE_PATH", "")
+
+
+class FakeClock:
+    """テスト用の時計（clock引数に渡し、now を進めて時間の経過を再現する）"""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FakeStream:
+    """ストリーミング補完の代わりに、トークンを1つずつ返す非同期イテレータ"""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for token in self.tokens:
+            await asyncio.sleep(0)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))])
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
@@ -0,0 +1,60 @@
+import json
+
+from fastapi.testclient import TestClient
+
+from ai_edu_api.benchmarks.mock_openai import MockSettings, create_app
+from ai_edu_api.benchmarks.run_benchmark import percentile, summarize
+
+
+def make_client(**kwargs):
+    settings = MockSettings(latency=0, jitter=0, token_rate=0, seed=1, **kwargs)
+    return TestClient(create_app(settings)), settings
+
+
+def test_percentile_interpolates():
+    values = [0.4, 0.1, 0.3, 0.2, 0.5]
+    assert percentile(values, 50) == 0.3
+    assert abs(percentile(values, 95) - 0.48) < 1e-9
+    assert percentile([], 50) is None
+
+
+def test_summarize_reports_throughput_errors_and_ttft():
+    samples = [{"ok": True, "latency": 0.1 * i, "ttft": 0.05} for i in range(1, 5)]
+    samples.append({"ok": False, "latency": 1.0, "ttft": None})
+    summary = summarize(samples, elapsed=2.0)
+    assert summary["requests"] == 5
+    assert summary["errors"] == 1
+    assert summary["throughput_rps"] == 2.0
+    assert summary["latency_ms"]["p50"] == 250.0
+    assert summary["ttft_ms"]["p99"] == 50.0
+
+
+def test_mock_returns_quiz_array_for_problem_prompt():
+    client, _ = make_client()
+    response = client.post("/v1/chat/completions", json={
+        "model": "gpt-4o",
+        "messages": [{"role": "system", "content": "以下の条件で **3問** の問題を出題してください。"}],
+    })
+    problems = json.loads(response.json()["choices"][0]["message"]["content"])
+    assert len(problems) == 3
+    assert problems[0]["answer"] in problems[0]["options"]
+
+
+def test_mock_streams_json_reply_and_injects_errors():
+    client, settings = make_client()
+    response = client.post("/v1/chat/completions", json={
+        "model": "gpt-4o", "stream": True, "messages": [{"role": "user", "content": "こんにちは"}],
+        "response_format": {"type": "json_object"},
+    })
+    chunks = [line[6:] for line in response.text.split("\n") if line.startswith("data: ")]
+    assert chunks[-1] == "[DONE]"
+    content = "".join(json.loads(c)["choices"][0]["delta"].get("content", "") for c in chunks[:-1])
+    assert set(json.loads(content)) == {"reply", "emotion"}
+
+    # JSONモードでなければ通常会話はプレーンテキスト
+    plain = client.post("/v1/chat/completions", json={"messages": [{"role": "user", "content": "こんにちは"}]})
+    assert plain.json()["choices"][0]["message"]["content"].startswith("練習")
+
+    settings.error_rate = 1.0
+    assert client.post("/v1/chat/completions", json={"messages": []}).status_code == 500
+    assert settings.stats == {"requests": 3, "streams": 1, "errors": 1}
@@ -1,22 +1,54 @@
+import asyncio
+import json
+from types import SimpleNamespace
+from unittest.mock import patch
+
 import pytest
+from ai_edu_api.api_endpoints import chat_endpoints
 from ai_edu_api.api_endpoints.chat_endpoints import chat_endpoint_logic
-from unittest.mock import patch
+from ai_edu_api.ai_logic.context_builder import ContextBuilder
+
+
+class FakeUpstream:
+    def __init__(self):
+        self.calls = []
+
+    async def complete(self, **kwargs):
+        self.calls.append(kwargs)
+        message = SimpleNamespace(content="元気です、嬉しいです！")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
 
 @pytest.fixture
-def mock_resident_ai_agent():
-    with patch("ai_edu_api.supabase_logic.resident_ai_agent.ResidentAIAgent") as MockAgent:
-        instance = MockAgent.return_value
-        instance.get_chat_history_from_supabase.return_value = [
-            {"role": "user", "content": "Hello!"},
-            {"role": "assistant", "content": "Hi there!"}
-        ]
-        yield instance
-
-def test_full_messages_structure(mock_resident_ai_agent):
-    chat_id = "test_chat_id"
-    messages = [{"role": "user", "content": "How are you?"}]
-
-    result = chat_endpoint_logic(chat_id, messages)
-
-    assert "以下はこれまでの会話の文脈です" in result[0]["content"]
-    assert len(result) == 3
+def mock_upstream():
+    upstream = FakeUpstream()
+    with patch.object(chat_endpoints, "get_upstream", return_value=upstream), \
+            patch.object(chat_endpoints, "context_builder", ContextBuilder(token_budget=120, summary_tokens=60)):
+        yield upstream
+
+
+def test_full_messages_structure(mock_upstream):
+    history = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"これは{i}番目の長めのメッセージです。" * 3}
+        for i in range(10)
+    ]
+    messages = history + [{"role": "user", "content": "How are you?"}]
+
+    response = asyncio.run(chat_endpoint_logic({
+        "chat_id": "test_chat_id",
+        "user_id": "test_user",
+        "messages": messages,
+    }))
+
+    sent = mock_upstream.calls[0]["messages"]
+    assert "以下はこれまでの会話の文脈です" in sent[0]["content"]
+    assert sent[-1]["content"] == "How are you?"
+    # 同じ履歴が二重に送られないこと
+    contents = [m["content"] for m in sent[1:]]
+    assert len(contents) == len(set(contents))
+    assert int(response.headers["X-Context-Tokens-Saved"]) > 0
+    # 返答はプレーンテキストで受け取り、感情ラベルはローカルで付ける
+    assert "response_format" not in mock_upstream.calls[0]
+    body = json.loads(response.body)
+    assert body["reply"] == "元気です、嬉しいです！"
+    assert body["emotion"] == "喜び"
@@ -0,0 +1,118 @@
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from fastapi.testclient import TestClient
+
+from ai_edu_api import main
+from ai_edu_api.ai_logic.context_builder import ContextBuilder, count_tokens, dedupe_messages
+from ai_edu_api.ai_logic.upstream import set_upstream
+
+
+def make_history(n):
+    return [{"role": "user", "content": f"質問{i}です。" * 5} for i in range(n)]
+
+
+def test_dedupe_messages_by_identity():
+    history = make_history(3)
+    merged = dedupe_messages(history, list(history), [{"role": "user", "content": "新しい質問"}])
+
+    assert len(merged) == 4
+
+
+def test_repeated_short_replies_are_not_collapsed():
+    history = [
+        {"role": "user", "content": "はい"},
+        {"role": "assistant", "content": "次の問題です"},
+        {"role": "user", "content": "はい"},
+        {"role": "assistant", "content": "次の問題です"},
+        {"role": "user", "content": "はい"},
+    ]
+    context = ContextBuilder().build("x", history)
+
+    # 同じ本文の発言が続いても1つの履歴の中ではまとめず、最後のユーザーの発言で終わる
+    assert len(context.messages) == 5
+    assert context.messages[-1] is history[-1]
+
+    # 別のリストとの重なりは同じオブジェクトか同じidのときだけ除く
+    stored = [{"role": "user", "content": "ok", "id": 1}, {"role": "assistant", "content": "ok", "id": 2}]
+    client = [{"role": "user", "content": "ok", "id": 1}, {"role": "user", "content": "ok"}]
+    merged = dedupe_messages(stored, client)
+    assert [m.get("id") for m in merged] == [1, 2, None]
+    assert merged[-1] is client[-1]
+
+
+def test_build_respects_token_budget_and_keeps_latest():
+    builder = ContextBuilder(token_budget=100, summary_tokens=40)
+    history = make_history(20)
+
+    context = builder.build("chat", history, history)
+
+    assert context.messages[-1] is history[-1]
+    assert context.sent_tokens <= 100
+    assert context.saved_tokens > 0
+    assert context.summary
+
+
+def test_rolling_summary_is_updated_incrementally():
+    builder = ContextBuilder(token_budget=100, summary_tokens=1000)
+    history = make_history(10)
+    builder.build("chat", history)
+    folded = builder._summaries["chat"].folded
+    first_lines = list(builder._summaries["chat"].lines)
+
+    history.append({"role": "user", "content": "追加の質問です。" * 5})
+    second = builder.build("chat", history)
+
+    # 前回までの行はそのまま、新しく古くなった分だけが追加される
+    assert builder._summaries["chat"].folded > folded
+    assert builder._summaries["chat"].lines[:len(first_lines)] == first_lines
+    assert len(builder._summaries["chat"].lines) > len(first_lines)
+    assert second.summary.startswith("話題: 質問")
+
+
+def test_summary_keeps_topics_of_dropped_lines():
+    builder = ContextBuilder(token_budget=60, summary_tokens=40)
+    history = [
+        {"role": "user", "content": "関係代名詞のwhichとthatの違いを教えてください。例文もお願いします。"},
+        {"role": "assistant", "content": "whichは非制限用法でも使えます。thatは使えません。"},
+    ] + [{"role": "user", "content": f"次の質問{i}です。"} for i in range(12)]
+
+    summary = builder.build("chat", history).summary
+
+    # 行は予算内に畳まれても、古いターンの話題は残り、各行は最初の一文だけになる
+    assert "関係代名詞" in summary.splitlines()[0]
+    assert "それ以前の" in summary
+    assert "例文もお願いします" not in summary
+
+
+def test_chat_route_sends_budgeted_context():
+    class RecordingUpstream:
+        def __init__(self):
+            self.calls = []
+
+        async def complete(self, **kwargs):
+            self.calls.append(kwargs)
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="了解です"))])
+
+    upstream = RecordingUpstream()
+    history = make_history(30)
+    set_upstream(upstream)
+    try:
+        with patch.object(main, "context_builder", ContextBuilder(token_budget=200, summary_tokens=80)):
+            response = TestClient(main.app).post("/chat", json={"messages": history})
+    finally:
+        set_upstream(None)
+
+    assert response.status_code == 200
+    sent = upstream.calls[0]["messages"]
+    # /chat も全履歴ではなく、要約入りのシステムプロンプト＋予算内の直近メッセージだけを送る
+    assert sent[0]["role"] == "system" and "話題:" in sent[0]["content"]
+    assert 1 <= len(sent) - 1 < len(history)
+    assert sent[-1]["content"] == history[-1]["content"]
+    assert sum(count_tokens(m["content"]) for m in sent[1:]) <= 200
+
+
+def test_count_tokens():
+    assert count_tokens("") == 0
+    assert count_tokens("こんにちは") == 5
+    assert count_tokens("hello world") == 4
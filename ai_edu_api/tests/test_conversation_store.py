@@ -0,0 +1,175 @@
+import asyncio
+import json
+from unittest.mock import patch
+
+import pytest
+from fastapi.testclient import TestClient
+from ai_edu_api.api_endpoints import chat_endpoints
+from ai_edu_api.api_endpoints.chat_endpoints import chat_endpoint_logic
+from ai_edu_api.ai_logic.context_builder import ContextBuilder
+from ai_edu_api.ai_logic.upstream_scheduler import UpstreamRateLimited
+from ai_edu_api import main
+from ai_edu_api.supabase_logic.conversation_store import ConversationStore, InvalidSequence, SequenceConflict, parse_last_seq
+from ai_edu_api.supabase_logic.resident_ai_agent import ResidentAIAgent, get_resident_ai
+from ai_edu_api.supabase_logic.state_backend import MemoryStateBackend, SQLiteStateBackend
+from ai_edu_api.tests.test_chat_endpoint_logic import FakeUpstream
+
+
+def user(text):
+    return {"role": "user", "content": text}
+
+
+def test_append_returns_seq_and_rejects_stale_last_seq():
+    store = ConversationStore(path=None)
+    assert store.append("c1", [user("a"), user("b")]) == 2
+    assert store.append("c1", [user("c")], expected_seq=2) == 3
+
+    with pytest.raises(SequenceConflict) as info:
+        store.append("c1", [user("d")], expected_seq=2)
+    assert info.value.current_seq == 3
+    assert [m["content"] for m in store.history("c1")] == ["a", "b", "c"]
+
+
+def test_replace_resets_history_and_seq():
+    store = ConversationStore(path=None)
+    store.append("c1", [user("a"), user("b"), user("c")])
+    assert store.replace("c1", [user("x")]) == 1
+    assert store.history("c1") == [user("x")]
+
+
+def test_keeps_recent_messages_and_evicts_oldest_chat():
+    store = ConversationStore(path=None, max_chats=2, max_messages=3)
+    store.append("c1", [user(str(i)) for i in range(5)])
+    assert [m["content"] for m in store.history("c1")] == ["2", "3", "4"]
+    assert store.seq("c1") == 5
+
+    store.append("c2", [user("b")])
+    store.append("c3", [user("c")])
+    assert len(store) == 2
+    assert store.seq("c1") == 0  # メモリのみなので追い出された会話は消える
+
+    small = ConversationStore(path=None, max_bytes=200)
+    small.append("c1", [user("あ" * 30)])
+    small.append("c2", [user("い" * 30)])
+    assert small.size_bytes <= 200
+    assert small.history("c1") == []
+
+
+def test_sqlite_store_is_shared_between_workers(tmp_path):
+    path = str(tmp_path / "conversations.sqlite3")
+    first = ConversationStore(path=path)
+    second = ConversationStore(path=path)
+    try:
+        assert first.append("c1", [user("a")]) == 1
+        # 別ワーカーが続きを追加しても、連番と履歴はSQLite側で揃う
+        assert second.append("c1", [user("b")], expected_seq=1) == 2
+        assert [m["content"] for m in first.history("c1")] == ["a", "b"]
+        with pytest.raises(SequenceConflict):
+            first.append("c1", [user("c")], expected_seq=1)
+    finally:
+        first.close()
+        second.close()
+
+    reopened = ConversationStore(path=path, max_chats=1)
+    try:
+        assert reopened.seq("c1") == 2
+        reopened.append("c2", [user("x")])
+        # メモリ層から追い出されてもディスクから読み直せる
+        assert [m["content"] for m in reopened.history("c1")] == ["a", "b"]
+    finally:
+        reopened.close()
+
+
+def test_agents_share_conversations_through_sqlite_state_backend(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    worker_a = ResidentAIAgent(state_backend=SQLiteStateBackend(path))
+    worker_b = ResidentAIAgent(state_backend=SQLiteStateBackend(path))
+    try:
+        seq = worker_a.record_turn("c1", [user("こんにちは")], None, "こんにちは！")
+        # 別ワーカーに届いた差分も、同じ連番で受け付けられる
+        assert worker_b.get_openai_history("c1", [user("元気？")], seq)[-1]["content"] == "元気？"
+        assert worker_b.record_turn("c1", [user("元気？")], seq, "元気です") == seq + 2
+        assert worker_a.conversations.seq("c1") == seq + 2
+    finally:
+        worker_a.conversations.close()
+        worker_b.conversations.close()
+
+
+
+def test_memory_backend_persists_conversations_to_default_path(tmp_path):
+    path = str(tmp_path / "conversations.sqlite3")
+    store = ConversationStore.for_backend(MemoryStateBackend(), default_path=path)
+    seq = store.append("c1", [user("こんにちは")])
+    store.close()
+
+    # スリープ・再起動の後も、差分の last_seq をそのまま受け付けられる
+    reopened = ConversationStore.for_backend(MemoryStateBackend(), default_path=path)
+    assert reopened.check_seq("c1", seq) == seq
+    reopened.close()
+    assert ConversationStore.for_backend(MemoryStateBackend(), default_path="")._disk is None
+
+
+def test_parse_last_seq():
+    assert parse_last_seq(None) is None
+    assert parse_last_seq(3) == parse_last_seq("3") == parse_last_seq(3.0) == 3
+    for value in ("abc", "", -1, 1.5, True, [1], {"seq": 1}):
+        with pytest.raises(InvalidSequence):
+            parse_last_seq(value)
+
+
+@pytest.fixture
+def mock_upstream():
+    upstream = FakeUpstream()
+    with patch.object(chat_endpoints, "get_upstream", return_value=upstream), \
+            patch.object(chat_endpoints, "context_builder", ContextBuilder(token_budget=10000)), \
+            patch.object(get_resident_ai(), "conversations", ConversationStore(path=None)):
+        yield upstream
+
+
+def test_chat_endpoint_accepts_deltas(mock_upstream):
+    chat_id = "delta_chat"
+    first = asyncio.run(chat_endpoint_logic({"chat_id": chat_id, "user_id": "u1", "messages": [user("こんにちは")]}))
+    seq = json.loads(first.body)["seq"]
+    assert seq == 2  # ユーザーの発言＋AIの返答
+
+    second = asyncio.run(chat_endpoint_logic({"chat_id": chat_id, "user_id": "u1", "last_seq": seq, "messages": [user("元気？")]}))
+    sent = mock_upstream.calls[-1]["messages"]
+    assert [m["content"] for m in sent[1:]] == ["こんにちは", "元気です、嬉しいです！", "元気？"]
+    assert json.loads(second.body)["seq"] == 4
+
+    stale = asyncio.run(chat_endpoint_logic({"chat_id": chat_id, "user_id": "u1", "last_seq": seq, "messages": [user("もう一度")]}))
+    assert stale.status_code == 409
+    assert json.loads(stale.body)["seq"] == 4
+
+
+
+def test_failed_request_leaves_no_turn_and_can_be_retried(mock_upstream):
+    chat_id = "retry_chat"
+    first = asyncio.run(chat_endpoint_logic({"chat_id": chat_id, "user_id": "u1", "messages": [user("こんにちは")]}))
+    seq = json.loads(first.body)["seq"]
+
+    # 受付拒否（429/503）・上流の失敗では発言を会話ストアに書かない
+    with patch.object(chat_endpoints, "admit_upstream", side_effect=UpstreamRateLimited("busy")):
+        with pytest.raises(UpstreamRateLimited):
+            asyncio.run(chat_endpoint_logic({"chat_id": chat_id, "user_id": "u1", "last_seq": seq, "messages": [user("元気？")]}))
+    assert get_resident_ai().conversations.seq(chat_id) == seq
+
+    # 同じ last_seq・同じ差分の再送は409にならず、発言も1回だけ残る
+    retried = asyncio.run(chat_endpoint_logic({"chat_id": chat_id, "user_id": "u1", "last_seq": seq, "messages": [user("元気？")]}))
+    assert retried.status_code == 200
+    assert json.loads(retried.body)["seq"] == seq + 2
+    assert [m["content"] for m in get_resident_ai().conversations.history(chat_id)] == [
+        "こんにちは", "元気です、嬉しいです！", "元気？", "元気です、嬉しいです！"
+    ]
+
+
+def test_non_numeric_last_seq_is_rejected_with_400(mock_upstream):
+    request = {"chat_id": "bad_seq", "user_id": "u1", "last_seq": "abc", "messages": [user("元気？")]}
+
+    response = asyncio.run(chat_endpoint_logic(request))
+    assert response.status_code == 400
+
+    response = TestClient(main.app).post("/chat", json=request)
+    assert response.status_code == 400
+    assert "last_seq" in response.json()["error"]
+    assert mock_upstream.calls == []
@@ -0,0 +1,91 @@
+from ai_edu_api.ai_logic.emotion_labeler import EmotionLabeler, emotion_labeler
+from ai_edu_api.benchmarks.emotion_benchmark import evaluate, load_fixture, measure_throughput
+from ai_edu_api.supabase_logic.profile_store import ProfileStore, ProfileUpdater
+
+
+def test_labels_lexicon_stems_and_negation():
+    assert emotion_labeler.label("やったー！英検に合格した！") == "喜び"
+    assert emotion_labeler.label("イライラする") == "怒り"
+    assert emotion_labeler.label("えっ、本当に？！") == "驚き"
+    assert emotion_labeler.label("寂しかった") == "悲しみ"
+    assert emotion_labeler.label("ありがとう、助かりました") == "ポジティブ"
+    # 直後の否定・英語の否定で極性が反転する
+    assert emotion_labeler.label("全然楽しくない") == "ネガティブ"
+    assert emotion_labeler.label("I am not happy") == "ネガティブ"
+    assert emotion_labeler.label("難しくないね") != "ネガティブ"
+    # 手がかりが無い・英単語の途中だけならニュートラル
+    assert emotion_labeler.label("過去完了形について教えてください") == "ニュートラル"
+    assert emotion_labeler.label("what does this function return") == "ニュートラル"
+    assert emotion_labeler.label(None) == "ニュートラル"
+
+
+def test_normalizes_width_and_case():
+    assert emotion_labeler.label("ＨＡＰＰＹ") == "喜び"
+    assert emotion_labeler.label("ｳﾚｼｲ") == emotion_labeler.label("ウレシイ")
+
+
+def test_batch_matches_single_labels():
+    texts = ["嬉しい", "", "悲しい😢", "次の問題", "ムカつく", "びっくり"]
+    assert emotion_labeler.label_batch(texts) == [emotion_labeler.label(text) for text in texts]
+    assert emotion_labeler.label_batch([]) == []
+
+
+def test_fixture_accuracy_and_throughput():
+    rows = load_fixture()
+    report = evaluate(EmotionLabeler(), rows)
+    assert report["examples"] == len(rows) >= 70
+    assert report["accuracy"] >= 0.9
+    assert len(report["errors"]) == round(len(rows) * (1 - report["accuracy"]))
+
+    throughput = measure_throughput(emotion_labeler, [row["text"] for row in rows], batch_size=64, repeat=1)
+    assert throughput["batch"]["batch_size"] == 64
+    assert throughput["single"]["messages_per_second"] > 0
+
+
+class CountingLabeler:
+    def __init__(self):
+        self.batches = []
+
+    def label_batch(self, texts):
+        self.batches.append(list(texts))
+        return ["驚き"] * len(texts)
+
+
+def test_profile_store_labels_only_new_user_messages_in_one_batch():
+    labeler = CountingLabeler()
+    store = ProfileStore(labeler=labeler)
+    history = [
+        {"role": "user", "content": "a"},
+        {"role": "assistant", "content": "b"},
+        {"role": "user", "content": "c", "emotion": "喜び"},
+    ]
+    store.analyze("u1", history)
+    history.append({"role": "user", "content": "d"})
+    profile = store.analyze("u1", history)
+
+    # AIの返答・感情付きの発言はラベラーに渡さず、2回目は新しい発言だけ
+    assert labeler.batches == [["a"], ["d"]]
+    assert profile["感情履歴"] == ["驚き", "喜び", "驚き"]
+
+
+def test_delta_messages_are_all_folded():
+    store = ProfileStore(labeler=CountingLabeler())
+    store.analyze("u1", [{"role": "user", "content": "a"}], delta=True)
+    store.analyze("u1", [{"role": "user", "content": "b"}], delta=True)
+    assert store.record("u1").message_count == 2
+
+
+def test_profile_updater_folds_in_background_and_coalesces():
+    store = ProfileStore(labeler=emotion_labeler)
+    updater = ProfileUpdater(store)
+    updater.start()
+    history = []
+    for text in ("嬉しい", "悲しい", "こんにちは"):
+        history.append({"role": "user", "content": text})
+        updater.submit("u1", history)
+    updater.stop()
+
+    assert store.get("u1")["感情履歴"] == ["喜び", "悲しみ", "ニュートラル"]
+    stats = updater.stats
+    assert stats["updated"] + stats["coalesced"] == stats["submitted"] == 3
+    assert updater.queue_depth == 0
@@ -0,0 +1,103 @@
+import time
+from types import SimpleNamespace
+
+from ai_edu_api.ai_logic.metrics import KNOWLEDGE_BATCH_SECONDS, registry
+from ai_edu_api.supabase_logic.knowledge_graph import (
+    FileWatermarkStore,
+    KnowledgeGraph,
+    KnowledgeUpdater,
+    SQLiteMessageSource,
+    SupabaseMessageSource,
+    extract_terms,
+)
+
+
+def make_rows(start, n):
+    return [
+        {
+            "id": f"m{i:05d}",
+            "chat_id": "c1",
+            "sender": "user",
+            "content": "英語 の 長文読解 と 語彙力 について",
+            "created_at": f"2025-06-01T00:{i // 60:02d}:{i % 60:02d}+00:00",
+        }
+        for i in range(start, start + n)
+    ]
+
+
+def test_extract_terms():
+    assert extract_terms("英語の長文読解とGrammarとGrammar") == ["英語", "長文読解", "grammar"]
+
+
+def test_run_once_ingests_in_batches_and_persists_watermark(tmp_path):
+    source = SQLiteMessageSource(str(tmp_path / "messages.sqlite3"))
+    source.insert(make_rows(0, 25))
+    watermark_path = str(tmp_path / "watermark.json")
+    graph = KnowledgeGraph()
+    updater = KnowledgeUpdater(graph, source, FileWatermarkStore(watermark_path), batch_size=10)
+
+    batches_before = KNOWLEDGE_BATCH_SECONDS.count()
+    assert updater.run_once() == 25
+    assert updater.stats["batches"] == 3
+    assert updater.stats["lag_seconds"] == 0.0
+    # 遅れとバッチの所要時間は /metrics に出る
+    assert KNOWLEDGE_BATCH_SECONDS.count() == batches_before + 3
+    assert "knowledge_graph_lag_seconds 0.0" in registry.render()
+    assert graph.term_counts["英語"] == 25
+    assert graph.neighbors("英語")[0] == ("語彙力", 25)
+
+    # 再起動後はウォーターマーク以降の行だけを取り込む
+    source.insert(make_rows(25, 5))
+    restarted = KnowledgeUpdater(graph, source, FileWatermarkStore(watermark_path), batch_size=10)
+    assert restarted.run_once() == 5
+    assert graph.term_counts["英語"] == 30
+
+
+class FakeSupabaseQuery:
+    """呼ばれたフィルタを記録するだけのSupabaseクライアントの代わり"""
+
+    def __init__(self):
+        self.calls = []
+
+    def table(self, name):
+        return self
+
+    def __getattr__(self, name):
+        def record(*args, **kwargs):
+            self.calls.append((name,) + args)
+            return self
+        return record
+
+    def execute(self):
+        return SimpleNamespace(data=[])
+
+
+def test_supabase_source_filters_watermark_in_query():
+    client = FakeSupabaseQuery()
+    source = SupabaseMessageSource(client=client)
+    watermark = {"created_at": "2025-06-01T00:00:00.5+00:00", "id": "m00010"}
+
+    assert source.fetch_after(watermark, 100) == []
+
+    # 同じcreated_atの行がlimit件以上あっても次のidへ進めるよう、(created_at, id) の比較はクエリ側で行う
+    assert ("or_", 'created_at.gt."2025-06-01T00:00:00.5+00:00",'
+                   'and(created_at.eq."2025-06-01T00:00:00.5+00:00",id.gt."m00010")') in client.calls
+    assert ("limit", 100) in client.calls
+    assert not any(call[0] == "gte" for call in client.calls)
+
+
+def test_trigger_is_debounced(tmp_path):
+    source = SQLiteMessageSource(str(tmp_path / "messages.sqlite3"))
+    updater = KnowledgeUpdater(KnowledgeGraph(), source, debounce=0.05, interval=60)
+    updater.start()
+    try:
+        time.sleep(0.05)
+        runs = updater.stats["runs"]
+        source.insert(make_rows(0, 3))
+        for _ in range(5):
+            updater.trigger()
+        time.sleep(0.3)
+        assert updater.stats["runs"] == runs + 1
+        assert updater.stats["rows"] == 3
+    finally:
+        updater.stop()
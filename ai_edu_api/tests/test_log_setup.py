@@ -0,0 +1,78 @@
+import logging
+import queue
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from ai_edu_api.ai_logic.log_setup import (
+    CorrelationIdMiddleware,
+    NonBlockingQueueHandler,
+    SafeFormatter,
+    SamplingFilter,
+    parse_sample_rates,
+    redact,
+    request_id_var,
+    truncate,
+)
+
+
+def make_record(msg, *args, level=logging.INFO):
+    return logging.LogRecord("ai_edu_api.test", level, __file__, 1, msg, args, None)
+
+
+def test_redact_and_truncate():
+    text = redact('key=sk-abcdefghijklmnop Authorization: Bearer abc.def "api_key": "secret123"')
+    assert "sk-abcdefghijklmnop" not in text
+    assert "abc.def" not in text
+    assert "secret123" not in text
+    assert truncate("あ" * 10, 4) == "ああああ…(+6文字)"
+
+
+def test_sampling_filter_per_level():
+    rates = parse_sample_rates("DEBUG=0.25,INFO=1,bogus=0.5")
+    assert rates == {logging.DEBUG: 0.25, logging.INFO: 1.0}
+    values = iter([0.1, 0.9, 0.2, 0.5])
+    sampling = SamplingFilter(rates, rand=lambda: next(values))
+    kept = [sampling.filter(make_record("x", level=logging.DEBUG)) for _ in range(4)]
+    assert kept == [True, False, True, False]
+    assert sampling.dropped == 2
+    assert sampling.filter(make_record("x", level=logging.ERROR))
+
+
+def test_queue_handler_defers_formatting_and_drops_when_full():
+    class Expensive:
+        formatted = 0
+
+        def __str__(self):
+            Expensive.formatted += 1
+            return "payload"
+
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=1))
+    token = request_id_var.set("req-1")
+    try:
+        handler.handle(make_record("data: %s", Expensive()))
+        handler.handle(make_record("data: %s", Expensive()))
+    finally:
+        request_id_var.reset(token)
+
+    assert Expensive.formatted == 0  # 呼び出し側では整形しない
+    assert handler.dropped == 1
+    record = handler.queue.get_nowait()
+    assert SafeFormatter(fmt="[%(request_id)s] %(message)s").format(record) == "[req-1] data: payload"
+    assert Expensive.formatted == 1
+
+
+def test_correlation_id_middleware():
+    app = FastAPI()
+    app.add_middleware(CorrelationIdMiddleware)
+
+    @app.get("/")
+    async def index():
+        return {"request_id": request_id_var.get()}
+
+    client = TestClient(app)
+    response = client.get("/")
+    assert response.headers["x-request-id"] == response.json()["request_id"] != "-"
+    response = client.get("/", headers={"X-Request-ID": "from-client"})
+    assert response.json()["request_id"] == "from-client"
+    assert response.headers["x-request-id"] == "from-client"
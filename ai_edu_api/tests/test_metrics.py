@@ -0,0 +1,60 @@
+from fastapi.testclient import TestClient
+
+from ai_edu_api import main
+from ai_edu_api.ai_logic.metrics import MetricsRegistry, STAGE_SECONDS, STREAM_TTFT_SECONDS, StreamTimer
+from ai_edu_api.ai_logic.upstream import set_upstream
+
+
+def test_histogram_renders_prometheus_text():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("demo_seconds", "デモ", ("stage",), buckets=(0.1, 1))
+    histogram.observe(0.05, "parse")
+    histogram.observe(0.5, "parse")
+    histogram.observe(5, "parse")
+    counter = registry.counter("demo_total", "デモ", ("path",))
+    counter.inc(2, 'a"b')
+
+    text = registry.render()
+
+    assert "# TYPE demo_seconds histogram" in text
+    assert 'demo_seconds_bucket{stage="parse",le="0.1"} 1' in text
+    assert 'demo_seconds_bucket{stage="parse",le="1"} 2' in text
+    assert 'demo_seconds_bucket{stage="parse",le="+Inf"} 3' in text
+    assert 'demo_seconds_count{stage="parse"} 3' in text
+    assert 'demo_seconds_sum{stage="parse"} 5.55' in text
+    assert 'demo_total{path="a\\"b"} 2' in text
+
+
+def test_stream_timer_records_ttft_once():
+    before = STREAM_TTFT_SECONDS.count("test_stream")
+    timer = StreamTimer("test_stream")
+    timer.finish()
+    assert STREAM_TTFT_SECONDS.count("test_stream") == before
+    timer.token()
+    timer.token()
+    timer.finish()
+    assert STREAM_TTFT_SECONDS.count("test_stream") == before + 1
+
+
+class FakeUpstream:
+    in_flight = 0
+
+    async def stream_tokens(self, **kwargs):
+        for token in ["よく", "できました", "！"]:
+            yield token
+
+
+def test_chat_stream_records_spans_and_metrics_endpoint():
+    set_upstream(FakeUpstream())
+    try:
+        client = TestClient(main.app)
+        client.post("/chat/stream", json={"messages": [{"role": "user", "content": "終わった"}]})
+        text = client.get("/metrics").text
+    finally:
+        set_upstream(None)
+
+    assert STAGE_SECONDS.count("chat_stream", "prompt") >= 1
+    assert STREAM_TTFT_SECONDS.count("chat_stream") >= 1
+    assert 'http_request_duration_seconds_count{method="POST",path="/chat/stream",status="200"}' in text
+    assert "stream_tokens_per_second_bucket" in text
+    assert "upstream_in_flight 0" in text
@@ -0,0 +1,223 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+from ai_edu_api import main
+from ai_edu_api.ai_logic.model_router import LatencyTracker, ModelRouter
+from ai_edu_api.ai_logic.single_flight import SingleFlight
+from ai_edu_api.ai_logic.upstream import UpstreamClient, set_upstream
+from ai_edu_api.ai_logic.upstream_scheduler import UpstreamOverloaded
+
+ROUTES = {"chat": ["gpt-4o", "gpt-4o-mini"], "quiz": ["gpt-4o"], "stream": ["gpt-4o", "gpt-4o-mini", "gpt-3.5-turbo"]}
+
+
+def make_router(**kwargs):
+    options = dict(routes=ROUTES, default_delay=0.05, min_samples=5, min_delay=0.01, max_delay=1.0)
+    options.update(kwargs)
+    return ModelRouter(**options)
+
+
+def reply(model):
+    return SimpleNamespace(model=model, choices=[SimpleNamespace(message=SimpleNamespace(content=model))])
+
+
+class FakeUpstream:
+    """モデルごとの遅延・失敗を設定できるアップストリーム"""
+
+    def __init__(self, delays=None, errors=None):
+        self.delays = delays or {}
+        self.errors = errors or {}
+        self.calls = []
+        self.cancelled = []
+        self.closed = []
+
+    async def complete(self, model, **kwargs):
+        self.calls.append(model)
+        try:
+            await asyncio.sleep(self.delays.get(model, 0))
+        except asyncio.CancelledError:
+            self.cancelled.append(model)
+            raise
+        if model in self.errors:
+            raise self.errors[model]
+        return reply(model)
+
+    async def stream_tokens(self, model, **kwargs):
+        self.calls.append(model)
+        try:
+            await asyncio.sleep(self.delays.get(model, 0))
+            if model in self.errors:
+                raise self.errors[model]
+            for token in [model, ":", "ok"]:
+                yield token
+        finally:
+            self.closed.append(model)
+
+
+def test_resolve_rejects_unknown_models():
+    router = make_router()
+    assert router.resolve("chat") == ["gpt-4o", "gpt-4o-mini"]
+    assert router.resolve("chat", "gpt-4o-mini") == ["gpt-4o-mini", "gpt-4o"]
+    assert router.resolve("quiz", "gpt-3.5-turbo") == ["gpt-3.5-turbo", "gpt-4o"]
+    assert router.resolve("chat", "何でもいい文字列") == ["gpt-4o", "gpt-4o-mini"]
+    assert router.stats["rejected_models"] == 1
+
+
+def test_hedge_delay_adapts_to_recent_latency():
+    router = make_router(percentile=0.9)
+    assert router.hedge_delay("gpt-4o", "complete") == 0.05
+    for value in (0.1, 0.2, 0.3, 0.4, 0.5):
+        router.tracker.record("gpt-4o", "complete", value)
+    assert router.hedge_delay("gpt-4o", "complete") == 0.5
+    for _ in range(5):
+        router.tracker.record("gpt-4o", "complete", 30)
+    assert router.hedge_delay("gpt-4o", "complete") == 1.0  # 上限で頭打ち
+
+
+def test_hedge_delay_is_per_mode():
+    router = make_router(default_delay={"chat": 0.05, "quiz": 0.5})
+    assert router.hedge_delay("gpt-4o", "complete", "quiz") == 0.5
+    for _ in range(5):
+        router.tracker.record("gpt-4o", "complete", 0.1, "chat")
+    # 会話のサンプルが揃っても、問題生成の期限は問題生成のサンプルで決める
+    assert router.hedge_delay("gpt-4o", "complete", "chat") == 0.1
+    assert router.hedge_delay("gpt-4o", "complete", "quiz") == 0.5
+
+    upstream = FakeUpstream(delays={"gpt-4o": 0.2})
+    routes = {"quiz": ["gpt-4o", "gpt-4o-mini"]}
+    router = make_router(routes=routes, default_delay={"chat": 0.05, "quiz": 0.5})
+    assert asyncio.run(router.complete(upstream, "quiz", messages=[])).model == "gpt-4o"
+    assert router.stats["hedges"] == 0
+    assert router.tracker.count("gpt-4o", "complete", "quiz") == 1
+
+
+def test_latency_tracker_window():
+    tracker = LatencyTracker(window=3)
+    for value in (5, 1, 2, 3):
+        tracker.record("m", "ttft", value)
+    assert tracker.count("m", "ttft") == 3
+    assert tracker.percentile("m", "ttft", 0.0) == 1
+
+
+def test_slow_primary_is_hedged_and_loser_cancelled():
+    router = make_router()
+    upstream = FakeUpstream(delays={"gpt-4o": 1.0, "gpt-4o-mini": 0.0})
+    response = asyncio.run(router.complete(upstream, "chat", messages=[]))
+    assert response.model == "gpt-4o-mini"
+    assert upstream.cancelled == ["gpt-4o"]
+    assert router.stats["hedges"] == 1 and router.stats["hedge_wins"] == 1
+    # 負けた先頭モデルの経過時間も記録される
+    assert router.tracker.count("gpt-4o", "complete") == 1
+
+
+class ModelDelayCompletions:
+    """モデルごとに応答までの遅延を変えるOpenAIクライアントの代わり（キャンセルを記録する）"""
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.finished = []
+        self.cancelled = []
+
+    async def create(self, model, **kwargs):
+        try:
+            await asyncio.sleep(self.delays.get(model, 0))
+        except asyncio.CancelledError:
+            self.cancelled.append(model)
+            raise
+        self.finished.append(model)
+        return reply(model)
+
+
+def test_hedge_loser_is_cancelled_through_single_flight():
+    # 本番と同じく SingleFlight で合流する UpstreamClient でも、負けた側の上流呼び出しが止まること
+    completions = ModelDelayCompletions({"gpt-4o": 1.0, "gpt-4o-mini": 0.0})
+    upstream = UpstreamClient(
+        client=SimpleNamespace(chat=SimpleNamespace(completions=completions)), coalescer=SingleFlight(window=0)
+    )
+    router = make_router()
+
+    async def run():
+        response = await router.complete(upstream, "chat", messages=[])
+        await asyncio.sleep(0.01)
+        # asyncio.run の終了時の後片付けより前に、上流の呼び出しが止まって枠が返っていること
+        return response, list(completions.cancelled), upstream.in_flight, upstream.scheduler.active
+
+    response, cancelled, in_flight, active = asyncio.run(run())
+    assert response.model == "gpt-4o-mini"
+    assert cancelled == ["gpt-4o"]
+    assert completions.finished == ["gpt-4o-mini"]
+    assert in_flight == active == 0
+
+
+def test_fast_primary_is_not_hedged():
+    router = make_router()
+    upstream = FakeUpstream()
+    assert asyncio.run(router.complete(upstream, "chat", messages=[])).model == "gpt-4o"
+    assert upstream.calls == ["gpt-4o"]
+    assert router.stats["hedges"] == 0
+
+
+def test_failures_fall_back_but_overload_does_not():
+    router = make_router(hedge_enabled=False)
+    upstream = FakeUpstream(errors={"gpt-4o": ValueError("500")})
+    assert asyncio.run(router.complete(upstream, "chat", messages=[])).model == "gpt-4o-mini"
+    assert router.stats["fallbacks"] == 1
+
+    upstream = FakeUpstream(errors={"gpt-4o": UpstreamOverloaded("混雑")})
+    with pytest.raises(UpstreamOverloaded):
+        asyncio.run(router.complete(upstream, "chat", messages=[]))
+    assert upstream.calls == ["gpt-4o"]
+
+
+def test_hedge_budget_limits_extra_requests():
+    router = make_router(hedge_budget=0.0)
+    upstream = FakeUpstream(delays={"gpt-4o": 0.2})
+
+    async def run():
+        for _ in range(3):
+            await router.complete(upstream, "chat", messages=[])
+
+    asyncio.run(run())
+    assert router.stats["hedges"] == 1
+    assert router.stats["requests"] == 3
+
+
+def test_stream_hedges_on_first_token_and_closes_loser():
+    router = make_router()
+    # 予備にはリスト順ではなく、直近の中央値が最も速いモデルを使う
+    for _ in range(3):
+        router.tracker.record("gpt-4o-mini", "complete", 2.0)
+        router.tracker.record("gpt-3.5-turbo", "complete", 0.5)
+    upstream = FakeUpstream(delays={"gpt-4o": 1.0})
+
+    async def run():
+        return [token async for token in router.stream_tokens(upstream, "stream", messages=[])]
+
+    assert asyncio.run(run()) == ["gpt-3.5-turbo", ":", "ok"]
+    assert upstream.calls == ["gpt-4o", "gpt-3.5-turbo"]
+    assert sorted(upstream.closed) == ["gpt-3.5-turbo", "gpt-4o"]
+    assert router.stats["hedge_wins"] == 1
+
+
+def test_stream_falls_back_before_first_token():
+    router = make_router(hedge_enabled=False)
+    upstream = FakeUpstream(errors={"gpt-4o": ValueError("boom")})
+
+    async def run():
+        return [token async for token in router.stream_tokens(upstream, "stream", messages=[])]
+
+    assert asyncio.run(run())[0] == "gpt-4o-mini"
+
+
+def test_chat_does_not_forward_arbitrary_model_names():
+    upstream = FakeUpstream()
+    set_upstream(upstream)
+    try:
+        TestClient(main.app).post("/chat", json={
+            "messages": [{"role": "user", "content": "こんにちは"}], "model": "../../admin",
+        })
+    finally:
+        set_upstream(None)
+    assert upstream.calls == ["gpt-4o"]
@@ -0,0 +1,97 @@
+from ai_edu_api.supabase_logic.conversation_store import ConversationStore
+from ai_edu_api.supabase_logic.profile_store import PROFILE_PRUNE_INTERVAL, ProfileStore, RECORD_BYTES
+from ai_edu_api.supabase_logic.resident_ai_agent import ResidentAIAgent
+from ai_edu_api.supabase_logic.state_backend import MemoryStateBackend, SQLiteStateBackend
+
+
+def test_analyze_only_folds_messages_past_watermark():
+    store = ProfileStore()
+    history = [
+        {"role": "assistant", "content": "こんにちは", "created_at": 100.0},
+        {"role": "user", "content": "やった！", "emotion": "喜び", "created_at": 110.0},
+    ]
+    store.analyze("u1", history)
+
+    history.append({"role": "user", "content": "うーん", "emotion": "悲しみ", "created_at": 120.0})
+    profile = store.analyze("u1", history)
+    record = store.record("u1")
+
+    assert record.message_count == 2
+    assert record.latency_ewma == 10.0
+    assert profile["感情履歴"] == ["喜び", "悲しみ"]
+
+
+def test_analyze_without_timestamps_folds_history_once_then_latest_turn():
+    store = ProfileStore()
+    history = [{"role": "user", "content": "a"}, {"role": "user", "content": "b"}]
+    store.analyze("u1", history)
+    store.analyze("u1", history + [{"role": "user", "content": "c"}])
+
+    assert store.record("u1").message_count == 3
+
+
+def test_single_message_requests_are_all_folded():
+    # 1回のリクエストで新しい発言1件だけを送るクライアント。同じ「はい」が続いても毎回数える
+    store = ProfileStore()
+    for text in ("はい", "はい", "なるほど", "次は？"):
+        store.analyze("u1", [{"role": "user", "content": text, "emotion": "喜び"}])
+    assert store.record("u1").message_count == 4
+
+
+def make_agent():
+    return ResidentAIAgent(state_backend=MemoryStateBackend(), conversations=ConversationStore())
+
+
+def test_repeated_turns_in_a_chat_are_all_folded():
+    agent = make_agent()
+    seq = agent.record_turn("c1", [{"role": "user", "content": "はい"}], None, "次の問題です", user_id="u1")
+    agent.record_turn("c1", [{"role": "user", "content": "はい"}], seq, "次の問題です", user_id="u1")
+    assert agent.user_profiles.record("u1").message_count == 2
+
+    # 全履歴の再送でも、この会話で保存済みの件数より後ろだけを新しい発言として数える
+    history = [{"role": "user", "content": "はい"}]
+    agent.record_turn("c2", history, None, "次の問題です", user_id="u2")
+    history += [{"role": "assistant", "content": "次の問題です"}, {"role": "user", "content": "はい"}]
+    agent.record_turn("c2", history, None, "次の問題です", user_id="u2")
+    assert agent.user_profiles.record("u2").message_count == 2
+
+
+def test_interleaved_chats_are_not_double_counted():
+    agent = make_agent()
+    agent.record_turn("a", [{"role": "user", "content": "a1"}], None, "ra1", user_id="u1")
+    agent.record_turn("b", [{"role": "user", "content": "b1"}], None, "rb1", user_id="u1")
+    history_a = [
+        {"role": "user", "content": "a1"}, {"role": "assistant", "content": "ra1"}, {"role": "user", "content": "a2"},
+    ]
+    agent.record_turn("a", history_a, None, "ra2", user_id="u1")
+
+    assert agent.user_profiles.record("u1").message_count == 3
+
+
+def test_shared_profiles_table_is_pruned(tmp_path, clock):
+    backend = SQLiteStateBackend(str(tmp_path / "state.sqlite3"), clock=clock)
+    store = ProfileStore(max_users=2, ttl=60, backend=backend, clock=clock)
+    for user_id in ("a", "b", "c"):
+        clock.now += 1
+        store.analyze(user_id, [{"content": "x"}])
+    clock.now += PROFILE_PRUNE_INTERVAL
+    store.analyze("c", [{"content": "y"}])
+
+    # 件数上限を超えた古いユーザーは表からも消える
+    assert backend.get_profile("a") is None
+    assert backend.get_profile("c") is not None
+    clock.now += 61 + PROFILE_PRUNE_INTERVAL
+    store.analyze("d", [{"content": "x"}])
+    assert backend.get_profile("b") is None and backend.get_profile("c") is None
+
+
+def test_lru_ttl_and_memory_cap(clock):
+    store = ProfileStore(max_users=100, ttl=60, max_bytes=RECORD_BYTES * 2, clock=clock)
+    for user_id in ("a", "b", "c"):
+        store.analyze(user_id, [{"content": "x"}])
+
+    assert len(store) == 2
+    assert "a" not in store
+
+    clock.now += 61
+    assert store.get("c") is None
@@ -0,0 +1,64 @@
+import os
+from types import SimpleNamespace
+
+from ai_edu_api import main
+from ai_edu_api.ai_logic.generate_problem_prompt import generate_problem_prompt as general_prompt
+from ai_edu_api.ai_logic.metrics import CACHED_PROMPT_TOKENS_TOTAL, PROMPT_TOKENS_TOTAL, record_usage
+from ai_edu_api.ai_logic.prompt_templates import CHAT_TEMPLATE, QUIZ_TEMPLATE, GENERAL_QUIZ_TEMPLATE
+from ai_edu_api.benchmarks.mock_openai import PromptCacheSimulator
+
+
+def common_prefix(a, b):
+    return os.path.commonprefix([a.encode("utf-8"), b.encode("utf-8")])
+
+
+def test_identical_settings_give_byte_identical_prompts():
+    a = main.generate_problem_prompt(tags=["時制", "前置詞"], level="英検2級", count=3)
+    b = main.generate_problem_prompt(tags=[" 前置詞", "時制", "時制"], level="英検2級", count=3)
+    assert a["content"].encode("utf-8") == b["content"].encode("utf-8")
+
+
+def test_static_then_settings_then_user_order():
+    profile_a = {"性格": "おおらか", "傾向": "夜型・返信早い・感情穏やか"}
+    profile_b = {"性格": "繊細", "傾向": "朝型・じっくり返信・ネガティブ多め"}
+    a = main.generate_problem_prompt(user_profile=profile_a, tags=["前置詞"], count=2)["content"]
+    b = main.generate_problem_prompt(user_profile=profile_b, tags=["前置詞"], count=2)["content"]
+    c = main.generate_problem_prompt(user_profile=profile_a, tags=["時制"], count=2)["content"]
+
+    assert a.startswith(QUIZ_TEMPLATE.static_text)
+    assert a.index("【今回の出題条件】") < a.index("おおらか")
+    # ユーザーが違っても静的な指示と出題条件までは共通の接頭辞になる
+    assert len(common_prefix(a, b)) >= len(a[:a.index("【ユーザー情報】")].encode("utf-8"))
+    # 出題条件が違っても静的な指示は共通
+    assert len(common_prefix(a, c)) >= len(QUIZ_TEMPLATE.static_text.encode("utf-8"))
+    assert "**2問**" in a
+
+
+def test_general_prompt_and_chat_prompt_start_with_static_blocks():
+    prompt = general_prompt(user_profile={"性格": "好奇心旺盛", "感情履歴": ["驚き"]}, tags=["数理"])["content"]
+    assert prompt.startswith(GENERAL_QUIZ_TEMPLATE.static_text)
+    assert prompt.index("出題範囲: 数理") < prompt.index("好奇心旺盛")
+    assert main.CHAT_SYSTEM_PROMPT["content"] == CHAT_TEMPLATE.static_text
+    with_context = CHAT_TEMPLATE.render(user="ユーザープロファイル", conversation="以下はこれまでの会話の文脈です")
+    assert with_context.startswith(CHAT_TEMPLATE.static_text)
+    assert with_context.index("ユーザープロファイル") < with_context.index("以下はこれまでの会話の文脈です")
+
+
+def test_record_usage_tracks_cached_tokens():
+    before_prompt = PROMPT_TOKENS_TOTAL.value("cache-test")
+    before_cached = CACHED_PROMPT_TOKENS_TOTAL.value("cache-test")
+    usage = SimpleNamespace(
+        prompt_tokens=2000, completion_tokens=50, prompt_tokens_details=SimpleNamespace(cached_tokens=1536)
+    )
+    record_usage("cache-test", usage)
+    record_usage("cache-test", SimpleNamespace(prompt_tokens=100, completion_tokens=5, prompt_tokens_details=None))
+    assert PROMPT_TOKENS_TOTAL.value("cache-test") - before_prompt == 2100
+    assert CACHED_PROMPT_TOKENS_TOTAL.value("cache-test") - before_cached == 1536
+
+
+def test_mock_prompt_cache_hits_on_shared_prefix():
+    cache = PromptCacheSimulator(min_tokens=256, block_tokens=128)
+    system = {"role": "system", "content": QUIZ_TEMPLATE.static_text * 2}
+    assert cache.lookup([system, {"role": "user", "content": "問題を作って"}]) == 0
+    cached = cache.lookup([system, {"role": "user", "content": "別の質問です"}])
+    assert cached >= 256
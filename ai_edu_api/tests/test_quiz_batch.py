@@ -0,0 +1,105 @@
+import asyncio
+import json
+
+from ai_edu_api.ai_logic.quiz_batch import (
+    IncrementalJSONArrayParser,
+    format_event,
+    generate_quiz_batch,
+    split_counts,
+)
+from ai_edu_api.ai_logic.upstream_scheduler import UpstreamRateLimited
+
+
+def make_problem(i):
+    return {"question": f"問{i}", "options": ["A", "B", "C", "D"], "answer": "A", "explanation": "解説"}
+
+
+class FakeUpstream:
+    """プロンプトで要求された問題数をチャンクに分けてストリーミングする"""
+
+    def __init__(self, broken_first=False):
+        self.requests = []
+        self.broken_first = broken_first
+
+    async def stream_tokens(self, model, messages):
+        n = messages[0]["content"]
+        self.requests.append(n)
+        problems = [make_problem(len(self.requests) * 100 + i) for i in range(n)]
+        if self.broken_first and len(self.requests) == 1:
+            problems[0] = {"question": "壊れた問題"}  # answerが無い
+        text = "```json\n" + json.dumps(problems, ensure_ascii=False) + "\n```"
+        for start in range(0, len(text), 7):
+            await asyncio.sleep(0)
+            yield text[start:start + 7]
+
+
+def collect(upstream, count, **kwargs):
+    async def run():
+        return [
+            event async for event in generate_quiz_batch(
+                upstream, lambda n: {"role": "system", "content": n}, count, **kwargs
+            )
+        ]
+    return asyncio.run(run())
+
+
+def test_parser_yields_objects_as_they_complete():
+    parser = IncrementalJSONArrayParser()
+    text = '{"problems": [{"q": "a[1]", "tags": ["x"]}, {"q": "b\\"}"}, {"q": ]'
+
+    split = text.index("]}") + 2
+
+    assert parser.feed(text[:split - 1]) == []
+    assert parser.feed(text[split - 1:split]) == [{"q": "a[1]", "tags": ["x"]}]
+    assert parser.feed(text[split:]) == [{"q": 'b"}'}]
+    assert parser.errors == 1
+
+
+def test_split_counts():
+    assert split_counts(5, 2) == [2, 2, 1]
+    assert split_counts(1, 4) == [1]
+
+
+def test_generate_quiz_batch_fans_out():
+    upstream = FakeUpstream()
+    events = collect(upstream, 5, per_request=2, concurrency=3)
+
+    assert sorted(upstream.requests) == [1, 2, 2]
+    assert [e["index"] for e in events if e["type"] == "problem"] == [0, 1, 2, 3, 4]
+    assert events[-1] == {"type": "done", "count": 5, "failed": 0}
+
+
+def test_generate_quiz_batch_retries_only_failed_items():
+    upstream = FakeUpstream(broken_first=True)
+    events = collect(upstream, 2, per_request=2)
+
+    assert upstream.requests == [2, 1]
+    assert events[-1] == {"type": "done", "count": 2, "failed": 0}
+
+
+def test_generate_quiz_batch_waits_retry_after_when_refused():
+    class RefusingUpstream(FakeUpstream):
+        async def stream_tokens(self, model, messages):
+            if not self.requests:
+                self.requests.append("refused")
+                raise UpstreamRateLimited("busy", retry_after=3)
+            async for delta in super().stream_tokens(model, messages):
+                yield delta
+
+    upstream = RefusingUpstream()
+    waits = []
+
+    async def sleep(seconds):
+        waits.append(seconds)
+
+    events = collect(upstream, 1, per_request=1, sleep=sleep)
+
+    assert waits == [3.0]
+    assert upstream.requests == ["refused", 1]
+    assert events[-1] == {"type": "done", "count": 1, "failed": 0}
+
+
+def test_format_event():
+    event = {"type": "done", "count": 1, "failed": 0}
+    assert format_event(event) == 'data: {"type": "done", "count": 1, "failed": 0}\n\n'
+    assert format_event(event, "ndjson").endswith("}\n")
@@ -0,0 +1,177 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from fastapi.testclient import TestClient
+
+from ai_edu_api import main
+from ai_edu_api.ai_logic.quiz_pool import QuizPool, QuizPoolRefiller, pool_key, question_shingles, similarity
+from ai_edu_api.ai_logic.upstream import set_upstream
+
+
+QUESTIONS = [
+    "Choose the correct preposition: I arrived ___ the station.",
+    "彼が来るまでここで待っていてください。下線部の意味に最も近いものは？",
+    "Which word best completes the sentence: She is good ___ math.",
+    "次の英文の空所に入る最も適切な語を選びなさい: He has lived here ___ 2010.",
+    "Select the sentence that uses the present perfect correctly.",
+    "The meeting was put ___ until next week because of the storm.",
+]
+
+
+def make_problem(i):
+    return {"question": QUESTIONS[i], "options": ["at", "in", "on", "for"], "answer": "at", "explanation": "解説"}
+
+
+KEY = pool_key("gpt-4o", "multiple_choice", "英検2級", ["前置詞"], "quiz_card_v1")
+
+
+def test_pool_key_is_normalized():
+    assert pool_key("gpt-4o", " multiple_choice", "英検2級 ", ["時制", " 前置詞", "時制"], "quiz_card_v1") == \
+        pool_key("gpt-4o", "multiple_choice", "英検2級", ["前置詞", "時制"], "quiz_card_v1")
+
+
+def test_take_serves_from_stock_and_counts_hit_rate():
+    pool = QuizPool(low_watermark=2, high_watermark=4)
+    assert pool.take(KEY, 1) is None
+    for i in range(3):
+        assert pool.add(KEY, make_problem(i))
+
+    assert pool.take(KEY, 2) == [make_problem(0), make_problem(1)]
+    # 足りない場合は部分的に取り出さない
+    assert pool.take(KEY, 2) is None
+    assert pool.stock(KEY) == 1
+    assert pool.stats["hits"] == 1 and pool.stats["misses"] == 2
+    assert abs(pool.hit_rate - 1 / 3) < 1e-9
+
+
+def test_add_rejects_invalid_duplicates_and_overflow():
+    pool = QuizPool(low_watermark=1, high_watermark=3)
+    assert not pool.add(KEY, {"question": "答えが無い"})
+    assert pool.add(KEY, make_problem(0))
+    near = dict(make_problem(0), question="Choose the correct preposition:  I arrived ___ the station!")
+    assert not pool.add(KEY, near)
+    assert pool.add(KEY, make_problem(1))
+    assert pool.add(KEY, make_problem(2))
+    assert not pool.add(KEY, make_problem(3))  # 高水位
+    # 提供済みの問題とも重複させない
+    pool.take(KEY, 1)
+    assert not pool.add(KEY, make_problem(0))
+    assert pool.stats == dict(pool.stats, invalid=1, duplicates=2, overflow=1, added=3)
+    assert similarity(question_shingles(make_problem(0)), question_shingles(near)) >= 0.85
+
+
+def test_bucket_byte_cap():
+    size = len(json.dumps(make_problem(0), ensure_ascii=False).encode("utf-8"))
+    pool = QuizPool(low_watermark=1, high_watermark=10, max_bucket_bytes=size + 10)
+    assert pool.add(KEY, make_problem(0))
+    assert not pool.add(KEY, make_problem(1))
+    assert pool.stats["overflow"] == 1
+
+
+def test_refill_prefers_demand_and_decays(clock):
+    pool = QuizPool(low_watermark=2, high_watermark=5, demand_half_life=60, min_demand=0.5, clock=clock)
+    popular = pool_key("gpt-4o", "multiple_choice", "英検2級", ["時制"], "quiz_card_v1")
+    rare = pool_key("gpt-4o", "multiple_choice", "英検準1級", [], "quiz_card_v1")
+    for _ in range(3):
+        pool.take(popular)
+    pool.take(rare)
+    assert pool.next_refill() == (popular, 5)
+
+    for i in range(2):
+        pool.add(popular, make_problem(i))
+    assert pool.next_refill() == (rare, 5)  # 低水位以上の条件は補充しない
+
+    clock.now = 600  # 需要が半減期10回分たって最小値を下回る
+    assert pool.next_refill() is None
+
+
+def test_least_demanded_bucket_is_evicted():
+    pool = QuizPool(max_buckets=2)
+    keys = [pool_key("gpt-4o", "multiple_choice", level, [], "quiz_card_v1") for level in ("A", "B", "C")]
+    pool.seed(keys[0], demand=5)
+    pool.seed(keys[1], demand=1)
+    pool.seed(keys[2], demand=1)
+    levels = [bucket["level"] for bucket in pool.as_dict()["buckets"]]
+    assert levels == ["A", "C"]
+    assert pool.stats["evicted_buckets"] == 1
+
+
+class FakeUpstream:
+    def __init__(self):
+        self.calls = []
+
+    async def stream_tokens(self, model, messages):
+        self.calls.append((model, messages[0]["content"]))
+        start = len(self.calls) * 2 - 2
+        yield json.dumps([make_problem(start), make_problem(start + 1)], ensure_ascii=False)
+
+
+def test_refiller_fills_to_high_watermark():
+    pool = QuizPool(low_watermark=2, high_watermark=4)
+    pool.seed(KEY)
+    upstream = FakeUpstream()
+    refiller = QuizPoolRefiller(pool, lambda: upstream, lambda key, n: {"role": "system", "content": n}, batch_size=2)
+
+    async def run():
+        assert await refiller.refill_once() == 2
+        assert await refiller.refill_once() is None  # 低水位に達した
+        pool.take(KEY, 1)
+        assert await refiller.refill_once() == 2
+        return pool.stock(KEY)
+
+    assert asyncio.run(run()) == 3
+    assert upstream.calls == [("gpt-4o", 2), ("gpt-4o", 2)]
+
+
+def test_chat_quiz_intent_is_served_from_pool():
+    key = pool_key("gpt-4o", "multiple_choice", "英検3級", ["語彙"], "quiz_card_v1")
+    main.quiz_pool.add(key, make_problem(4))
+
+    class FailingUpstream:
+        async def complete(self, **kwargs):
+            raise AssertionError("プールから返すのでアップストリームは呼ばない")
+
+    set_upstream(FailingUpstream())
+    try:
+        response = TestClient(main.app).post("/chat", json={
+            "messages": [{"role": "user", "content": "問題を作って"}], "level": "英検3級", "tags": ["語彙"],
+        })
+    finally:
+        set_upstream(None)
+    assert json.loads(response.json()["reply"]) == [make_problem(4)]
+    assert main.quiz_pool.stock(key) == 0
+
+
+def test_quiz_topic_strips_trigger_keywords():
+    assert main.quiz_topic("問題を作って") == ""
+    assert main.quiz_topic("問題を出してください！") == ""
+    assert main.quiz_topic("Quiz please") == ""
+    assert main.quiz_topic("関係代名詞の問題を作って") == "関係代名詞"
+    assert main.quiz_topic("現在完了の問題作成お願いします") == "現在完了"
+
+
+def test_quiz_with_topic_is_not_served_from_pool():
+    key = pool_key("gpt-4o", "multiple_choice", "英検3級", [], "quiz_card_v1")
+    main.quiz_pool.add(key, make_problem(5))
+
+    class TopicUpstream:
+        def __init__(self):
+            self.calls = []
+
+        async def complete(self, **kwargs):
+            self.calls.append(kwargs)
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content='[{"q": 1}]'))])
+
+    upstream = TopicUpstream()
+    set_upstream(upstream)
+    try:
+        response = TestClient(main.app).post("/chat", json={
+            "messages": [{"role": "user", "content": "関係代名詞の問題を作って"}], "level": "英検3級",
+        })
+    finally:
+        set_upstream(None)
+    # 話題を指定した依頼は生徒の発言ごと上流に送って生成し、プールのストックは残る
+    assert response.json()["reply"] == '[{"q": 1}]'
+    assert upstream.calls[0]["messages"][-1]["content"] == "関係代名詞の問題を作って"
+    assert main.quiz_pool.stock(key) == 1
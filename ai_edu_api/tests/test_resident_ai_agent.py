@@ -19,7 +19,7 @@ def resident_ai_agent():
 def test_analyze_user(resident_ai_agent):
     user_id = "test_user"
     chat_history = [
-        {"content": "Hello!"},
+        {"content": "Hello!", "emotion": "喜び"},
         {"content": "How are you?"}
     ]
 
@@ -27,4 +27,6 @@ def test_analyze_user(resident_ai_agent):
 
     assert profile is not None
     assert profile["性格"] == "おおらか"
-    assert "Hello!" in profile["感情履歴"]
+    # 本文ではなく感情ラベルだけを保持する（感情の無い発言はローカルのラベラーで付ける）
+    assert profile["感情履歴"] == ["喜び", "ニュートラル"]
+    assert "Hello!" not in profile["感情履歴"]
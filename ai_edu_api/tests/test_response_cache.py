@@ -0,0 +1,88 @@
+from ai_edu_api.ai_logic.metrics import RESPONSE_CACHE_HITS, RESPONSE_CACHE_MISSES
+from ai_edu_api.ai_logic.response_cache import ResponseCache, profile_bucket, quiz_cache_key
+
+
+def test_quiz_cache_key_normalizes_tags_and_profile():
+    profile_a = {"性格": "おおらか", "傾向": "夜型", "感情履歴": ["喜び", "喜び", "驚き"]}
+    profile_b = {"性格": "おおらか", "傾向": "夜型", "感情履歴": ["驚き", "喜び", "喜び", "喜び"]}
+
+    key_a = quiz_cache_key(profile_a, level="中級", tags=["文法", "語彙"])
+    key_b = quiz_cache_key(profile_b, level="中級", tags=[" 語彙", "文法", "文法"])
+
+    assert key_a == key_b
+    assert key_a != quiz_cache_key(profile_a, level="上級", tags=["文法", "語彙"])
+    assert key_a != quiz_cache_key(profile_a, level="中級", tags=["文法", "語彙"], topic="関係代名詞")
+
+
+def test_serves_variants_in_rotation_after_filling(clock):
+    cache = ResponseCache(variants=2, ttl=60, clock=clock)
+
+    assert cache.get("k") is None
+    cache.put("k", "[1]")
+    assert cache.get("k") is None
+    cache.put("k", "[2]")
+
+    assert [cache.get("k") for _ in range(3)] == ["[1]", "[2]", "[1]"]
+    assert cache.stats["hits"] == 3
+    assert cache.stats["misses"] == 2
+
+
+def test_ttl_and_size_eviction(clock):
+    cache = ResponseCache(variants=1, ttl=60, max_bytes=10, clock=clock)
+    cache.put("a", "12345")
+    cache.put("b", "12345")
+    cache.put("c", "12345")
+
+    assert cache.get("a") is None
+    assert cache.stats["evictions"] == 1
+
+    clock.now += 61
+    assert cache.get("c") is None
+    assert cache.stats["expired"] == 1
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    ResponseCache(variants=1, disk_path=path).put("k", "[1]")
+
+    restarted = ResponseCache(variants=1, disk_path=path)
+
+    assert restarted.get("k") == "[1]"
+    assert restarted.stats["disk_hits"] == 1
+
+
+def test_profile_bucket_uses_a_small_label_set():
+    night = {"性格": "おおらか", "傾向": "夜型・返信早い・ポジティブ多め", "感情履歴": ["喜び"]}
+    morning = {"性格": "おおらか", "傾向": "朝型・じっくり返信・ポジティブ多め", "感情履歴": ["喜び"]}
+    free_text = {"性格": "明るくて元気な子", "傾向": "部活帰りによく話す", "感情履歴": ["喜び", "ワクワク"]}
+
+    assert profile_bucket(night) == profile_bucket(morning) == "おおらか|ポジティブ多め|喜び"
+    assert profile_bucket(free_text) == "その他|その他|喜び"
+
+
+def test_put_keeps_variants_stored_on_disk(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    ResponseCache(variants=2, disk_path=path).put("k", "[1]")
+
+    restarted = ResponseCache(variants=2, disk_path=path)
+    restarted.put("k", "[2]")
+
+    assert ResponseCache(variants=2, disk_path=path).get("k") == "[1]"
+    assert restarted.get("k") == "[1]"
+    assert restarted.get("k") == "[2]"
+
+
+def test_hits_and_misses_are_exported_by_tier(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    ResponseCache(variants=1, disk_path=path).put("k", "[1]")
+    hits = {tier: RESPONSE_CACHE_HITS.value(tier) for tier in ("memory", "disk")}
+    misses = RESPONSE_CACHE_MISSES.value("disk")
+
+    cache = ResponseCache(variants=1, disk_path=path)
+    cache.get("k")
+    cache.get("k")
+    cache.get("other")
+
+    assert RESPONSE_CACHE_HITS.value("disk") == hits["disk"] + 1
+    assert RESPONSE_CACHE_HITS.value("memory") == hits["memory"] + 1
+    assert RESPONSE_CACHE_MISSES.value("disk") == misses + 1
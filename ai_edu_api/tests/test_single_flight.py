@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+from ai_edu_api.ai_logic.single_flight import SingleFlight, coalesce_key
+from ai_edu_api.ai_logic.upstream import UpstreamClient
+from ai_edu_api.tests.test_upstream import make_client
+
+
+def test_coalesce_key_is_canonical():
+    a = coalesce_key(model="gpt-4o", messages=[{"role": "user", "content": "問題を作って"}], response_format={"type": "json_object"})
+    b = coalesce_key(response_format={"type": "json_object"}, messages=[{"content": "問題を作って", "role": "user"}], model="gpt-4o")
+    c = coalesce_key(model="gpt-4o-mini", messages=[{"role": "user", "content": "問題を作って"}], response_format={"type": "json_object"})
+    assert a == b
+    assert a != c
+
+
+def test_identical_concurrent_requests_share_one_upstream_call():
+    client, completions = make_client(delay=0.01)
+    completions.calls = 0
+    original = completions.create
+
+    async def counting_create(**kwargs):
+        completions.calls += 1
+        return await original(**kwargs)
+
+    completions.create = counting_create
+    upstream = UpstreamClient(client=client, coalescer=SingleFlight(window=0))
+    messages = [{"role": "system", "content": "英検2級の問題"}, {"role": "user", "content": "問題を作って"}]
+
+    async def run():
+        same = [upstream.complete(model="gpt-4o", messages=messages) for _ in range(20)]
+        other = upstream.complete(model="gpt-4o", messages=messages[:1])
+        return await asyncio.gather(*same, other)
+
+    responses = asyncio.run(run())
+
+    assert completions.calls == 2
+    assert len({id(r) for r in responses[:20]}) == 1  # 同じレスポンスを共有
+    assert upstream.coalescer.stats["leaders"] == 2
+    assert upstream.coalescer.stats["coalesced"] == 19
+    assert upstream.coalescer.in_flight == 0
+
+
+def test_upstream_call_is_cancelled_only_when_last_waiter_leaves():
+    flight = SingleFlight(window=0)
+    started = []
+    cancelled = []
+
+    async def slow():
+        started.append(1)
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def run():
+        first = asyncio.ensure_future(flight.do("k", slow))
+        second = asyncio.ensure_future(flight.do("k", slow))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        still_running = not cancelled
+        second.cancel()
+        await asyncio.gather(second, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        return still_running
+
+    assert asyncio.run(run())
+    assert started == [1]
+    assert cancelled == [1]
+    assert flight.stats["cancelled"] == 1
+    assert flight.in_flight == 0
+
+
+def test_window_reuses_result_after_completion_then_expires():
+    now = [0.0]
+    flight = SingleFlight(window=5, clock=lambda: now[0])
+    calls = []
+
+    async def call():
+        calls.append(1)
+        return len(calls)
+
+    async def run():
+        first = await flight.do("k", call)
+        now[0] = 3.0
+        second = await flight.do("k", call)  # ウィンドウ内は相乗り
+        now[0] = 10.0
+        third = await flight.do("k", call)  # ウィンドウ外は新しく呼ぶ
+        return first, second, third
+
+    assert asyncio.run(run()) == (1, 1, 2)
+    assert flight.stats["coalesced"] == 1
+
+
+def test_errors_are_shared_but_not_retained():
+    flight = SingleFlight(window=10)
+    attempts = []
+
+    async def failing():
+        attempts.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream down")
+
+    async def run():
+        results = await asyncio.gather(*[flight.do("k", failing) for _ in range(3)], return_exceptions=True)
+        assert all(isinstance(r, RuntimeError) for r in results)
+        with pytest.raises(RuntimeError):
+            await flight.do("k", failing)  # 失敗は保持せず再試行する
+
+    asyncio.run(run())
+    assert len(attempts) == 2
+    assert flight.stats["errors"] == 2
@@ -0,0 +1,92 @@
+import asyncio
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from ai_edu_api.ai_logic import startup
+from ai_edu_api.ai_logic.startup import FirstRequestMiddleware, StartupReport, run_warmup
+from ai_edu_api.benchmarks.cold_start import parse_importtime
+from ai_edu_api.supabase_logic import resident_ai_agent
+
+
+def test_run_warmup_records_steps_and_errors():
+    report = StartupReport()
+    calls = []
+
+    async def async_step():
+        calls.append("async")
+
+    def failing():
+        raise RuntimeError("no network")
+
+    asyncio.run(run_warmup([
+        ("sync", lambda: calls.append("sync")),
+        ("async", async_step),
+        ("fail", failing),
+        ("skipped", lambda: calls.append("skipped")),
+    ], report))
+
+    assert calls == ["sync", "async"]
+    assert set(report.steps) == {"sync", "async"}
+    assert report.warmup_error == "fail: no network"
+    assert report.marks["warmup_done"] >= report.marks["warmup_start"]
+
+
+def test_requests_wait_for_background_warmup():
+    order = []
+
+    async def slow_step():
+        await asyncio.sleep(0.05)
+        order.append("warm")
+
+    async def run():
+        startup.start_warmup([("slow", slow_step)], StartupReport())
+        await startup.wait_for_warmup()
+        order.append("request")
+        await startup.stop_warmup()
+
+    asyncio.run(run())
+    assert order == ["warm", "request"]
+
+
+def test_first_request_middleware_records_once_per_path():
+    report = StartupReport()
+    app = FastAPI()
+    app.add_middleware(FirstRequestMiddleware, report=report)
+
+    @app.get("/")
+    async def index():
+        return {"status": "ok"}
+
+    client = TestClient(app)
+    client.get("/")
+    first = dict(report.first_requests["/"])
+    client.get("/")
+    assert report.first_requests["/"] == first
+    assert first["latency"] >= 0
+
+
+def test_single_shared_resident_ai_is_not_started_on_creation():
+    resident_ai_agent.set_resident_ai(None)
+    try:
+        agent = resident_ai_agent.get_resident_ai()
+        assert resident_ai_agent.get_resident_ai() is agent
+        assert agent.updater is None  # バックグラウンドスレッドは start() まで動かない
+        agent.notify_new_messages()
+    finally:
+        resident_ai_agent.close_resident_ai()
+
+
+def test_parse_importtime():
+    stderr = "\n".join([
+        "import time: self [us] | cumulative | imported package",
+        "import time:       100 |        100 |   json.decoder",
+        "import time:       200 |        300 | json",
+        "import time:      1000 |       5000 |     openai.types",
+        "import time:       500 |       6000 |   openai",
+        "import time:       700 |       7000 | ai_edu_api.main",
+    ])
+    report = parse_importtime(stderr)
+    assert report["total_ms"] == 7.3
+    assert report["top"][0] == {"module": "ai_edu_api.main", "cumulative_ms": 7.0}
+    assert "openai.types" not in [m["module"] for m in report["top"]][:2]
@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+from ai_edu_api.supabase_logic.knowledge_graph import KnowledgeGraph, KnowledgeUpdater, SQLiteMessageSource
+from ai_edu_api.supabase_logic.profile_store import ProfileRecord, ProfileStore
+from ai_edu_api.supabase_logic.state_backend import (
+    MemoryStateBackend,
+    SQLiteStateBackend,
+    make_state_backend,
+)
+
+
+def test_profile_record_round_trip():
+    record = ProfileRecord()
+    record.fold({"role": "user", "content": "x", "emotion": "驚き", "created_at": 10.0})
+
+    restored = ProfileRecord.from_bytes(record.to_bytes())
+
+    assert restored.to_profile() == record.to_profile()
+    assert restored.watermark_ts == record.watermark_ts
+    assert restored.last_ai_ts is None
+
+
+def test_profiles_are_shared_between_workers(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    worker_a = ProfileStore(backend=SQLiteStateBackend(path))
+    worker_b = ProfileStore(backend=SQLiteStateBackend(path))
+    history = [{"role": "user", "content": "a", "emotion": "喜び", "created_at": 1.0}]
+
+    worker_a.analyze("u1", history)
+    history.append({"role": "user", "content": "b", "emotion": "怒り", "created_at": 2.0})
+    profile = worker_b.analyze("u1", history)
+
+    assert profile["感情履歴"] == ["喜び", "怒り"]
+    assert worker_a.get("u1")["感情履歴"] == ["喜び", "怒り"]
+
+
+def test_update_profile_is_atomic(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    backend = SQLiteStateBackend(path)
+
+    def increment(data):
+        return str(int(data or 0) + 1)
+
+    def worker():
+        for _ in range(20):
+            backend.update_profile("counter", increment)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert backend.get_profile("counter") == "80"
+
+
+def test_only_one_updater_ingests(tmp_path):
+    source = SQLiteMessageSource(str(tmp_path / "messages.sqlite3"))
+    source.insert([
+        {"id": "m1", "chat_id": "c", "sender": "user", "content": "英語 文法", "created_at": "2025-06-01T00:00:00+00:00"},
+    ])
+    path = str(tmp_path / "state.sqlite3")
+    leader = KnowledgeUpdater(KnowledgeGraph(), source, backend=SQLiteStateBackend(path))
+    follower = KnowledgeUpdater(KnowledgeGraph(), source, backend=SQLiteStateBackend(path))
+
+    assert leader.run_once() == 1
+    assert follower.run_once() == 0
+    assert follower.stats["role"] == "follower"
+    # フォロワーは共有バックエンドからグラフを同期する
+    assert follower.graph.term_counts == {"英語": 1, "文法": 1}
+
+    leader.stop()
+    source.insert([
+        {"id": "m2", "chat_id": "c", "sender": "user", "content": "英語 長文", "created_at": "2025-06-01T00:00:01+00:00"},
+    ])
+    assert follower.run_once() == 1
+    assert follower.graph.term_counts["英語"] == 2
+
+
+def test_make_state_backend(tmp_path):
+    assert isinstance(make_state_backend("memory"), MemoryStateBackend)
+    assert isinstance(make_state_backend(f"sqlite:///{tmp_path / 's.sqlite3'}"), SQLiteStateBackend)
+    with pytest.raises(ValueError):
+        make_state_backend("redis://localhost")
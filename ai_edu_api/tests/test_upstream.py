@@ -0,0 +1,56 @@
+import asyncio
+from types import SimpleNamespace
+
+from ai_edu_api.ai_logic.upstream import UpstreamClient
+from ai_edu_api.tests.conftest import FakeStream
+
+
+class FakeCompletions:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.active = 0
+        self.peak = 0
+
+    async def create(self, stream=False, **kwargs):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+        if stream:
+            return FakeStream(["こん", "にちは"])
+        message = SimpleNamespace(content="ok")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def make_client(delay=0.0):
+    completions = FakeCompletions(delay)
+    return SimpleNamespace(chat=SimpleNamespace(completions=completions)), completions
+
+
+def test_complete_respects_concurrency_limit():
+    client, completions = make_client(delay=0.01)
+    upstream = UpstreamClient(client=client, max_concurrency=3)
+
+    async def run():
+        return await asyncio.gather(*[
+            upstream.complete(model="gpt-4o", messages=[]) for _ in range(10)
+        ])
+
+    responses = asyncio.run(run())
+
+    assert len(responses) == 10
+    assert completions.peak == 3
+    assert upstream.in_flight == 0
+
+
+def test_stream_tokens_yields_plain_text_deltas():
+    client, _ = make_client()
+    upstream = UpstreamClient(client=client)
+
+    async def run():
+        return [delta async for delta in upstream.stream_tokens(model="gpt-4o", messages=[])]
+
+    assert asyncio.run(run()) == ["こん", "にちは"]
+    assert upstream.in_flight == 0
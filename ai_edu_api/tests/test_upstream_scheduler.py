@@ -0,0 +1,256 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+from ai_edu_api import main
+from ai_edu_api.ai_logic import upstream as upstream_module
+from ai_edu_api.ai_logic.upstream import UpstreamClient, set_upstream
+from ai_edu_api.ai_logic.upstream_scheduler import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_BULK,
+    PRIORITY_INTERACTIVE,
+    UpstreamOverloaded,
+    UpstreamScheduler,
+    UserRateLimiter,
+    backoff_delay,
+    call_with_retries,
+    parse_retry_after,
+)
+from ai_edu_api.tests.conftest import FakeStream
+
+
+class APIError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.response = SimpleNamespace(headers=headers or {})
+
+
+def test_user_token_bucket(clock):
+    limiter = UserRateLimiter(rate=0.5, burst=2, clock=clock)
+    assert limiter.acquire("u1") == 0
+    assert limiter.acquire("u1") == 0
+    assert limiter.acquire("u1") == pytest.approx(2.0)
+    assert limiter.acquire("u2") == 0  # ユーザーごとに独立
+    assert limiter.acquire(None) == 0  # user_idが無ければ制限しない
+    clock.now = 2.0
+    assert limiter.acquire("u1") == 0
+
+
+def test_interactive_requests_jump_ahead_of_bulk():
+    scheduler = UpstreamScheduler(max_concurrency=1, rate_limiter=UserRateLimiter(rate=0))
+    order = []
+
+    async def use(name, priority, hold=None):
+        async with scheduler.slot(priority=priority):
+            order.append(name)
+            if hold is not None:
+                await hold.wait()
+
+    async def run():
+        hold = asyncio.Event()
+        first = asyncio.create_task(use("first", PRIORITY_INTERACTIVE, hold))
+        await asyncio.sleep(0)
+        tasks = [
+            asyncio.create_task(use("background", PRIORITY_BACKGROUND)),
+            asyncio.create_task(use("bulk", PRIORITY_BULK)),
+            asyncio.create_task(use("chat", PRIORITY_INTERACTIVE)),
+        ]
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 3
+        hold.set()
+        await asyncio.gather(first, *tasks)
+
+    asyncio.run(run())
+    assert order == ["first", "chat", "bulk", "background"]
+    assert scheduler.active == 0 and scheduler.queue_depth == 0
+
+
+def test_full_queue_sheds_or_preempts_lower_priority():
+    scheduler = UpstreamScheduler(max_concurrency=1, max_queue=1, rate_limiter=UserRateLimiter(rate=0))
+
+    async def use(priority, hold=None):
+        async with scheduler.slot(priority=priority):
+            if hold is not None:
+                await hold.wait()
+            return priority
+
+    async def run():
+        hold = asyncio.Event()
+        running = asyncio.create_task(use(PRIORITY_INTERACTIVE, hold))
+        await asyncio.sleep(0)
+        bulk = asyncio.create_task(use(PRIORITY_BULK))
+        await asyncio.sleep(0)
+        # 満杯・割り込める待ちが無い → 即座に503
+        with pytest.raises(UpstreamOverloaded):
+            scheduler.admit(priority=PRIORITY_BULK)
+        with pytest.raises(UpstreamOverloaded):
+            await use(PRIORITY_BULK)
+        # 対話のリクエストは一括生成の待ちを押し出して入る
+        scheduler.admit(priority=PRIORITY_INTERACTIVE)
+        chat = asyncio.create_task(use(PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0)
+        hold.set()
+        results = await asyncio.gather(running, bulk, chat, return_exceptions=True)
+        return results
+
+    results = asyncio.run(run())
+    assert isinstance(results[1], UpstreamOverloaded)
+    assert results[2] == PRIORITY_INTERACTIVE
+    assert scheduler.active == 0 and scheduler.queue_depth == 0
+
+
+def test_cancelled_waiter_leaves_queue():
+    scheduler = UpstreamScheduler(max_concurrency=1, rate_limiter=UserRateLimiter(rate=0))
+
+    async def run():
+        hold = asyncio.Event()
+
+        async def holder():
+            async with scheduler.slot():
+                await hold.wait()
+
+        async def waiter():
+            async with scheduler.slot():
+                pass
+
+        first = asyncio.create_task(holder())
+        await asyncio.sleep(0)
+        second = asyncio.create_task(waiter())
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth == 1
+        second.cancel()
+        await asyncio.gather(second, return_exceptions=True)
+        assert scheduler.queue_depth == 0
+        hold.set()
+        await first
+
+    asyncio.run(run())
+    assert scheduler.active == 0
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(APIError(429, {"retry-after-ms": "1500"})) == 1.5
+    assert parse_retry_after(APIError(429, {"retry-after": "3"})) == 3.0
+    assert parse_retry_after(APIError(429, {"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0.0
+    assert parse_retry_after(APIError(429)) is None
+    assert parse_retry_after(ValueError()) is None
+
+
+def test_backoff_delay_is_jittered_and_honors_retry_after():
+    assert backoff_delay(0, base=1, cap=10, rand=lambda: 0.5) == 0.5
+    assert backoff_delay(5, base=1, cap=10, rand=lambda: 1.0) == 10
+    assert backoff_delay(0, retry_after=3, base=1, cap=10, rand=lambda: 0.5) == 3
+
+
+def test_retries_release_slot_and_honor_retry_after(clock):
+    scheduler = UpstreamScheduler(max_concurrency=1, rate_limiter=UserRateLimiter(rate=0), clock=clock)
+    errors = [APIError(429, {"retry-after": "2"}), APIError(503)]
+    sleeps = []
+
+    async def call():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    async def sleep(delay):
+        assert scheduler.active == 0  # 待っている間は枠を手放している
+        sleeps.append(delay)
+        clock.now += delay
+
+    async def run():
+        return await call_with_retries(call, scheduler, "complete", "gpt-4o", max_retries=3, sleep=sleep)
+
+    assert asyncio.run(run()) == "ok"
+    assert sleeps[0] >= 2 and len(sleeps) == 2
+    assert scheduler.paused_until == 2  # Retry-Afterの間は他のリクエストも送らない
+
+
+def test_pause_does_not_hold_slots():
+    scheduler = UpstreamScheduler(max_concurrency=1, rate_limiter=UserRateLimiter(rate=0))
+    held = []
+
+    async def use():
+        async with scheduler.slot():
+            held.append(scheduler.active)
+
+    async def run():
+        first = asyncio.create_task(use())
+        async with scheduler.slot():
+            second = asyncio.create_task(use())
+            await asyncio.sleep(0)
+            scheduler.pause(0.05)  # 並んでいる間に429が来た
+        await asyncio.sleep(0.01)
+        paused_active = scheduler.active
+        await asyncio.gather(first, second)
+        return paused_active
+
+    assert asyncio.run(run()) == 0  # 停止中は誰も枠を持っていない
+    assert held == [1, 1] and scheduler.active == 0
+
+
+def test_retries_exhausted_or_not_retryable(clock):
+    scheduler = UpstreamScheduler(max_concurrency=1, rate_limiter=UserRateLimiter(rate=0), clock=clock)
+
+    async def always(error):
+        raise error
+
+    async def sleep(delay):
+        clock.now += delay
+
+    async def run(error, **kwargs):
+        return await call_with_retries(lambda: always(error), scheduler, "complete", "gpt-4o", sleep=sleep, **kwargs)
+
+    with pytest.raises(UpstreamOverloaded) as info:
+        asyncio.run(run(APIError(429, {"retry-after": "7"}), max_retries=1))
+    assert info.value.retry_after == 7
+    clock.now = scheduler.paused_until  # Retry-Afterの停止が明けてから
+    with pytest.raises(APIError):
+        asyncio.run(run(APIError(400)))
+
+
+def test_stream_retries_before_first_token():
+    class FlakyCompletions:
+        def __init__(self):
+            self.calls = 0
+
+        async def create(self, stream=False, **kwargs):
+            self.calls += 1
+            if self.calls == 1:
+                raise APIError(503, {"retry-after-ms": "1"})
+            return FakeStream(["こん", "にちは"])
+
+    completions = FlakyCompletions()
+    upstream = UpstreamClient(client=SimpleNamespace(chat=SimpleNamespace(completions=completions)))
+
+    async def run():
+        return [token async for token in upstream.stream_tokens(model="gpt-4o", messages=[])]
+
+    assert asyncio.run(run()) == ["こん", "にちは"]
+    assert completions.calls == 2
+
+
+def test_chat_returns_429_with_retry_after():
+    scheduler = upstream_module._scheduler
+    original = scheduler.rate_limiter
+    scheduler.rate_limiter = UserRateLimiter(rate=0.1, burst=1)
+
+    class FakeUpstream:
+        async def complete(self, **kwargs):
+            message = SimpleNamespace(content='{"reply": "ok", "emotion": "ニュートラル"}')
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    set_upstream(FakeUpstream())
+    try:
+        client = TestClient(main.app)
+        body = {"messages": [{"role": "user", "content": "こんにちは"}], "user_id": "rate-test"}
+        assert client.post("/chat", json=body).status_code == 200
+        response = client.post("/chat", json=body)
+    finally:
+        set_upstream(None)
+        scheduler.rate_limiter = original
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 9
+    assert response.json()["retry_after"] >= 9